@@ -3,7 +3,8 @@
 from flask.ext.httpauth import HTTPBasicAuth
 from functools import wraps
 from flask import request, make_response, current_app
-from json import loads, dumps
+from json import dumps
+from core.utils import request_json
 from werkzeug.datastructures import Authorization
 
 anonymous = Authorization('basic', {'username': 'anonymous', 'password': None})
@@ -37,8 +38,14 @@ def authentificate_failed():
 
 class DesiredCapabilitiesAuth(HTTPBasicAuth):
     def get_auth_from_caps(self):
+        """ Parsed once per request. """
+        if not hasattr(request, 'caps_auth'):
+            request.caps_auth = self._parse_auth_from_caps()
+        return request.caps_auth
+
+    def _parse_auth_from_caps(self):
         try:
-            body = loads(request.data)
+            body = request_json(request)
         except ValueError:
             return anonymous
         try:
@@ -1,11 +1,14 @@
 # coding: utf-8
 
 import logging
-from sqlalchemy import create_engine, inspect, desc
+from sqlalchemy import create_engine, inspect, desc, bindparam
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from core.sessions import Session
 from core.db.models import SessionLogStep, User, Platform
+from core.db.writer import StepWriter
+from core.db.cache import UserCache
 from core.utils import to_thread
 from core.config import config
 
@@ -26,6 +29,67 @@ def threaded_transaction(func):
     return wrapper
 
 
+def changed_columns(obj):
+    """ Column values changed since the object was loaded or saved.
+        Returns None if a relationship was changed, such objects
+        have to be merged. """
+    state = inspect(obj)
+    for relationship in state.mapper.relationships:
+        if state.attrs[relationship.key].history.has_changes():
+            return None
+
+    values = {}
+    for column in state.mapper.column_attrs:
+        history = state.attrs[column.key].history
+        if history.added:
+            values[column.key] = history.added[0]
+    return values
+
+
+def merge(obj, dbsession):
+    """ Related detached objects with unchanged columns, cached users
+        for example, are merged as they are, without loading. Cascaded
+        from the merge of obj they would be loaded and their possibly
+        stale columns written over the current ones. """
+    state = inspect(obj)
+    # the identity map keeps clean objects only while they are referenced
+    related = []
+    for relationship in state.mapper.relationships:
+        value = state.dict.get(relationship.key)
+        if relationship.uselist or value is None:
+            continue
+        value_state = inspect(value)
+        if value_state.detached and not columns_changed(value_state):
+            related.append(
+                dbsession.merge(clean_copy(value_state), load=False))
+    return dbsession.merge(obj)
+
+
+def columns_changed(state):
+    return any(state.attrs[column.key].history.has_changes()
+               for column in state.mapper.column_attrs)
+
+
+def clean_copy(state):
+    """ Copy of loaded column values, a backref append doesn't make
+        it dirty for merge(load=False). """
+    obj = state.manager.new_instance()
+    for column in state.mapper.column_attrs:
+        if column.key in state.dict:
+            setattr(obj, column.key, state.dict[column.key])
+    copy_state = inspect(obj)
+    copy_state.key = state.key
+    copy_state._commit_all(copy_state.dict)
+    return obj
+
+
+def mark_saved(obj, values):
+    """ Forget history of saved values, unless they were changed again. """
+    for key, value in values.items():
+        if getattr(obj, key) is value:
+            set_committed_value(obj, key, value)
+
+
 def transaction(func):
     def wrapper(self, *args, **kwargs):
         # Try to use passed dbsession
@@ -64,6 +128,8 @@ class Database(object):
                                           autoflush=False,
                                           expire_on_commit=False)
         self.DBSession = scoped_session(self.session_maker)
+        self.step_writer = StepWriter(self)
+        self.users = UserCache(User)
 
     @transaction
     def get_session(self, session_id, dbsession=None):
@@ -71,18 +137,38 @@ class Database(object):
             return None
         return dbsession.query(Session).get(session_id)
 
+    @transaction
+    def get_session_arrivals(self, since, dbsession=None):
+        """ Platform and creation time of sessions created since. """
+        return dbsession.query(Session.platform, Session.created).filter(
+            Session.created >= since, Session.platform.isnot(None)).all()
+
     @transaction
     def get_log_steps_for_session(self, session_id, dbsession=None):
+        self.step_writer.flush()
         return dbsession.query(SessionLogStep).filter_by(
             session_id=session_id).order_by(
                 desc(SessionLogStep.id)).all()
 
     @transaction
     def get_step_by_id(self, log_step_id, dbsession=None):
+        self.step_writer.flush()
         return dbsession.query(SessionLogStep).get(log_step_id)
 
+    def get_user(self, username=None, user_id=None):
+        """ Users are cached for USERS_CACHE_TTL seconds,
+            an update of a user drops it from the cache. """
+        if not user_id and not username:
+            return None
+        user = self.users.get(username=username, user_id=user_id)
+        if user is None:
+            user = self._get_user(username=username, user_id=user_id)
+            if user is not None:
+                self.users.put(user)
+        return user
+
     @transaction
-    def get_user(self, username=None, user_id=None, dbsession=None):
+    def _get_user(self, username=None, user_id=None, dbsession=None):
         if user_id:
             return dbsession.query(User).get(user_id)
         elif username:
@@ -116,11 +202,61 @@ class Database(object):
 
     @transaction
     def update(self, obj, dbsession=None):
-        dbsession.merge(obj)
-        dbsession.commit()
-        updated_obj = dbsession.query(type(obj)).get(obj.id)
-        dbsession.flush()
-        return updated_obj
+        try:
+            return self._update(obj, dbsession)
+        finally:
+            # after the commit, a user read in between
+            # would be cached with the old values
+            if isinstance(obj, User):
+                self.users.invalidate(obj)
+
+    def _update(self, obj, dbsession):
+        values = changed_columns(obj)
+        if values is None or obj.id is None:
+            merged = merge(obj, dbsession)
+            dbsession.commit()
+            dbsession.refresh(merged)
+            # the caller keeps its object, it is in sync now
+            state = inspect(obj)
+            state._commit_all(state.dict)
+            return merged
+
+        values.pop("id", None)
+        if values:
+            dbsession.query(type(obj)).filter_by(id=obj.id).update(
+                values, synchronize_session=False)
+            dbsession.commit()
+            mark_saved(obj, values)
+        return obj
+
+    def update_sessions_activity(self, sessions):
+        """ Persists in-memory modified timestamps with a single
+            executemany UPDATE. """
+        sessions = [session for session in sessions
+                    if inspect(session).attrs.modified.history.added]
+        if not sessions:
+            return
+
+        table = Session.__table__
+        values = [{"_id": session.id, "_modified": session.modified}
+                  for session in sessions]
+
+        statement = table.update().where(
+            table.c.id == bindparam("_id")
+        ).values(modified=bindparam("_modified"))
+        with self.engine.begin() as connection:
+            connection.execute(statement, values)
+
+        for session, value in zip(sessions, values):
+            mark_saved(session, {"modified": value["_modified"]})
+
+    def add_step(self, obj):
+        return self.step_writer.put(obj)
+
+    def update_step(self, obj):
+        if self.step_writer.is_pending(obj):
+            return obj
+        return self.update(obj)
 
     def refresh(self, obj):
         obj_state = inspect(obj)
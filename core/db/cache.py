@@ -0,0 +1,68 @@
+# coding: utf-8
+
+import time
+from threading import Lock
+
+from sqlalchemy import inspect
+
+from core.config import config
+
+
+def detached_copy(model, values):
+    """ New detached instance with the given loaded column values,
+        like make_transient_to_detached of later SQLAlchemy. """
+    obj = model(**values)
+    state = inspect(obj)
+    state.key = state.mapper._identity_key_from_state(state)
+    state._commit_all(state.dict)
+    return obj
+
+
+class UserCache(object):
+    """ Column values of users by username and by id for ttl seconds.
+        Every get returns a new detached User, sessions never share
+        one instance. """
+
+    def __init__(self, model, ttl=None):
+        self.model = model
+        self.ttl = config.USERS_CACHE_TTL if ttl is None else ttl
+        self.lock = Lock()
+        self.by_username = {}
+        self.by_id = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username=None, user_id=None):
+        with self.lock:
+            if user_id:
+                entry = self.by_id.get(user_id)
+            else:
+                entry = self.by_username.get(username)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return detached_copy(self.model, entry[1])
+
+    def put(self, user):
+        if not self.ttl:
+            return
+        values = dict((column.key, getattr(user, column.key))
+                      for column in inspect(self.model).column_attrs)
+        entry = (time.time() + self.ttl, values)
+        with self.lock:
+            self.by_id[user.id] = entry
+            self.by_username[user.username] = entry
+
+    def invalidate(self, user):
+        with self.lock:
+            entry = self.by_id.pop(user.id, None)
+            self.by_username.pop(user.username, None)
+            if entry is not None:
+                self.by_username.pop(entry[1]["username"], None)
+
+    @property
+    def info(self):
+        with self.lock:
+            return {"users": len(self.by_id),
+                    "hits": self.hits, "misses": self.misses}
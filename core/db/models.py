@@ -25,7 +25,16 @@ class FeaturesMixin(object):
         current_app.database.refresh(self)
 
 
-class SessionLogSubStep(Base, FeaturesMixin):
+class StepFeaturesMixin(FeaturesMixin):
+    """ Log steps are written in background batches by the step writer. """
+    def add(self):
+        current_app.database.add_step(self)
+
+    def save(self):
+        current_app.database.update_step(self)
+
+
+class SessionLogSubStep(Base, StepFeaturesMixin):
     __tablename__ = 'sub_steps'
 
     id = Column(Integer, Sequence('sub_steps_id_seq'), primary_key=True)
@@ -46,7 +55,7 @@ class SessionLogSubStep(Base, FeaturesMixin):
         self.add()
 
 
-class SessionLogStep(Base, FeaturesMixin):
+class SessionLogStep(Base, StepFeaturesMixin):
     __tablename__ = 'session_log_steps'
 
     id = Column(Integer, Sequence('session_log_steps_id_seq'),
@@ -56,7 +65,7 @@ class SessionLogStep(Base, FeaturesMixin):
     )
     control_line = Column(String)
     body = Column(String)
-    screenshot = Column(String)
+    screenshot = Column(String, index=True)
     created = Column(DateTime, default=datetime.now)
 
     # Relationships
@@ -93,6 +102,7 @@ class Session(Base, FeaturesMixin):
     endpoint_name = Column(String)
     name = Column(String)
     dc = Column(String)
+    platform = Column(String)
     selenium_session = Column(String)
     take_screenshot = Column(Boolean)
     run_script = Column(String)
@@ -122,12 +132,16 @@ class Session(Base, FeaturesMixin):
     def set_user(self, username):
         self.user = current_app.database.get_user(username=username)
 
+    _capabilities = None
+
     def __init__(self, name=None, dc=None):
         if name:
             self.name = name
 
         if dc:
             self.dc = json.dumps(dc)
+            self._capabilities = dc
+            self.platform = dc.get("platform", None)
 
             if dc.get("name", None) and not self.name:
                 self.name = dc["name"]
@@ -146,8 +160,11 @@ class Session(Base, FeaturesMixin):
             self.save()
 
     @property
-    def platform(self):
-        return json.loads(self.dc).get("platform", None)
+    def capabilities(self):
+        """ Desired capabilities, decoded once. """
+        if self._capabilities is None:
+            self._capabilities = json.loads(self.dc) if self.dc else {}
+        return self._capabilities
 
     def add_session_step(self, control_line, body=None, created=None):
         return SessionLogStep(control_line=control_line,
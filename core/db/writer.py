@@ -0,0 +1,234 @@
+# coding: utf-8
+
+import logging
+from datetime import datetime
+from threading import Thread, Lock, Event
+
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+
+class IdAllocator(object):
+    """ Hands out primary keys from a postgresql sequence.
+        Keys are fetched in blocks, so a new row gets its id
+        without a round-trip to the database. """
+
+    def __init__(self, engine, sequence_name, block_size):
+        self.engine = engine
+        self.sequence_name = sequence_name
+        self.block_size = block_size
+        self.ids = []
+        self.lock = Lock()
+
+    def _fetch_block(self):
+        result = self.engine.execute(
+            text("SELECT nextval(:name) FROM generate_series(1, :count)"),
+            name=self.sequence_name, count=self.block_size
+        )
+        return [row[0] for row in result]
+
+    def next(self):
+        with self.lock:
+            if not self.ids:
+                self.ids = self._fetch_block()
+            return self.ids.pop(0)
+
+
+class StepWriter(Thread):
+    """ Writes session log steps and sub steps in batches.
+        Objects get their ids on put, rows are inserted with one
+        multi-row INSERT per table when the batch is full or
+        when the flush interval has passed. """
+
+    ROW_ATTEMPTS = 3
+
+    def __init__(self, database, batch_size=None, flush_interval=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.running = True
+        self.database = database
+        self.batch_size = batch_size or config.STEPS_WRITER_BATCH_SIZE
+        self.flush_interval = \
+            flush_interval or config.STEPS_WRITER_FLUSH_INTERVAL
+
+        self.pending = []
+        self.pending_ids = set()
+        self.writing_ids = set()
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.wakeup = Event()
+        self.allocators = {}
+        # id of a failed object: attempts to write it
+        self.attempts = {}
+
+    def _allocator(self, table):
+        sequence_name = table.c.id.default.name
+        if sequence_name not in self.allocators:
+            self.allocators[sequence_name] = IdAllocator(
+                self.database.engine, sequence_name, self.batch_size)
+        return self.allocators[sequence_name]
+
+    def put(self, obj):
+        table = type(obj).__table__
+        obj.id = self._allocator(table).next()
+        if obj.created is None:
+            obj.created = datetime.now()
+
+        with self.lock:
+            self.pending.append(obj)
+            self.pending_ids.add(id(obj))
+            size = len(self.pending)
+            if self.running and not self.is_alive():
+                self.start()
+
+        if size >= self.batch_size:
+            self.wakeup.set()
+        return obj
+
+    def is_pending(self, obj):
+        """ Pending object will be written with its current values,
+            so there is nothing to update yet. An object being written
+            is waited for, it may have changed after its row was made. """
+        with self.lock:
+            if id(obj) in self.pending_ids:
+                return True
+            writing = id(obj) in self.writing_ids
+        if writing:
+            with self.write_lock:
+                pass
+            with self.lock:
+                return id(obj) in self.pending_ids
+        return False
+
+    @staticmethod
+    def _row(obj):
+        table = type(obj).__table__
+        return dict((c.name, getattr(obj, c.name)) for c in table.columns)
+
+    @staticmethod
+    def _table_order(table):
+        return table.metadata.sorted_tables.index(table)
+
+    @staticmethod
+    def _written(obj, row):
+        """ Written values are committed, a later save of the object
+            updates only the columns changed since. """
+        for key, value in row.items():
+            if getattr(obj, key) is value:
+                set_committed_value(obj, key, value)
+        state = inspect(obj)
+        state.key = state.mapper._identity_key_from_state(state)
+
+    def _insert(self, rows):
+        """ One multi-row INSERT per table, rows are (obj, row). """
+        tables = {}
+        for obj, row in rows:
+            tables.setdefault(type(obj).__table__, []).append(row)
+        with self.database.engine.begin() as connection:
+            for table in sorted(tables, key=self._table_order):
+                connection.execute(table.insert().values(tables[table]))
+
+    @staticmethod
+    def _is_outage(error):
+        """ The database can't be reached, rows are not to blame. """
+        return isinstance(error, OperationalError) or \
+            getattr(error, "connection_invalidated", False)
+
+    def _put_back(self, objs):
+        with self.lock:
+            self.pending = list(objs) + self.pending
+            self.pending_ids.update(id(obj) for obj in objs)
+
+    def _insert_each(self, rows):
+        """ Returns rows which can't be written, the unwritten ones
+            are put back if the database can't be reached. """
+        rows = sorted(
+            rows, key=lambda r: self._table_order(type(r[0]).__table__))
+        failed = []
+        for num, (obj, row) in enumerate(rows):
+            try:
+                self._insert([(obj, row)])
+            except Exception as e:
+                if self._is_outage(e):
+                    self._put_back(
+                        [o for o, _ in failed] + [o for o, _ in rows[num:]])
+                    raise
+                log.warning("Can't write %s %s: %s" %
+                            (type(obj).__name__, obj.id, e))
+                failed.append((obj, row))
+            else:
+                self.attempts.pop(id(obj), None)
+                self._written(obj, row)
+        return failed
+
+    def _retry(self, failed):
+        """ Failed objects are put back to be written with the next
+            batch, the ones failed ROW_ATTEMPTS times are dropped. """
+        retry = []
+        for obj, row in failed:
+            attempts = self.attempts.pop(id(obj), 0) + 1
+            if attempts < self.ROW_ATTEMPTS:
+                self.attempts[id(obj)] = attempts
+                retry.append(obj)
+            else:
+                log.error("%s %s dropped after %s attempts to write it" %
+                          (type(obj).__name__, obj.id, attempts))
+        self._put_back(retry)
+
+    def flush(self):
+        """ The batch is written outside of the lock, so put never
+            waits for the database. A batch failed while the database
+            can't be reached is put back. Otherwise it is written row by
+            row, rows which still fail are retried with the next batches
+            and dropped after ROW_ATTEMPTS failures. """
+        with self.write_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.writing_ids, self.pending_ids = self.pending_ids, set()
+            if not batch:
+                return 0
+
+            rows = [(obj, self._row(obj)) for obj in batch]
+            try:
+                try:
+                    self._insert(rows)
+                except Exception as e:
+                    if self._is_outage(e):
+                        self._put_back(batch)
+                        raise
+                    log.warning("Can't write %s steps at once: %s" %
+                                (len(rows), e))
+                    failed = self._insert_each(rows)
+                else:
+                    failed = []
+                    for obj, row in rows:
+                        self.attempts.pop(id(obj), None)
+                        self._written(obj, row)
+                if failed:
+                    self._retry(failed)
+            finally:
+                with self.lock:
+                    self.writing_ids = set()
+        return len(batch) - len(failed)
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception("Error writing session log steps: %s" % e)
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.wakeup.set()
+            self.join()
+        self.flush()
+        log.info("StepWriter stopped")
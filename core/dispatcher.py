@@ -3,5 +3,6 @@ from pydispatch import dispatcher  # NOQA
 
 class Signals(object):
     DELETE_VIRTUAL_MACHINE = "delete_virtual_machine"
+    VIRTUAL_MACHINE_READY = "virtual_machine_ready"
     SESSION_TIMEOUT = "session_timeout"
     DELETE_SESSION = "delete_session"
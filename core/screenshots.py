@@ -0,0 +1,283 @@
+# coding: utf-8
+
+import os
+import time
+import base64
+import hashlib
+import logging
+
+from functools import partial
+from StringIO import StringIO
+from multiprocessing import Pool, TimeoutError
+from threading import Lock
+
+from PIL import Image
+
+from core import utils
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 128
+STORE_DIR = "store"
+
+
+def encode_quantized_png(image, quality, output):
+    """ Palette of up to 256 colors, fewer for lower quality. """
+    colors = max(2, min(256, quality * 256 / 100))
+    image.convert("RGB").quantize(colors=colors).save(
+        output, "PNG", optimize=True)
+
+
+def encode_webp(image, quality, output):
+    image.save(output, "WEBP", quality=quality)
+
+
+# format: (encoder, file extension), png screenshots are written as is
+ENCODERS = {
+    "png": (None, ".png"),
+    "quantized_png": (encode_quantized_png, ".png"),
+    "webp": (encode_webp, ".webp"),
+}
+DEFAULT_ENCODING = ("png", 100)
+
+
+def get_encoding(settings):
+    """ Encoding tuple of settings like {"format": "webp", "quality": 80}. """
+    if not settings:
+        return DEFAULT_ENCODING
+    encoding = settings.get("format", "png"), settings.get("quality", 100)
+    if encoding[0] not in ENCODERS:
+        raise ValueError("Unknown screenshots format %s" % encoding[0])
+    return encoding
+
+
+def encode(data, encoding):
+    encoder = ENCODERS[encoding[0]][0]
+    if encoder is None:
+        return data
+    output = StringIO()
+    encoder(Image.open(StringIO(data)), encoding[1], output)
+    return output.getvalue()
+
+
+def digest(screenshot, encoding=DEFAULT_ENCODING):
+    """ Hash of base64 encoded screenshot, identical images have
+        identical encodings, so the decoding is not needed. """
+    sha1 = hashlib.sha1(screenshot)
+    if encoding != DEFAULT_ENCODING:
+        sha1.update("%s:%s" % encoding)
+    return sha1.hexdigest()
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return digest(base64.b64encode(f.read()))
+
+
+def store_path(screenshot_digest, encoding=DEFAULT_ENCODING):
+    return os.path.join(
+        config.SCREENSHOTS_DIR, STORE_DIR, screenshot_digest[:2],
+        screenshot_digest + ENCODERS[encoding[0]][1])
+
+
+def write_screenshot(path, screenshot, encoding=DEFAULT_ENCODING):
+    utils.write_file(path + ".tmp",
+                     encode(base64.b64decode(screenshot), encoding))
+    os.rename(path + ".tmp", path)
+
+
+def touch(path):
+    """ False if there is no such file. """
+    try:
+        os.utime(path, None)
+        return True
+    except OSError:
+        return False
+
+
+def thumbnail_path(screenshot_path):
+    root, extension = os.path.splitext(screenshot_path)
+    return "%s_thumb%s" % (root, extension)
+
+
+def screenshot_resize(screenshot_path, width, height=None, postfix=None):
+    try:
+        img = Image.open(screenshot_path)
+        image_format = img.format
+
+        if height:
+            size = width, height
+        else:
+            wpercent = (width / float(img.size[0]))
+            size = width, int((float(img.size[1]) * float(wpercent)))
+
+        root, extension = os.path.splitext(screenshot_path)
+        if postfix:
+            postfix = "%s%s" % (postfix, extension)
+        else:
+            postfix = "%sx%s%s" % (size + (extension,))
+
+        new_file_path = root + postfix
+        if img.mode == "P":
+            img = img.convert("RGB")
+        img = img.resize(size, Image.ANTIALIAS)
+        # moved into place, concurrent requests never read a half of it
+        img.save(new_file_path + ".tmp", image_format)
+        os.rename(new_file_path + ".tmp", new_file_path)
+        return new_file_path
+    except IOError:
+        log.debug("Can\'t resize image '%s'" % screenshot_path)
+
+
+def make_thumbnail(screenshot_path):
+    return screenshot_resize(screenshot_path, THUMBNAIL_WIDTH,
+                             postfix="_thumb")
+
+
+def _run(func, *args):
+    """ Pool of python 2 has no error callback, errors are returned. """
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+class ScreenshotPipeline(object):
+    """ Decodes and writes screenshots in a bounded pool of processes,
+        away from the GIL of request handling. Screenshots are stored
+        by content hash, an image already stored is not written again.
+        Thumbnails are made on their first request. Under backpressure
+        thumbnails are refused first, screenshots are dropped when the
+        queue is full. Tasks not done in time are given up, so a dead
+        or hung process does not hold the queue. """
+
+    def __init__(self, processes=None, queue_size=None,
+                 thumbnails_queue_size=None, task_timeout=None):
+        self.processes = processes or config.SCREENSHOTS_PROCESSES
+        self.queue_size = queue_size or config.SCREENSHOTS_QUEUE_SIZE
+        self.thumbnails_queue_size = thumbnails_queue_size or \
+            config.SCREENSHOTS_THUMBNAILS_QUEUE_SIZE
+        self.task_timeout = task_timeout or config.SCREENSHOTS_TASK_TIMEOUT
+        self.pool = None
+        self.lock = Lock()
+        self.depth = 0
+        self.writing = set()
+        # task number: (submit time, path being written)
+        self.tasks = {}
+        self.task_count = 0
+        self.counters = dict.fromkeys(
+            ("written", "deduplicated", "deduplicated_bytes", "dropped",
+             "thumbnails", "thumbnails_dropped", "errors", "lost"), 0)
+
+    def start(self):
+        """ Processes are forked before threads of the server are started,
+            a fork of a threaded process may inherit held locks. """
+        with self.lock:
+            if self.pool is None:
+                self.pool = Pool(self.processes)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _give_up_lost(self):
+        since = time.time() - self.task_timeout
+        for task, (submitted, writing) in self.tasks.items():
+            if submitted < since:
+                del self.tasks[task]
+                self.depth -= 1
+                self.writing.discard(writing)
+                self.counters["lost"] += 1
+                log.warning("Screenshot task %s given up after %ss" %
+                            (writing or task, self.task_timeout))
+
+    def _submit(self, limit, counter, func, args, writing=None):
+        with self.lock:
+            self._give_up_lost()
+            if self.pool is None or self.depth >= limit:
+                return None
+            self.depth += 1
+            self.task_count += 1
+            self.tasks[self.task_count] = time.time(), writing
+            return self.pool.apply_async(
+                _run, (func,) + args,
+                callback=partial(self._done, self.task_count, counter))
+
+    def _done(self, task, counter, result):
+        value, error = result
+        with self.lock:
+            if task not in self.tasks:
+                # given up already
+                return
+            writing = self.tasks.pop(task)[1]
+            self.depth -= 1
+            self.writing.discard(writing)
+            self.counters["errors" if error else counter] += 1
+        if error:
+            log.warning("Screenshot processing failed: %s" % error)
+
+    def wait(self, timeout=None):
+        """ True if every queued task is done in time. """
+        return utils.wait_for(lambda: not self.info["queue_depth"],
+                              timeout or self.task_timeout)
+
+    def save(self, screenshot, encoding=DEFAULT_ENCODING):
+        """ Returns path of the stored screenshot,
+            None if the screenshot is dropped. """
+        path = store_path(digest(screenshot, encoding), encoding)
+        with self.lock:
+            # a reused file is touched, cleanup keeps files used lately
+            if path in self.writing or touch(path):
+                self.counters["deduplicated"] += 1
+                self.counters["deduplicated_bytes"] += len(screenshot) * 3 / 4
+                return path
+            self.writing.add(path)
+
+        if self._submit(self.queue_size, "written", write_screenshot,
+                        (path, screenshot, encoding), writing=path) is None:
+            with self.lock:
+                self.writing.discard(path)
+            self._count("dropped")
+            log.warning("Screenshot %s dropped, %s screenshots in queue" %
+                        (path, self.depth))
+            return None
+        return path
+
+    def thumbnail(self, screenshot_path, timeout=None):
+        """ Returns path of the thumbnail, None if it can't be made
+            or the pipeline is too busy for it. """
+        path = thumbnail_path(screenshot_path)
+        if os.path.exists(path):
+            return path
+
+        result = self._submit(self.thumbnails_queue_size, "thumbnails",
+                              make_thumbnail, (screenshot_path,))
+        if result is None:
+            self._count("thumbnails_dropped")
+            return None
+
+        try:
+            value, error = result.get(
+                timeout or config.SCREENSHOTS_THUMBNAIL_TIMEOUT)
+        except TimeoutError:
+            return None
+        return value
+
+    @property
+    def info(self):
+        with self.lock:
+            self._give_up_lost()
+            info = dict(self.counters)
+            info["queue_depth"] = self.depth
+        saved = info["written"] + info["deduplicated"]
+        info["dedup_ratio"] = \
+            round(saved / float(info["written"]), 2) if info["written"] else 0
+        return info
+
+    def stop(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -1,27 +1,92 @@
 # coding: utf-8
 
 import time
+import heapq
 import requests
 import logging
 
-from Queue import Queue
-from threading import Thread
+from cookielib import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from threading import Thread, Event, Lock, RLock, Condition
+from collections import defaultdict
 from datetime import datetime
 from flask import current_app
+from twisted.internet import threads
+from twisted.internet.defer import CancelledError, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from core.db import models
 from core.config import config
-from core.exceptions import SessionException
+from core.exceptions import SessionException, TimeoutException
 from core.video import VNCVideoHelper
+from core.step_bodies import StepBodyLog
 
 log = logging.getLogger(__name__)
 
+_upstream_pool = None
+_upstream_pool_lock = Lock()
 
-def getresponse(req, q):
-    try:
-        q.put(req())
-    except Exception as e:
-        q.put(e)
+
+def upstream_pool():
+    """ Bounded thread pool running requests to the endpoints.
+        Started on first use and stopped with the reactor. """
+    global _upstream_pool
+    from twisted.internet import reactor
+
+    with _upstream_pool_lock:
+        if _upstream_pool is None:
+            _upstream_pool = ThreadPool(
+                maxthreads=config.UPSTREAM_THREAD_POOL_MAX, name="upstream")
+            _upstream_pool.start()
+            reactor.addSystemEventTrigger(
+                'during', 'shutdown', stop_upstream_pool)
+    return _upstream_pool
+
+
+def stop_upstream_pool():
+    global _upstream_pool
+
+    with _upstream_pool_lock:
+        if _upstream_pool is not None:
+            _upstream_pool.stop()
+            _upstream_pool = None
+
+
+class UpstreamRequest(object):
+    """ Pending request to the endpoint. The deferred is made and its
+        callbacks are attached in the reactor thread, the result is
+        delivered by them and waiting callers are woken up by an event. """
+
+    def __init__(self, make_deferred):
+        from twisted.internet import reactor
+        self.result = None
+        self.deferred = None
+        self._done = Event()
+        reactor.callFromThread(self._start, make_deferred)
+
+    def _start(self, make_deferred):
+        self.deferred = maybeDeferred(make_deferred)
+        self.deferred.addBoth(self._set_result)
+
+    def _set_result(self, result):
+        self.result = result
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _cancel(self):
+        if self.deferred is not None:
+            self.deferred.cancel()
+
+    def cancel(self):
+        from twisted.internet import reactor
+        reactor.callFromThread(self._cancel)
 
 
 class RequestHelper(object):
@@ -47,7 +112,75 @@ class RequestHelper(object):
             self.method, self.url, self.headers, self.data)
 
 
-def update_log_step(log_step, message=None, control_line=None):
+class EndpointConnectionPool(object):
+    """ Persistent keep-alive connections to the ports of a session endpoint.
+        One pool is created per port, so commands reuse opened sockets
+        instead of connecting to the vm on every request. """
+
+    hop_by_hop_headers = ("connection", "keep-alive")
+
+    def __init__(self, host, ports, pool_size=None, keep_alive=None):
+        if pool_size is None:
+            pool_size = config.ENDPOINT_POOL_SIZE
+        if keep_alive is None:
+            keep_alive = config.ENDPOINT_KEEP_ALIVE
+
+        self.host = host
+        self.ports = list(ports)
+        self.keep_alive = keep_alive
+        self.requests_count = dict((port, 0) for port in ports)
+
+        self.adapter = HTTPAdapter(pool_connections=len(ports),
+                                   pool_maxsize=pool_size)
+        self.http = requests.Session()
+        self.http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.http.mount("http://", self.adapter)
+
+    def url(self, port, path="/"):
+        return "http://%s:%s%s" % (self.host, port, path)
+
+    def request(self, port, method, url, headers=None, data=None,
+                stream=False):
+        _headers = {}
+        if headers:
+            for key, value in headers.items():
+                if key.lower() not in self.hop_by_hop_headers:
+                    _headers[key] = value
+        if not self.keep_alive:
+            _headers["Connection"] = "close"
+
+        if port not in self.ports:
+            self.ports.append(port)
+        self.requests_count[port] = self.requests_count.get(port, 0) + 1
+        return self.http.request(method=method,
+                                 url=self.url(port, url),
+                                 headers=_headers,
+                                 data=data,
+                                 stream=stream)
+
+    @property
+    def info(self):
+        stat = {}
+        for port in self.ports:
+            connection_pool = self.adapter.get_connection(self.url(port))
+            requests_count = self.requests_count.get(port, 0)
+            connections = connection_pool.num_connections
+            stat[str(port)] = {
+                "requests": requests_count,
+                "connections": connections,
+                "reused": max(requests_count - connections, 0)
+            }
+        return stat
+
+    def close(self):
+        self.http.close()
+
+
+def update_log_step(log_step, message=None, control_line=None,
+                    body_log=None):
+    """ Message is rendered by body_log of the session if it is given. """
+    if message and body_log is not None:
+        message = body_log.render(message)[0]
     if message:
         log_step.body = message
     if control_line:
@@ -55,6 +188,54 @@ def update_log_step(log_step, message=None, control_line=None):
     log_step.save()
 
 
+class StreamedBody(object):
+    """ Upstream response body sent to the client chunk by chunk through
+        a JsonStreamScanner. Callbacks get the body once it is sent. """
+
+    skipped_headers = ("content-length", "content-encoding",
+                       "transfer-encoding", "connection", "keep-alive")
+
+    def __init__(self, response, scanner, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = config.UPSTREAM_STREAM_CHUNK_SIZE
+        self.response = response
+        self.scanner = scanner
+        self.chunk_size = chunk_size
+        self.callbacks = []
+        self.size = 0
+
+    @staticmethod
+    def should_stream(response):
+        length = response.headers.get("Content-Length")
+        return length is None or \
+            int(length) >= config.UPSTREAM_STREAM_MIN_SIZE
+
+    @property
+    def headers(self):
+        return dict((key, value)
+                    for key, value in self.response.headers.items()
+                    if key.lower() not in self.skipped_headers)
+
+    def on_complete(self, callback):
+        self.callbacks.append(callback)
+
+    def __iter__(self):
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                self.size += len(chunk)
+                chunk = self.scanner.feed(chunk)
+                if chunk:
+                    yield chunk
+        finally:
+            self.response.close()
+
+        for callback in self.callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                log.exception("Error in streamed body callback: %s" % e)
+
+
 class SimpleResponse:
     def __init__(self, status_code=None, headers=None, content=None):
         self.status_code = status_code
@@ -65,11 +246,16 @@ class SimpleResponse:
 class Session(models.Session):
     current_log_step = None
     vnc_helper = None
+    connection_pool = None
+    proxy_traffic = None
+    upstream_requests = None
     take_screencast = None
     is_active = True
+    _body_log = None
 
     def __init__(self, name=None, dc=None):
         super(Session, self).__init__(name, dc)
+        self.upstream_requests = set()
         if dc and dc.get('takeScreencast', None):
             self.take_screencast = True
 
@@ -99,18 +285,26 @@ class Session(models.Session):
                 "ip": self.endpoint_ip,
                 "name": self.endpoint_name
             }
+        if self.connection_pool:
+            stat["connections"] = self.connection_pool.info
+        if self.proxy_traffic:
+            stat["proxy"] = self.proxy_traffic.info
         return stat
 
     def set_user(self, username):
         self.user = current_app.database.get_user(username=username)
+        current_app.sessions.reindex(self)
 
     def start_timer(self):
+        """ Activity timestamp lives in memory, it is persisted
+            in bulk by SessionWorker and on session close. """
         self.modified = datetime.now()
-        self.save()
         self.is_active = False
+        current_app.sessions.worker.arm(self)
 
     def stop_timer(self):
         self.is_active = True
+        current_app.sessions.worker.disarm(self)
 
     def close(self, reason=None):
         self.closed = True
@@ -121,7 +315,13 @@ class Session(models.Session):
 
         if self.vnc_helper:
             self.vnc_helper.stop_recording()
-            self.vnc_helper.stop_proxy()
+
+        if self.upstream_requests:
+            for upstream in list(self.upstream_requests):
+                upstream.cancel()
+
+        if self.connection_pool:
+            self.connection_pool.close()
 
         current_app.sessions.remove(self)
 
@@ -156,6 +356,11 @@ class Session(models.Session):
         self.modified = datetime.now()
         self.set_vm(endpoint)
         self.status = "running"
+        current_app.sessions.reindex(self)
+        self.connection_pool = EndpointConnectionPool(
+            self.endpoint_ip,
+            [config.SELENIUM_PORT, config.VMMASTER_AGENT_PORT]
+        )
         self.vnc_helper = VNCVideoHelper(self.endpoint_ip,
                                          filename_prefix=self.id)
 
@@ -170,103 +375,275 @@ class Session(models.Session):
         self.failed(reason="Session timeout. No activity since %s" %
                     str(self.modified))
 
+    @property
+    def body_log(self):
+        if self._body_log is None:
+            self._body_log = StepBodyLog(
+                self.id, self.capabilities.get("bodyLogging"))
+        return self._body_log
+
     def add_sub_step(self, control_line, body=None):
         if self.current_log_step:
-            return self.current_log_step.add_sub_step(control_line, body)
+            return self.body_log.add(
+                lambda rendered: self.current_log_step.add_sub_step(
+                    control_line, rendered),
+                body, kind="sub step")
 
     def add_session_step(self, control_line, body=None, created=None):
-        step = super(Session, self).add_session_step(
-            control_line=control_line, body=body, created=created
-        )
+        step = self.body_log.add(
+            lambda rendered: super(Session, self).add_session_step(
+                control_line=control_line, body=rendered, created=created),
+            body)
         self.current_log_step = step
 
         return step
 
-    def make_request(self, port, request):
-        """ Make http request to some port in session
-            and return the response. """
+    def make_request_async(self, port, request, stream=False):
+        """ Make http request to some port in session.
+            Returns deferred fired with the response in reactor thread. """
+        from twisted.internet import reactor
 
         if request.headers.get("Host"):
             del request.headers['Host']
 
-        q = Queue()
-        url = "http://%s:%s%s" % (self.endpoint_ip, port, request.url)
+        if self.connection_pool is None:
+            self.connection_pool = EndpointConnectionPool(
+                self.endpoint_ip, [port])
 
-        def req():
-            return requests.request(method=request.method,
-                                    url=url,
-                                    headers=request.headers,
-                                    data=request.data)
+        return threads.deferToThreadPool(
+            reactor, upstream_pool(), self.connection_pool.request, port,
+            method=request.method, url=request.url,
+            headers=request.headers, data=request.data, stream=stream
+        )
 
-        t = Thread(target=getresponse, args=(req, q))
-        t.daemon = True
-        t.start()
+    def make_request(self, port, request, scanner=None):
+        """ Make http request to some port in session
+            and return the response. Waits for the result of
+            make_request_async until the session would time out,
+            the inactivity timer is stopped while a command runs.
+            With a scanner a big body is returned as StreamedBody
+            instead of being read. """
+        upstream = UpstreamRequest(lambda: self.make_request_async(
+            port, request, stream=scanner is not None))
+        if self.upstream_requests is None:
+            self.upstream_requests = set()
+        self.upstream_requests.add(upstream)
 
-        while t.isAlive():
-            yield None, None, None
+        try:
+            if not upstream.wait(config.SESSION_TIMEOUT):
+                self.timeout()
+                raise TimeoutException(
+                    "Session %s timeout (%s)" % (self.id, self.reason))
+        finally:
+            self.upstream_requests.discard(upstream)
+
+        response = upstream.result
+        if isinstance(response, Failure):
+            if response.check(CancelledError) and self.timeouted:
+                raise TimeoutException(
+                    "Session %s timeout (%s)" % (self.id, self.reason))
+            elif response.check(CancelledError):
+                raise SessionException(
+                    "Session %s closed (%s)" % (self.id, self.reason))
+            response.raiseException()
+
+        if scanner is not None and StreamedBody.should_stream(response):
+            body = StreamedBody(response, scanner)
+            yield response.status_code, body.headers, body
+        else:
+            yield response.status_code, response.headers, response.content
 
-        response = q.get()
-        if isinstance(response, Exception):
-            raise response
 
-        yield response.status_code, response.headers, response.content
+class SessionWorker(Thread):
+    """ Times out inactive sessions. Deadlines armed by start_timer are
+        kept in a heap, the worker sleeps until the nearest one is due.
+        Entries of disarmed or rearmed timers are dropped lazily,
+        the heap is rebuilt when they outnumber the armed ones. """
 
+    # smaller heaps are not worth rebuilding
+    COMPACT_MIN_SIZE = 64
 
-class SessionWorker(Thread):
     def __init__(self, sessions):
         Thread.__init__(self)
         self.running = True
         self.daemon = True
         self.sessions = sessions
+        self.condition = Condition()
+        self.heap = []
+        self.entries = {}
+
+    def _compact(self):
+        if len(self.heap) > max(self.COMPACT_MIN_SIZE, 2 * len(self.entries)):
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def arm(self, session, timeout=None):
+        if timeout is None:
+            timeout = config.SESSION_TIMEOUT
+        entry = (time.time() + timeout, session.id, session)
+        with self.condition:
+            self.entries[session.id] = entry
+            heapq.heappush(self.heap, entry)
+            self._compact()
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    def disarm(self, session):
+        with self.condition:
+            self.entries.pop(session.id, None)
+            self._compact()
+
+    def _is_armed(self, entry):
+        return self.entries.get(entry[1]) is entry
+
+    def _expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self._is_armed(entry):
+                del self.entries[entry[1]]
+                expired.append(entry[2])
+        return expired
+
+    def _next_deadline(self):
+        while self.heap and not self._is_armed(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
 
     def run(self):
         with self.sessions.app.app_context():
+            next_persist = time.time() + \
+                config.SESSION_ACTIVITY_PERSIST_INTERVAL
             while self.running:
-                for session in self.sessions.running():
-                    if not session.is_active \
-                            and session.inactivity > config.SESSION_TIMEOUT:
+                with self.condition:
+                    wake_up = next_persist
+                    deadline = self._next_deadline()
+                    if deadline is not None:
+                        wake_up = min(wake_up, deadline)
+                    timeout = wake_up - time.time()
+                    if timeout > 0:
+                        self.condition.wait(timeout)
+                    expired = self._expired(time.time())
+
+                for session in expired:
+                    if not session.is_active and not session.closed:
                         session.timeout()
-                time.sleep(1)
+
+                if time.time() >= next_persist:
+                    self.persist_activity()
+                    next_persist = time.time() + \
+                        config.SESSION_ACTIVITY_PERSIST_INTERVAL
+
+    def persist_activity(self):
+        try:
+            self.sessions.app.database.update_sessions_activity(
+                self.sessions.running())
+        except Exception as e:
+            log.exception("Error persisting sessions activity: %s" % e)
 
     def stop(self):
-        self.running = False
+        with self.condition:
+            self.running = False
+            self.condition.notify()
         self.join()
         log.info("SessionWorker stopped")
 
 
 class Sessions(object):
-    active_sessions = {}
+    """ Registry of active sessions with secondary indexes by status,
+        platform, user and endpoint. Sessions call reindex after
+        changing an indexed attribute. Readers get snapshot lists. """
+
+    indexes = {
+        "status": lambda session: session.status,
+        "platform": lambda session: session.platform,
+        "user": lambda session: session.user_id,
+        "endpoint": lambda session: session.endpoint_name,
+    }
 
     def __init__(self, app):
         self.app = app
+        self.lock = RLock()
+        self.active_sessions = {}
+        self.index = dict((name, defaultdict(dict)) for name in self.indexes)
+        self.keys = {}
         self.worker = SessionWorker(self)
         self.worker.start()
 
+    def _index(self, session_id, session):
+        keys = dict((name, key(session))
+                    for name, key in self.indexes.items())
+        for name, key in keys.items():
+            self.index[name][key][session_id] = session
+        self.keys[session_id] = keys
+
+    def _unindex(self, session_id):
+        for name, key in self.keys.pop(session_id, {}).items():
+            sessions = self.index[name][key]
+            sessions.pop(session_id, None)
+            if not sessions:
+                del self.index[name][key]
+
     def put(self, session):
-        if str(session.id) not in self.active_sessions.keys():
-            self.active_sessions[str(session.id)] = session
-        else:
-            raise SessionException("Duplicate session id: %s" % session.id)
+        """ Raises SessionException if a session with the same id
+            is active already, the active one is kept as it is. """
+        session_id = str(session.id)
+        with self.lock:
+            if session_id in self.active_sessions:
+                raise SessionException(
+                    "Duplicate session id: %s" % session.id)
+            self.active_sessions[session_id] = session
+            self._index(session_id, session)
+
+    def reindex(self, session):
+        session_id = str(session.id)
+        with self.lock:
+            if session_id in self.active_sessions:
+                self._unindex(session_id)
+                self._index(session_id, session)
 
     def remove(self, session):
-        try:
-            del self.active_sessions[str(session.id)]
-        except KeyError:
-            pass
+        self.worker.disarm(session)
+        session_id = str(session.id)
+        with self.lock:
+            if self.active_sessions.pop(session_id, None) is not None:
+                self._unindex(session_id)
 
     def active(self):
-        return self.active_sessions.values()
+        with self.lock:
+            return list(self.active_sessions.values())
+
+    def find(self, index, key):
+        with self.lock:
+            return list(self.index[index].get(key, {}).values())
 
     def running(self):
-        return [s for s in self.active() if s.status == "running"]
+        return self.find("status", "running")
 
     def waiting(self):
-        return [s for s in self.active() if s.status == "waiting"]
+        return self.find("status", "waiting")
+
+    def count(self, index=None, key=None):
+        with self.lock:
+            if index is None:
+                return len(self.active_sessions)
+            return len(self.index[index].get(key, ()))
+
+    def counts(self):
+        with self.lock:
+            return dict((name, dict((str(key), len(sessions))
+                                    for key, sessions in index.items()))
+                        for name, index in self.index.items())
 
     def kill_all(self):
-        for session in self.active_sessions.values():
+        for session in self.active():
             session.close()
 
+    def get_active(self, session_id):
+        """ Active session or None, without the lock: a dict lookup
+            is atomic, so the reactor thread never waits for writers. """
+        return self.active_sessions.get(str(session_id))
+
     def get_session(self, session_id):
         try:
             session = self.active_sessions[str(session_id)]
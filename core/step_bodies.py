@@ -0,0 +1,95 @@
+# coding: utf-8
+
+import os
+import gzip
+import hashlib
+import logging
+from collections import OrderedDict
+
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+# verbosity levels
+NONE = "none"
+SHORT = "short"
+FULL = "full"
+LEVELS = (NONE, SHORT, FULL)
+
+
+def bodies_dir(session_id):
+    """ Next to the session screenshots, deleted with them. """
+    return os.path.join(config.SCREENSHOTS_DIR, str(session_id), "bodies")
+
+
+class StepBodyLog(object):
+    """ Decides what of a step body goes to the database.
+
+        none: bodies are not logged,
+        short: bodies are cut to STEPS_BODY_SHORT_SIZE,
+        full: a body repeated in the session refers to the step
+        it was logged with first, bodies bigger than
+        STEPS_BODY_MAX_SIZE are written to gzip files
+        and the row refers to the file. """
+
+    def __init__(self, session_id, level=None):
+        self.session_id = session_id
+        self.level = level if level in LEVELS else config.STEPS_BODY_LOGGING
+        self.seen = OrderedDict()
+
+    def _spill(self, body, digest):
+        path = os.path.join(bodies_dir(self.session_id), "%s.gz" % digest)
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = gzip.open(path + ".tmp", "wb", compresslevel=1)
+            try:
+                f.write(body)
+            finally:
+                f.close()
+            os.rename(path + ".tmp", path)
+        return "[body of %s bytes in %s]" % (len(body), path)
+
+    def render(self, body):
+        """ Returns text to store and digest of the body
+            if it may be referred to later. """
+        if not body or self.level == FULL and \
+                len(body) < config.STEPS_BODY_HASH_MIN_SIZE:
+            return body, None
+        if self.level == NONE:
+            return None, None
+        if self.level == SHORT:
+            if len(body) <= config.STEPS_BODY_SHORT_SIZE:
+                return body, None
+            return "%s... [%s bytes]" % (
+                body[:config.STEPS_BODY_SHORT_SIZE], len(body)), None
+
+        digest = hashlib.sha1(body).hexdigest()
+        first = self.seen.get(digest)
+        if first is not None:
+            return "[body of %s bytes, same as in %s]" % (
+                len(body), first), None
+        if len(body) > config.STEPS_BODY_MAX_SIZE:
+            try:
+                return self._spill(body, digest), digest
+            except (IOError, OSError) as e:
+                log.warning("Can't write step body of session %s: %s" %
+                            (self.session_id, e))
+                return "%s... [%s bytes]" % (
+                    body[:config.STEPS_BODY_MAX_SIZE], len(body)), None
+        return body, digest
+
+    def remember(self, digest, step_name):
+        if digest is None:
+            return
+        self.seen[digest] = step_name
+        while len(self.seen) > config.STEPS_BODY_HASHES:
+            self.seen.popitem(last=False)
+
+    def add(self, add_step, body, kind="step"):
+        """ Adds a step with add_step(body), the body rendered. """
+        rendered, digest = self.render(body)
+        step = add_step(rendered)
+        if step is not None:
+            self.remember(digest, "%s %s" % (kind, step.id))
+        return step
@@ -42,13 +42,21 @@ def convert_img_to_qcow2_origin(img_file, qcow2_origin_name):
     system_utils.run_command(command)
 
 
+def create_qcow2_overlay(origin_path, overlay_path):
+    from core.exceptions import CreationException
+
+    command = commands.clone_qcow2_drive(origin_path, overlay_path)
+    code, output = system_utils.run_command(command, silent=True)
+    if code:
+        raise CreationException(
+            "Can't create %s: %s" % (overlay_path, output.strip()))
+    return overlay_path
+
+
 def clone_qcow2_drive(origin_name, clone_name):
     clone_path = os.path.join(config.CLONES_DIR, "%s.qcow2" % clone_name)
     origin_path = os.path.join(config.ORIGINS_DIR, origin_name, "drive.qcow2")
-
-    command = commands.clone_qcow2_drive(origin_path, clone_path)
-    system_utils.run_command(command)
-    return clone_path
+    return create_qcow2_overlay(origin_path, clone_path)
 
 
 def write_clone_dumpxml(clone_name, xml):
@@ -193,6 +201,15 @@ def to_json(result):
         return {}
 
 
+def request_json(request):
+    """ Decoded body of the request, decoded once per request body. """
+    parsed = getattr(request, "parsed_json", None)
+    if not isinstance(parsed, tuple) or parsed[0] is not request.data:
+        parsed = request.data, json.loads(request.data)
+        request.parsed_json = parsed
+    return parsed[1]
+
+
 def remove_base64_screenshot(response_data):
     content_json = to_json(response_data)
 
@@ -0,0 +1,228 @@
+# coding: utf-8
+
+import re
+import json
+
+STRUCT, STRING, LITERAL = range(3)
+
+STRING_SPECIAL = re.compile(r'["\\]')
+LITERAL_END = re.compile(r'[\s,\]}]')
+
+# decoding is cheaper than scanning for documents smaller than this
+SMALL_DOCUMENT = 4 * 1024
+
+
+class JsonStreamScanner(object):
+    """ Incremental scanner over a JSON document fed in chunks.
+
+        Values at paths from replace are substituted with the given
+        raw JSON text, string values at paths from capture are collected
+        and cut out of the copy kept for logging. A path is a tuple of
+        object keys and array indexes, ("value", "screen") for example.
+        String contents are skipped with a regex search, so long base64
+        values cost one search per chunk. Without capture and log copy
+        the rest of the document is passed through untouched once all
+        the replacements are made. """
+
+    def __init__(self, replace=None, capture=(), keep_log=True):
+        self.replace = replace or {}
+        self.capture = set(capture)
+        self.captured = {}
+        self.replaced = set()
+        self.keep_log = keep_log
+        self.log = []
+
+        self.stack = []
+        self.mode = STRUCT
+        self.is_key = False
+        self.key = []
+        self.escape = False
+        self.capturing = None
+        self.drop_depth = None
+
+    def _path(self):
+        return tuple(container[1] for container in self.stack)
+
+    def _emit(self, out, text):
+        if self.drop_depth is not None or not text:
+            return
+        out.append(text)
+        if self.is_key:
+            self.key.append(text)
+        if self.capturing is not None:
+            self.captured[self.capturing].append(text)
+        elif self.keep_log:
+            self.log.append(text)
+
+    def _start_value(self, out, is_string=False):
+        if self.drop_depth is not None:
+            return
+        path = self._path()
+        if path in self.replace:
+            self._emit(out, self.replace[path])
+            self.replaced.add(path)
+            self.drop_depth = len(self.stack)
+        elif is_string and path in self.capture:
+            self._emit(out, '"')
+            self.captured[path] = []
+            self.capturing = path
+            return True
+
+    def _value_done(self):
+        if self.drop_depth == len(self.stack):
+            self.drop_depth = None
+        if self.stack and self.stack[-1][0] == "array":
+            self.stack[-1][1] += 1
+
+    def _expects_key(self):
+        return self.stack and self.stack[-1][0] == "object" \
+            and self.stack[-1][2]
+
+    @property
+    def done(self):
+        return not self.capture and not self.keep_log \
+            and self.drop_depth is None \
+            and len(self.replaced) == len(self.replace)
+
+    def feed(self, data):
+        """ Returns the rewritten part of the document. """
+        out = []
+        i, n = 0, len(data)
+        while i < n:
+            if self.done:
+                out.append(data[i:])
+                break
+
+            if self.mode == STRING:
+                if self.escape:
+                    self.escape = False
+                    self._emit(out, data[i])
+                    i += 1
+                    continue
+                match = STRING_SPECIAL.search(data, i)
+                if match is None:
+                    self._emit(out, data[i:])
+                    break
+                j = match.start()
+                self._emit(out, data[i:j])
+                if data[j] == '\\':
+                    self._emit(out, '\\')
+                    self.escape = True
+                else:
+                    self._close_string(out)
+                i = j + 1
+
+            elif self.mode == LITERAL:
+                match = LITERAL_END.search(data, i)
+                j = match.start() if match else n
+                self._emit(out, data[i:j])
+                i = j
+                if match:
+                    self.mode = STRUCT
+                    self._value_done()
+
+            else:
+                c = data[i]
+                i += 1
+                if c == '"':
+                    self.mode = STRING
+                    if self._expects_key():
+                        self._emit(out, c)
+                        self.is_key = True
+                        self.key = []
+                    elif not self._start_value(out, is_string=True):
+                        self._emit(out, c)
+                elif c == '{' or c == '[':
+                    self._start_value(out)
+                    self._emit(out, c)
+                    if c == '{':
+                        self.stack.append(["object", None, True])
+                    else:
+                        self.stack.append(["array", 0])
+                elif c == '}' or c == ']':
+                    self._emit(out, c)
+                    if self.stack:
+                        self.stack.pop()
+                    self._value_done()
+                elif c == ':':
+                    self._emit(out, c)
+                    if self.stack:
+                        self.stack[-1][2] = False
+                elif c == ',':
+                    self._emit(out, c)
+                    if self.stack and self.stack[-1][0] == "object":
+                        self.stack[-1][2] = True
+                elif c.isspace():
+                    self._emit(out, c)
+                else:
+                    self._start_value(out)
+                    self.mode = LITERAL
+                    i -= 1
+
+        return "".join(out)
+
+    def _close_string(self, out):
+        self.mode = STRUCT
+        if self.is_key:
+            self.is_key = False
+            self._emit(out, '"')
+            self.stack[-1][1] = "".join(self.key)
+            return
+
+        self.capturing = None
+        self._emit(out, '"')
+        self._value_done()
+
+    def captured_value(self, path):
+        value = self.captured.get(path)
+        if value is None:
+            return None
+        return "".join(value)
+
+    @property
+    def log_copy(self):
+        return "".join(self.log)
+
+
+def rewrite_session_id(session_id):
+    return JsonStreamScanner(
+        replace={("sessionId",): json.dumps(session_id)}, keep_log=False)
+
+
+def replace_session_id(body, session_id):
+    """ Replaces top level sessionId of a JSON object, as a streamed body
+        gets it from rewrite_session_id. Other bodies are kept. """
+    if len(body) < SMALL_DOCUMENT:
+        try:
+            document = json.loads(body)
+        except ValueError:
+            return body
+        if not isinstance(document, dict) or "sessionId" not in document:
+            return body
+        document["sessionId"] = session_id
+        return json.dumps(document)
+    return rewrite_session_id(session_id).feed(body)
+
+
+def set_session_id(body, session_id):
+    """ Sets top level sessionId of a JSON object without decoding it,
+        the key is added if the object has none. """
+    if len(body) < SMALL_DOCUMENT:
+        document = json.loads(body)
+        if not isinstance(document, dict):
+            raise ValueError("JSON object expected: %s" % body[:100])
+        document["sessionId"] = session_id
+        return json.dumps(document)
+
+    scanner = rewrite_session_id(session_id)
+    result = scanner.feed(body)
+    if scanner.replaced:
+        return result
+
+    start = result.find("{")
+    if start < 0 or result[:start].strip():
+        raise ValueError("JSON object expected: %s" % body[:100])
+    rest = result[start + 1:]
+    separator = "" if rest.lstrip().startswith("}") else ", "
+    return '%s{"sessionId": %s%s%s' % (
+        result[:start], json.dumps(session_id), separator, rest)
@@ -3,7 +3,12 @@ from novaclient.v2.client import client as novaclient
 from neutronclient.v2_0 import client as networkclient
 import glanceclient.v2.client as glclient
 from core.config import config
+import time
 import logging
+from collections import defaultdict
+from threading import Lock, Condition, Thread
+
+log = logging.getLogger(__name__)
 
 
 def keystone_client():
@@ -59,3 +64,235 @@ def neutron_client():
         endpoint_url=network_endpoint,
         token=keystone.auth_token
     )
+
+
+class ApiCounters(object):
+    """ Number of OpenStack API calls made, per backend and method. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = defaultdict(lambda: defaultdict(int))
+
+    def count(self, backend, method):
+        with self.lock:
+            self.calls[backend][method] += 1
+
+    @property
+    def info(self):
+        with self.lock:
+            return dict((backend, dict(methods))
+                        for backend, methods in self.calls.items())
+
+
+class CountedClient(object):
+    """ Client proxy counting calls of methods found depth attributes
+        deep: 2 for manager based clients (servers.list), 1 for flat
+        ones (list_networks). """
+
+    def __init__(self, client, backend, counters, depth, path=()):
+        self._client = client
+        self._backend = backend
+        self._counters = counters
+        self._depth = depth
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        path = self._path + (name,)
+        if len(path) < self._depth:
+            return CountedClient(
+                attr, self._backend, self._counters, self._depth, path)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counters.count(self._backend, ".".join(path))
+            return attr(*args, **kwargs)
+        return counted
+
+
+class ClientPool(object):
+    """ Authenticated clients shared by all clones. Clients are handed
+        out round robin and recreated when they are older than ttl. """
+
+    def __init__(self, factory, size, ttl):
+        self.factory = factory
+        self.size = max(size, 1)
+        self.ttl = ttl
+        self.clients = [None] * self.size
+        self.next = 0
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            i, self.next = self.next, (self.next + 1) % self.size
+            now = time.time()
+            if self.clients[i] is None or now - self.clients[i][1] > self.ttl:
+                self.clients[i] = (self.factory(), now)
+            return self.clients[i][0]
+
+
+class OpenstackCache(object):
+    """ Clients and metadata needed to create a clone. Metadata is
+        resolved on first use and kept for OPENSTACK_CACHE_TTL,
+        everything is dropped when platforms are reloaded. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pools = {}
+        self.values = {}
+
+    def clear(self):
+        with self.lock:
+            self.pools = {}
+            self.values = {}
+
+    def _client(self, kind, factory, depth):
+        with self.lock:
+            if kind not in self.pools:
+                self.pools[kind] = ClientPool(
+                    lambda: CountedClient(factory(), kind, counters, depth),
+                    config.OPENSTACK_CLIENT_POOL_SIZE,
+                    config.OPENSTACK_CLIENT_TTL
+                )
+            pool = self.pools[kind]
+        return pool.get()
+
+    def nova(self):
+        return self._client("nova", lambda: nova_client(), 2)
+
+    def neutron(self):
+        return self._client("neutron", lambda: neutron_client(), 1)
+
+    def glance(self):
+        return self._client("glance", lambda: glance_client(), 2)
+
+    def get(self, key, resolve):
+        with self.lock:
+            entry = self.values.get(key)
+        if entry and time.time() - entry[1] < config.OPENSTACK_CACHE_TTL:
+            return entry[0]
+
+        value = resolve()
+        with self.lock:
+            self.values[key] = (value, time.time())
+        return value
+
+    def image(self, origin):
+        return self.get(
+            ("image", origin.name),
+            lambda: self.nova().images.find(name=origin.name)
+        )
+
+    def flavor(self, origin):
+        return self.get(
+            ("flavor", origin.flavor_name),
+            lambda: self.nova().flavors.find(name=origin.flavor_name)
+        )
+
+
+class ServerListingError(Exception):
+    pass
+
+
+class ServerPoller(object):
+    """ Lists all vmmaster servers with a single call every
+        VM_CREATE_CHECK_PAUSE seconds while somebody waits for a status
+        and hands the result to every waiting clone. A failed listing
+        keeps the servers of the last one. """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.servers = {}
+        self.started = 0
+        self.finished = 0
+        self.waiting = 0
+        self.worker = None
+        self.running = False
+        self.listed = 0
+        self.failed = 0
+
+    def _start(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.running = True
+            self.worker = Thread(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join(1)
+        self.worker = None
+        self.servers = {}
+        self.listed = 0
+        self.failed = 0
+
+    def server(self, name):
+        """ Server from the last listing, None if it was not listed. """
+        with self.condition:
+            return self.servers.get(name)
+
+    def wait(self, name):
+        """ Blocks until a listing started after the call is done,
+            returns the server from it or None if it was not listed.
+            Raises ServerListingError if the listing failed. """
+        with self.condition:
+            self._start()
+            wanted = self.started + 1
+            self.waiting += 1
+            self.condition.notify_all()
+            try:
+                while self.running and self.finished < wanted:
+                    self.condition.wait(1)
+            finally:
+                self.waiting -= 1
+            if self.running and self.failed == self.finished:
+                raise ServerListingError(
+                    "Can't list openstack servers, listing %s failed" %
+                    self.failed)
+            return self.servers.get(name)
+
+    def list_servers(self):
+        """ None if servers can't be listed. """
+        try:
+            servers = cache.nova().servers.list(search_opts={
+                "name": "^%s" % config.OPENSTACK_PLATFORM_NAME_PREFIX
+            })
+            return dict((server.name, server) for server in servers
+                        if "-clone-" in server.name)
+        except Exception as e:
+            log.exception("Can't list openstack servers: %s" % e)
+            return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    pause = self.listed + config.VM_CREATE_CHECK_PAUSE - \
+                        time.time()
+                    if self.waiting and pause <= 0:
+                        break
+                    self.condition.wait(pause if self.waiting else 1)
+                if not self.running:
+                    break
+                self.started += 1
+                cycle = self.started
+                self.listed = time.time()
+
+            servers = self.list_servers()
+
+            with self.condition:
+                if servers is None:
+                    self.failed = cycle
+                else:
+                    self.servers = servers
+                self.finished = cycle
+                self.condition.notify_all()
+
+
+counters = ApiCounters()
+cache = OpenstackCache()
+poller = ServerPoller()
@@ -7,21 +7,17 @@
 import logging
 import multiprocessing
 from twisted.internet import threads
-import websockify
 
 from core.config import config
 
 import sys, socket, os, os.path, subprocess, signal
 from vnc2flv import flv, rfb, video
-from core.utils.network_utils import get_free_port
 
 log = logging.getLogger(__name__)
 
 
 class VNCVideoHelper():
     recorder = None
-    proxy = None
-    __proxy_port = None
     __filepath = None
 
     def __init__(self, host, port=5900, filename_prefix='vnc'):
@@ -103,29 +99,6 @@ class VNCVideoHelper():
             os.remove(self.__filepath)
             log.debug('Source video %s was deleted' % self.__filepath)
 
-    def start_proxy(self):
-        self.__proxy_port = get_free_port()
-        sys.argv = [
-            "--daemon",
-            "--wrap-mode=ignore",
-            "--record=%s/proxy_vnc_%s.log" % (self.dir_path, self.port),
-            "0.0.0.0:%d" % self.__proxy_port,
-            "%s:%s" % (self.host, self.port)
-        ]
-
-        self.proxy = multiprocessing.Process(
-            target=websockify.websocketproxy.websockify_init
-        )
-
-        self.proxy.start()
-
-    def get_proxy_port(self):
-        return self.__proxy_port
-
-    def stop_proxy(self):
-        if self.proxy and self.proxy.is_alive():
-            self.proxy.terminate()
-
     def start_recording(self, framerate=5, size=(800, 600)):
         sys.stderr = sys.stdout = open(os.sep.join([
             self.dir_path, 'vnc_video.log'
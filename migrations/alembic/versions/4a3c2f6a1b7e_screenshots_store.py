@@ -0,0 +1,93 @@
+"""screenshots_store
+
+Revision ID: 4a3c2f6a1b7e
+Revises: 32c160e101ea
+Create Date: 2026-10-17 20:12:44.517311
+
+"""
+import os
+import shutil
+import logging
+
+from alembic import op
+from sqlalchemy.sql import text
+
+from core.config import config
+from core import screenshots
+
+# revision identifiers, used by Alembic.
+revision = '4a3c2f6a1b7e'
+down_revision = '32c160e101ea'
+
+log = logging.getLogger(__name__)
+
+
+def _copy(source, target):
+    """ Copies source to target unless the target exists already.
+        Sources are kept, if the migration is rolled back the log steps
+        still refer to them and it can be run again. They are removed
+        with directories of their sessions by the cleanup. """
+    if os.path.exists(target):
+        return False
+
+    target_dir = os.path.dirname(target)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    shutil.copy(source, target + ".tmp")
+    os.rename(target + ".tmp", target)
+    return True
+
+
+def upgrade():
+    op.create_index(op.f('ix_session_log_steps_screenshot'),
+                    'session_log_steps', ['screenshot'], unique=False)
+
+    connection = op.get_bind()
+    steps = connection.execute(text(
+        "SELECT id, screenshot FROM session_log_steps "
+        "WHERE screenshot IS NOT NULL;"))
+
+    total, stored = 0, 0
+    for step_id, path in steps.fetchall():
+        if not os.path.isfile(path):
+            continue
+        target = screenshots.store_path(screenshots.file_digest(path))
+        thumbnail = screenshots.thumbnail_path(path)
+
+        total += 1
+        if _copy(path, target):
+            stored += 1
+        if os.path.isfile(thumbnail):
+            _copy(thumbnail, screenshots.thumbnail_path(target))
+
+        connection.execute(text(
+            "UPDATE session_log_steps SET screenshot = :screenshot "
+            "WHERE id = :id;"), screenshot=target, id=step_id)
+
+    if stored:
+        log.info("%s screenshots copied to %s files, dedup ratio %.2f" % (
+            total, stored, total / float(stored)))
+
+
+def downgrade():
+    connection = op.get_bind()
+    steps = connection.execute(text(
+        "SELECT id, session_id, screenshot FROM session_log_steps "
+        "WHERE screenshot IS NOT NULL;"))
+
+    store = os.path.join(config.SCREENSHOTS_DIR, screenshots.STORE_DIR)
+    for step_id, session_id, path in steps.fetchall():
+        if not path.startswith(store) or not os.path.isfile(path):
+            continue
+        target = os.path.join(config.SCREENSHOTS_DIR, str(session_id),
+                              "%s.png" % step_id)
+        _copy(path, target)
+
+        connection.execute(text(
+            "UPDATE session_log_steps SET screenshot = :screenshot "
+            "WHERE id = :id;"), screenshot=target, id=step_id)
+
+    # kept, log steps refer to it until the migration is committed
+    log.info("Screenshots are copied back, %s can be removed" % store)
+    op.drop_index(op.f('ix_session_log_steps_screenshot'),
+                  table_name='session_log_steps')
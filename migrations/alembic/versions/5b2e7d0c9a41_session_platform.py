@@ -0,0 +1,24 @@
+"""session_platform
+
+Revision ID: 5b2e7d0c9a41
+Revises: 4a3c2f6a1b7e
+Create Date: 2026-10-17 22:41:05.118342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5b2e7d0c9a41'
+down_revision = '4a3c2f6a1b7e'
+
+
+def upgrade():
+    op.add_column('sessions',
+                  sa.Column('platform', sa.String(), nullable=True))
+    op.execute("UPDATE sessions SET platform = dc::json->>'platform' "
+               "WHERE dc IS NOT NULL;")
+
+
+def downgrade():
+    op.drop_column('sessions', 'platform')
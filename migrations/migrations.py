@@ -15,7 +15,7 @@ script = ScriptDirectory.from_config(alembic_cfg)
 
 
 def run(connection_string):
-    revision = "32c160e101ea"  # Added platforms table
+    revision = "5b2e7d0c9a41"  # Platform column of sessions
 
     alembic_cfg.set_main_option("sqlalchemy.url", connection_string)
     try:
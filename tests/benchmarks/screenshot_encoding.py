@@ -0,0 +1,88 @@
+# coding: utf-8
+
+""" Measures CPU time against bytes saved by screenshot encodings.
+
+    python tests/benchmarks/screenshot_encoding.py [screenshots dir]
+
+    Without a directory of PNG screenshots a corpus of synthetic
+    page-like images is used.
+"""
+
+import os
+import sys
+import time
+import random
+from StringIO import StringIO
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from core.screenshots import encode  # noqa
+
+ENCODINGS = [
+    ("quantized_png", 100),
+    ("quantized_png", 50),
+    ("webp", 90),
+    ("webp", 75),
+    ("webp", 50),
+]
+
+
+def page(seed, width=1280, height=1024):
+    """ White page with a header, text lines, buttons and a photo. """
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 60), fill=(rnd.randint(0, 255), 80, 160))
+    for y in range(100, height - 300, 22):
+        x = 40
+        while x < width - 200:
+            word = rnd.randint(20, 90)
+            draw.rectangle((x, y, x + word, y + 10), fill=(50, 50, 50))
+            x += word + 8
+    for x in range(40, width - 200, 220):
+        draw.rectangle((x, height - 260, x + 180, height - 220),
+                       fill=(rnd.randint(0, 255), rnd.randint(0, 255), 200))
+    photo = Image.merge("RGB", (
+        Image.radial_gradient("L"), Image.linear_gradient("L"),
+        Image.effect_noise((256, 256), rnd.randint(20, 60)))
+    ).resize((640, 180))
+    image.paste(photo, (40, height - 200))
+    return image
+
+
+def corpus(directory=None):
+    if directory:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".png"):
+                with open(os.path.join(directory, name), "rb") as f:
+                    yield f.read()
+        return
+
+    for seed in range(10):
+        output = StringIO()
+        page(seed).save(output, "PNG")
+        yield output.getvalue()
+
+
+def main(directory=None):
+    screenshots = list(corpus(directory))
+    original = sum(len(screenshot) for screenshot in screenshots)
+    print("%s screenshots, %.1f KB as png" % (
+        len(screenshots), original / 1024.0))
+    print("%-16s %12s %12s %8s" % (
+        "encoding", "cpu ms/shot", "size, KB", "saved"))
+
+    for encoding in ENCODINGS:
+        start = time.clock()
+        size = sum(len(encode(screenshot, encoding))
+                   for screenshot in screenshots)
+        cpu = (time.clock() - start) / len(screenshots)
+        print("%-16s %12.1f %12.1f %7.1f%%" % (
+            "%s:%s" % encoding, cpu * 1000, size / 1024.0,
+            100.0 * (original - size) / original))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
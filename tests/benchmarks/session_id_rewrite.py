@@ -0,0 +1,75 @@
+# coding: utf-8
+
+""" Compares sessionId rewriting of swap_session with the former
+    decode/encode implementation over realistic payloads.
+
+    python tests/benchmarks/session_id_rewrite.py
+"""
+
+import os
+import sys
+import json
+import base64
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+import core.db  # noqa
+from core.utils.json_stream import set_session_id  # noqa
+from vmmaster.webdriver.commands import set_path_session_id as new_path  # noqa
+
+SIZES = (100, 1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+PATH = "/wd/hub/session/selenium-session-id/element/0/value"
+
+
+def old_body(body, session_id):
+    body = json.loads(body)
+    body["sessionId"] = session_id
+    return json.dumps(body)
+
+
+def old_path(path, session_id):
+    parts = path.split("/")
+    pos = parts.index("session")
+    parts[pos + 1] = str(session_id)
+    return "/".join(parts)
+
+
+def payload(size):
+    """ A sendKeys/executeScript-like request: the sessionId first and
+        a long string argument, as file uploads and screenshots are. """
+    filler = base64.b64encode(os.urandom(size))[:max(size - 60, 1)]
+    return json.dumps({
+        "sessionId": "selenium-session-id",
+        "value": [filler]
+    })
+
+
+def measure(func, *args):
+    timer = timeit.Timer(lambda: func(*args))
+    number, elapsed = 1, 0
+    while elapsed < 0.2:
+        elapsed = timer.timeit(number)
+        number *= 2
+    return min(timer.repeat(3, number // 2 or 1)) / (number // 2 or 1)
+
+
+def main():
+    print("%10s %12s %12s %8s" % ("size", "old, ms", "new, ms", "speedup"))
+    for size in SIZES:
+        body = payload(size)
+        assert json.loads(old_body(body, 1)) == \
+            json.loads(set_session_id(body, 1))
+        old = measure(old_body, body, 1)
+        new = measure(set_session_id, body, 1)
+        print("%10d %12.4f %12.4f %7.1fx" % (
+            len(body), old * 1000, new * 1000, old / new))
+
+    old = measure(old_path, PATH, 1)
+    new = measure(new_path, PATH, 1)
+    print("%10s %12.4f %12.4f %7.1fx" % (
+        "path", old * 1000, new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
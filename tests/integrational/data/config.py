@@ -14,5 +14,6 @@ class Config(object):
 
     SCREENSHOTS_DIR = BASE_DIR + "/screenshots"
     SCREENSHOTS_DAYS = 7
+    SCREENSHOTS_CLEANUP_GRACE_PERIOD = 600
 
     LOG_LEVEL = "INFO"
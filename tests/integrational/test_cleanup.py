@@ -79,3 +79,43 @@ class TestCleanup(unittest.TestCase):
 
         self.assertIn(self.session.id, session_ids)
         self.cleanup.delete_session_data([self.session])
+
+    def test_shared_screenshot_deleted_with_last_reference(self):
+        path = os.path.join(config.SCREENSHOTS_DIR, "store", "ab", "ab.png")
+        system_utils.run_command(
+            ["mkdir", "-p", os.path.dirname(path)], silent=True)
+        system_utils.run_command(["touch", path], silent=True)
+        # not used lately
+        os.utime(path, (0, 0))
+
+        from core.sessions import Session
+        with patch('flask.current_app.sessions', Mock()):
+            sessions = [self.session, Session()]
+
+        for num, session in enumerate(sessions):
+            session.status = 'unknown'
+            session.name = '__test_shared_screenshot_%s' % num
+            session.save()
+            step = session.add_session_step("POST /wd/hub/session/1/url")
+            step.screenshot = path
+            step.save()
+        self.app.database.step_writer.flush()
+
+        self.cleanup.delete_session_data(sessions[:1])
+        self.assertTrue(os.path.isfile(path))
+
+        self.cleanup.delete_session_data(sessions[1:])
+        self.assertFalse(os.path.isfile(path))
+        system_utils.run_command(
+            ["rm", "-rf", config.SCREENSHOTS_DIR], silent=True)
+
+    def test_screenshot_used_lately_is_kept(self):
+        path = os.path.join(config.SCREENSHOTS_DIR, "store", "cd", "cd.png")
+        system_utils.run_command(
+            ["mkdir", "-p", os.path.dirname(path)], silent=True)
+        system_utils.run_command(["touch", path], silent=True)
+
+        self.cleanup.delete_screenshots([path])
+        self.assertTrue(os.path.isfile(path))
+        system_utils.run_command(
+            ["rm", "-rf", config.SCREENSHOTS_DIR], silent=True)
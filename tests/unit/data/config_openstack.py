@@ -4,6 +4,7 @@ import os
 class Config(object):
     BASE_DIR = os.path.dirname(os.path.realpath(__file__))
     PORT = 9001
+    USERS_CACHE_TTL = 60
 
     # relative to BASE_DIR
     CLONES_DIR = BASE_DIR + "/clones"
@@ -12,6 +13,15 @@ class Config(object):
     LOG_DIR = BASE_DIR + "/logs"
 
     SCREENSHOTS_DIR = BASE_DIR + "/screenshots"
+    SCREENSHOTS_PROCESSES = 2
+    SCREENSHOTS_QUEUE_SIZE = 100
+    SCREENSHOTS_THUMBNAILS_QUEUE_SIZE = 20
+    SCREENSHOTS_THUMBNAIL_TIMEOUT = 10
+    SCREENSHOTS_TASK_TIMEOUT = 60
+    SCREENSHOTS_CLEANUP_GRACE_PERIOD = 600
+    SCREENSHOTS_ENCODING = {"format": "png", "quality": 100}
+    SCREENSHOTS_USER_ENCODING = {}
+    SCREENSHOTS_PLATFORM_ENCODING = {}
 
     # clones related stuff
     ORIGIN_POSTFIX = "origin"
@@ -41,18 +51,40 @@ class Config(object):
     OPENASTACK_VM_META_DATA = {
         'admin_pass': 'testPassw0rd.'
     }
+    OPENSTACK_CLIENT_POOL_SIZE = 1
+    OPENSTACK_CLIENT_TTL = 1800
+    OPENSTACK_CACHE_TTL = 600
 
     VM_CHECK = False
     VM_CHECK_FREQUENCY = 1800
     VM_CREATE_CHECK_PAUSE = 1
     VM_CREATE_CHECK_ATTEMPTS = 1
     PRELOADER_FREQUENCY = 1
+    KVM_PRELOADER_CONCURRENCY = 2
+    OPENSTACK_PRELOADER_CONCURRENCY = 10
+    PRELOADER_STOP_TIMEOUT = 10
+
+    # copy-on-write drive overlays created in advance for every origin
+    KVM_SPARE_OVERLAYS = 0
+
+    # adaptive preloading: targets are computed from recent sessions,
+    # *_PRELOADED settings only list platforms to keep preloaded
+    PRELOADER_ADAPTIVE = False
+    PRELOADER_ADAPTIVE_WINDOW = 900
+    PRELOADER_ADAPTIVE_HEADROOM = 1.5
+    PRELOADER_ADAPTIVE_MIN = 0
+    PRELOADER_ADAPTIVE_MAX = 5
     SESSION_TIMEOUT = 30
+    SESSION_ACTIVITY_PERSIST_INTERVAL = 10
     PING_TIMEOUT = 1
 
     # vm pool
     GET_VM_TIMEOUT = 1
 
+    # waiting sessions queue priorities, higher is served first
+    QUEUE_USER_PRIORITIES = {}  # {username: priority}
+    QUEUE_GROUP_PRIORITIES = {}  # {group id: priority}
+
     # GRAPHITE = ('graphite', 2003)
 
     SELENIUM_PORT = 4455
@@ -60,4 +92,30 @@ class Config(object):
 
     THREAD_POOL_MAX = 100
 
+    # endpoint connections
+    ENDPOINT_POOL_SIZE = 10
+    ENDPOINT_KEEP_ALIVE = True
+
+    # requests to endpoints
+    UPSTREAM_THREAD_POOL_MAX = 100
+    # bigger responses (or of unknown size) are streamed to the client
+    UPSTREAM_STREAM_MIN_SIZE = 1024 * 1024
+    UPSTREAM_STREAM_CHUNK_SIZE = 64 * 1024
+    PROXY_CONNECT_TIMEOUT = 10
+    PROXY_PERSISTENT_CONNECTIONS = 4
+    PROXY_IDLE_CONNECTION_TIMEOUT = 60
+    VNC_PROXY_MAX_CONNECTIONS = 100
+    VNC_PROXY_SESSION_MAX_CONNECTIONS = 5
+    VNC_PROXY_IDLE_TIMEOUT = 600
+    VNC_PROXY_MAX_FRAME_SIZE = 1024 * 1024
+
+    # session log steps writer
+    STEPS_WRITER_BATCH_SIZE = 100
+    STEPS_WRITER_FLUSH_INTERVAL = 1
+    STEPS_BODY_LOGGING = "full"
+    STEPS_BODY_SHORT_SIZE = 1024
+    STEPS_BODY_MAX_SIZE = 64 * 1024
+    STEPS_BODY_HASH_MIN_SIZE = 256
+    STEPS_BODY_HASHES = 1000
+
     LOG_LEVEL = "INFO"
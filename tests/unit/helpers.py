@@ -209,6 +209,7 @@ class DatabaseMock(Mock):
     def __init__(self, *args, **kwargs):
         super(DatabaseMock, self).__init__(*args, **kwargs)
         self.add = Mock(side_effect=set_primary_key)
+        self.add_step = Mock(side_effect=set_primary_key)
 
 
 def vmmaster_server_mock(port):
@@ -3,10 +3,10 @@
 import json
 from datetime import datetime
 from mock import Mock, patch
-from multiprocessing import Process
-from helpers import BaseTestCase, fake_home_dir, DatabaseMock, wait_for
+from helpers import BaseTestCase, fake_home_dir, DatabaseMock
 from lode_runner import dataprovider
 from core import constants
+from core.config import config
 
 
 class TestApi(BaseTestCase):
@@ -127,6 +127,49 @@ class TestApi(BaseTestCase):
         self.assertEqual(screenshots_count, len(screenshots))
         self.assertEqual(200, body['metacode'])
 
+    def test_thumbnail_made_on_request(self):
+        step = Mock(session_id=1, screenshot="/vmmaster/screenshots/1/1.png")
+
+        with patch('flask.current_app.database.get_step_by_id',
+                   Mock(return_value=step)), \
+                patch('flask.current_app.screenshots.thumbnail',
+                      Mock(return_value="/vmmaster/screenshots/1/1_thumb.png")
+                      ) as thumbnail:
+            response = self.vmmaster_client.get(
+                '/api/session/1/step/1/thumbnail')
+        body = json.loads(response.data)
+
+        thumbnail.assert_called_once_with("/vmmaster/screenshots/1/1.png")
+        self.assertEqual("/vmmaster/screenshots/1/1_thumb.png",
+                         body['result']['thumbnail'])
+        self.assertEqual(200, body['metacode'])
+
+    def test_thumbnail_refused_under_backpressure(self):
+        step = Mock(session_id=1, screenshot="/vmmaster/screenshots/1/1.png")
+
+        with patch('flask.current_app.database.get_step_by_id',
+                   Mock(return_value=step)), \
+                patch('flask.current_app.screenshots.thumbnail',
+                      Mock(return_value=None)):
+            response = self.vmmaster_client.get(
+                '/api/session/1/step/1/thumbnail')
+        body = json.loads(response.data)
+
+        self.assertEqual(503, body['metacode'])
+
+    def test_thumbnail_of_step_of_another_session(self):
+        step = Mock(session_id=2, screenshot="/vmmaster/screenshots/2/1.png")
+
+        with patch('flask.current_app.database.get_step_by_id',
+                   Mock(return_value=step)), \
+                patch('flask.current_app.screenshots.thumbnail') as thumbnail:
+            response = self.vmmaster_client.get(
+                '/api/session/1/step/1/thumbnail')
+        body = json.loads(response.data)
+
+        self.assertFalse(thumbnail.called)
+        self.assertEqual(404, body['metacode'])
+
     def test_get_screenshots_for_label(self):
 
         steps = [
@@ -149,49 +192,17 @@ class TestApi(BaseTestCase):
         self.assertEqual(1, len(screenshots))
         self.assertEqual(200, body['metacode'])
 
-    def test_failed_get_vnc_info_with_create_proxy(self):
-        from core.sessions import Session
-        endpoint = Mock(ip='127.0.0.1')
-        session = Session()
-        session.name = "session1"
-        session.created = session.modified = datetime.now()
-
-        expected = 5901
-
-        with patch(
-            'flask.current_app.sessions.active',
-            Mock(return_value=[session])
-        ), patch(
-                'websockify.websocketproxy.websockify_init', Mock()
-        ):
-            session.run(endpoint)
-            response = self.vmmaster_client.get(
-                '/api/session/%s/vnc_info' % session.id)
-
-        body = json.loads(response.data)
-        self.assertEqual(200, response.status_code)
-
-        vnc_proxy_port = body['result']['vnc_proxy_port']
-        self.assertEqual(type(expected), type(vnc_proxy_port))
-        self.assertEqual(200, body['metacode'])
-        self.assertTrue(isinstance(session.vnc_helper.proxy, Process))
-
-        session.close()
-        self.assertTrue(wait_for(
-            lambda: not session.vnc_helper.proxy.is_alive()))
-
-    def test_get_vnc_info_for_running_proxy(self):
+    def test_get_vnc_info(self):
         from core.sessions import Session
         endpoint = Mock(ip='127.0.0.1')
         session = Session()
         session.name = "session1"
         session.created = session.modified = datetime.now()
         session.run(endpoint)
-        session.vnc_helper = Mock(proxy=Mock(),
-                                  get_proxy_port=Mock(return_value=5900))
 
         expected = {
-            'vnc_proxy_port': 5900
+            'vnc_proxy_port': config.PORT,
+            'vnc_proxy_path': '/vnc/session/%s' % session.id
         }
 
         response = self.vmmaster_client.get(
@@ -199,9 +210,7 @@ class TestApi(BaseTestCase):
 
         body = json.loads(response.data)
         self.assertEqual(200, response.status_code)
-
-        vnc_proxy_port = body['result']
-        self.assertDictEqual(expected, vnc_proxy_port)
+        self.assertDictEqual(expected, body['result'])
         self.assertEqual(200, body['metacode'])
         session.close()
 
@@ -209,11 +218,6 @@ class TestApi(BaseTestCase):
         with patch(
                 'flask.current_app.sessions.active',
                 Mock(return_value=[])
-        ), patch(
-                'websockify.websocketproxy.websockify_init', Mock()
-        ), patch(
-                'core.utils.network_utils.get_free_port',
-                Mock(side_effect=5900)
         ):
             response = self.vmmaster_client.get('/api/session/1/vnc_info')
         body = json.loads(response.data)
@@ -0,0 +1,77 @@
+# coding: utf-8
+
+import os
+from xml.dom import minidom
+
+from mock import Mock, patch
+from core.config import config, setup_config
+from core import dumpxml
+from helpers import BaseTestCase
+
+
+class TestCloneFactory(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        from vmpool.clone_factory import KVMCloneFactory
+
+        self.origin = Mock()
+        self.origin.name = "test_origin_1"
+        self.origin.drive = os.path.join(
+            config.ORIGINS_DIR, "test_origin_1", "drive.qcow2")
+        self.origin.settings = open(os.path.join(
+            config.ORIGINS_DIR, "test_origin_1", "settings.xml")).read()
+        self.factory = KVMCloneFactory(self.origin)
+
+    def tearDown(self):
+        self.factory.stop()
+
+    def test_template_renders_clone_settings(self):
+        xml = minidom.parseString(self.factory.template.render(
+            name="test_origin_1-clone-1",
+            uuid="12345678-1234-1234-1234-123456789012",
+            mac="52:54:00:00:00:01",
+            disk_file='/clones/"drive".qcow2',
+            interface_source="virbr0"
+        ))
+
+        self.assertEqual("test_origin_1-clone-1", dumpxml.get_name(xml))
+        self.assertEqual("52:54:00:00:00:01", dumpxml.get_mac(xml))
+        self.assertEqual('/clones/"drive".qcow2', dumpxml.get_disk_file(xml))
+        self.assertEqual("virbr0", dumpxml.get_interface_source(xml))
+
+    @patch('core.utils.create_qcow2_overlay', Mock())
+    def test_clone_takes_spare_overlay(self):
+        from core import utils
+        overlays = self.factory.overlays
+        spare = overlays.path("test_origin_1-spare-1")
+        overlays.spares.append(spare)
+
+        with patch('os.rename') as rename, \
+                patch.object(overlays, 'fill', Mock()):
+            path = overlays.take("test_origin_1-clone-1")
+
+        rename.assert_called_once_with(spare, path)
+        self.assertFalse(utils.create_qcow2_overlay.called)
+        self.assertEqual(0, len(overlays))
+
+    @patch('core.utils.create_qcow2_overlay', Mock())
+    def test_overlay_created_without_spares(self):
+        from core import utils
+        path = self.factory.overlays.take("test_origin_1-clone-1")
+
+        utils.create_qcow2_overlay.assert_called_once_with(
+            self.origin.drive, path)
+
+    def test_step_timings(self):
+        from vmpool.clone_factory import StepTimer
+        timer = StepTimer()
+        with timer("clone"):
+            pass
+        with timer("define"):
+            pass
+
+        self.factory.record(timer)
+
+        self.assertEqual(1, self.factory.info["created"])
+        self.assertEqual(["clone", "define"],
+                         sorted(self.factory.info["timings"]))
@@ -97,6 +97,9 @@ class CommonCommandsTestCase(BaseTestCase):
         cls.vmmaster_agent.stop()
         del cls.app
 
+        from core.sessions import stop_upstream_pool
+        stop_upstream_pool()
+
 
 def ping_vm_mock(arg):
     yield None
@@ -442,6 +445,28 @@ class TestGetDesiredCapabilities(BaseTestCase):
         dc = self.commands.get_desired_capabilities(self.request)
         self.assertFalse(dc["takeScreenshot"])
 
+    def test_capabilities_parsed_once(self):
+        self.request.data = json.dumps(self.body)
+
+        with patch("core.utils.json.loads",
+                   Mock(side_effect=json.loads)) as loads:
+            dc = self.commands.get_desired_capabilities(self.request)
+            self.commands.get_desired_capabilities(self.request)
+
+        self.assertEqual(1, loads.call_count)
+        self.assertEqual("some_platform", dc["platform"])
+
+    def test_replace_platform_keeps_parsed_capabilities(self):
+        self.request.data = json.dumps(self.body)
+        dc = self.commands.get_desired_capabilities(self.request)
+
+        self.commands.replace_platform_with_any(self.request)
+
+        self.assertEqual("some_platform", dc["platform"])
+        self.assertEqual(
+            "ANY", json.loads(self.request.data)[
+                "desiredCapabilities"]["platform"])
+
 
 class TestRunScript(CommonCommandsTestCase):
     def setUp(self):
@@ -464,6 +489,38 @@ class TestRunScript(CommonCommandsTestCase):
         self.assertEqual(200, response[0])
         self.assertEqual(self.response_body, response[2])
 
+    @patch.multiple('vmmaster.webdriver.helpers',
+                    is_request_closed=Mock(return_value=False),
+                    is_session_timeouted=Mock(return_value=False),
+                    is_session_closed=Mock(return_value=False))
+    def test_run_script_output_logged_by_body_policy(self):
+        from core.step_bodies import StepBodyLog
+
+        class WebSocketApp(object):
+            def __init__(self, host, on_message, on_close, **kwargs):
+                self.on_message, self.on_close = on_message, on_close
+
+            def run_forever(self):
+                self.on_message(self, "x" * 2000)
+                self.on_close(self)
+
+            def close(self):
+                pass
+
+        sub_step = Mock()
+        self.session._body_log = StepBodyLog(self.session.id, "short")
+        with patch.object(self.session, "add_sub_step",
+                          Mock(return_value=sub_step)), \
+                patch('websocket.WebSocketApp', WebSocketApp):
+            status, headers, body = \
+                self.commands.run_script_through_websocket(
+                    "script", self.session, "ws://localhost")
+
+        self.assertEqual(2000, len(json.loads(body)["output"]))
+        self.assertEqual(2, sub_step.save.call_count)
+        self.assertTrue(sub_step.body.endswith(" bytes]"))
+        self.assertLess(len(sub_step.body), 1100)
+
 
 class TestLabelCommands(CommonCommandsTestCase):
     def test_label(self):
@@ -481,3 +538,206 @@ class TestLabelCommands(CommonCommandsTestCase):
         json_body = json.loads(body)
         self.assertEqual(json_body["value"], label)
         self.assertEqual(json_body["labelId"], label_id)
+
+
+@patch('flask.current_app.database', Mock())
+class TestSessionRequests(CommonCommandsTestCase):
+    def test_requests_counted_per_port(self):
+        from core.sessions import RequestHelper
+        port = self.webdriver_server.port
+
+        for _ in range(2):
+            for status, headers, body in self.session.make_request(
+                port, RequestHelper("GET", "/wd/hub/status")
+            ):
+                pass
+
+        self.assertEqual(200, status)
+        self.assertEqual("ok", body)
+        stat = self.session.connection_pool.info[str(port)]
+        self.assertEqual(2, stat["requests"])
+        self.assertEqual(
+            stat["requests"] - stat["connections"], stat["reused"])
+
+    def test_hop_by_hop_headers_are_not_forwarded(self):
+        pool = self.session.connection_pool
+
+        with patch.object(pool.http, 'request', Mock()) as request:
+            pool.request(self.webdriver_server.port, "GET", "/",
+                         headers={"Connection": "close", "Accept": "*/*"})
+
+        headers = request.call_args[1]["headers"]
+        self.assertNotIn("Connection", headers)
+        self.assertEqual("*/*", headers["Accept"])
+
+    @patch.object(config, 'UPSTREAM_STREAM_MIN_SIZE', 0)
+    def test_big_response_streamed_through_scanner(self):
+        from core.sessions import RequestHelper, StreamedBody
+        from core.utils.json_stream import rewrite_session_id
+        port = self.webdriver_server.port
+
+        for status, headers, body in self.session.make_request(
+            port, RequestHelper("GET", "/wd/hub/status"),
+            scanner=rewrite_session_id(self.session.id)
+        ):
+            pass
+
+        completed = Mock()
+        body.on_complete(completed)
+        self.assertIsInstance(body, StreamedBody)
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual("ok", "".join(body))
+        completed.assert_called_once_with(body)
+
+    @patch.multiple('vmmaster.webdriver.helpers',
+                    is_request_closed=Mock(return_value=False),
+                    is_session_timeouted=Mock(return_value=False),
+                    is_session_closed=Mock(return_value=False))
+    @patch.object(config, 'UPSTREAM_STREAM_MIN_SIZE', 1024)
+    def test_same_session_id_in_small_and_big_responses(self):
+        from flask import request
+        from core.sessions import StreamedBody
+        from vmmaster.webdriver.helpers import transparent
+        self.session.selenium_session = "selenium-1"
+
+        session_ids = []
+        for padding in ("", "x" * 2048):
+            data = json.dumps({"sessionId": "selenium-1", "status": 0,
+                               "value": padding})
+            with self.app.test_request_context(
+                    "/wd/hub/session/%s/element" % self.session.id,
+                    method="POST", data=data, headers={"reply": "200"}), \
+                    patch.object(config, 'SELENIUM_PORT',
+                                 self.webdriver_server.port):
+                request.session = self.session
+                status, headers, body = transparent()
+                if isinstance(body, StreamedBody):
+                    body = "".join(body)
+            session_ids.append(json.loads(body)["sessionId"])
+
+        self.assertEqual([self.session.id, self.session.id], session_ids)
+
+    def test_make_request_interrupted_by_session_close(self):
+        from threading import Event, Timer
+        from core.sessions import RequestHelper
+        release = Event()
+
+        def cancel_upstream_requests():
+            self.session.closed = True
+            for upstream in list(self.session.upstream_requests):
+                upstream.cancel()
+
+        with patch.object(
+            self.session.connection_pool, 'request',
+            Mock(side_effect=lambda *args, **kwargs: release.wait(5))
+        ):
+            Timer(0.1, cancel_upstream_requests).start()
+            self.assertRaises(
+                SessionException, list, self.session.make_request(
+                    self.webdriver_server.port, RequestHelper("GET", "/"))
+            )
+            release.set()
+
+        self.assertEqual(0, len(self.session.upstream_requests))
+
+    @patch.object(config, 'SESSION_TIMEOUT', 0.2)
+    def test_make_request_times_out_the_session(self):
+        from threading import Event
+        from core.sessions import RequestHelper
+        release = Event()
+
+        with patch.object(
+            self.session.connection_pool, 'request',
+            Mock(side_effect=lambda *args, **kwargs: release.wait(5))
+        ), patch.object(self.session, 'timeout', Mock()) as timeout:
+            self.assertRaises(
+                TimeoutException, list, self.session.make_request(
+                    self.webdriver_server.port, RequestHelper("GET", "/"))
+            )
+            release.set()
+
+        timeout.assert_called_once_with()
+        self.assertEqual(0, len(self.session.upstream_requests))
+
+
+class TestCommandRouter(BaseTestCase):
+    def setUp(self):
+        from vmmaster.webdriver import router
+        self.router = router
+
+    def test_commands_parsed(self):
+        r = self.router
+        for method, path, expected in [
+            ("POST", "/wd/hub/session", (r.NEW_SESSION, None, None)),
+            ("GET", "/wd/hub/session/1", (r.GET_SESSION, "1", None)),
+            ("DELETE", "/wd/hub/session/1/", (r.DELETE_SESSION, "1", None)),
+            ("POST", "/wd/hub/session/1/url", (r.URL, "1", None)),
+            ("POST", "/wd/hub/session/1/element", (r.ELEMENT, "1", None)),
+            ("POST", "/wd/hub/session/1/element/5/click", (r.CLICK, "1", "5")),
+            ("POST", "/wd/hub/session/1/element/5/value", (r.VALUE, "1", "5")),
+            ("GET", "/wd/hub/session/1/element/5/text", (r.ELEMENT, "1", "5")),
+            ("GET", "/wd/hub/session/1/element/5/attribute/value",
+             (r.ATTRIBUTE_VALUE, "1", "5")),
+            ("POST", "/wd/hub/session/1/execute_async",
+             (r.EXECUTE_ASYNC, "1", None)),
+            ("POST", "/wd/hub/session/1/execute/async",
+             (r.EXECUTE, "1", None)),
+            ("POST", "/wd/hub/session/1/touch/click", (r.CLICK, "1", None)),
+            ("POST", "/wd/hub/session/1/touch/flick", (r.TOUCH, "1", None)),
+            ("POST", "/wd/hub/session/1/elements", (r.ELEMENTS, "1", None)),
+            ("POST", "/wd/hub/session/1/vmmaster/runScript",
+             (r.RUN_SCRIPT, "1", None)),
+            ("GET", "/wd/hub/session/1/window_handles", (r.OTHER, "1", None)),
+            ("GET", "/wd/hub/status", (r.UNKNOWN, None, None)),
+        ]:
+            command = self.router.parse(method, path)
+            self.assertEqual(expected, command[:3], path)
+
+    def test_default_screenshot_policy(self):
+        session = Mock(screenshot_policy=None, capabilities={})
+        click = self.router.parse("POST", "/wd/hub/session/1/element/5/click")
+        find = self.router.parse("POST", "/wd/hub/session/1/element")
+        handles = self.router.parse("GET", "/wd/hub/session/1/window_handles")
+        attribute = self.router.parse(
+            "GET", "/wd/hub/session/1/element/5/attribute/value")
+
+        self.assertEqual(
+            "session", self.router.screenshot_source(session, click, 200))
+        self.assertEqual(
+            "session", self.router.screenshot_source(session, attribute, 200))
+        self.assertIsNone(self.router.screenshot_source(session, find, 200))
+        self.assertEqual(
+            "response", self.router.screenshot_source(session, find, 500))
+        self.assertIsNone(
+            self.router.screenshot_source(session, handles, 500))
+
+    def test_screenshot_policy_kept_from_path_words(self):
+        session = Mock(screenshot_policy=None, capabilities={})
+        for path, status, expected in [
+            ("/wd/hub/session/1/execute/async", 200, "session"),
+            ("/wd/hub/session/1/execute_async", 200, None),
+            ("/wd/hub/session/1/execute_async", 500, "response"),
+            ("/wd/hub/session/1/touch/click", 200, "session"),
+            ("/wd/hub/session/1/touch/flick", 500, None),
+            ("/wd/hub/session/1/elements", 500, None),
+            ("/wd/hub/session/1/element/5/elements", 500, "response"),
+        ]:
+            command = self.router.parse("POST", path)
+            self.assertEqual(
+                expected,
+                self.router.screenshot_source(session, command, status), path)
+
+    def test_screenshot_policy_from_capabilities(self):
+        session = Mock(screenshot_policy=None, capabilities={
+            "screenshotPolicy": {"click": "never", "element": "always",
+                                 "url": "sometimes"}
+        })
+        click = self.router.parse("POST", "/wd/hub/session/1/element/5/click")
+        find = self.router.parse("POST", "/wd/hub/session/1/element")
+        url = self.router.parse("POST", "/wd/hub/session/1/url")
+
+        self.assertIsNone(self.router.screenshot_source(session, click, 200))
+        self.assertEqual(
+            "session", self.router.screenshot_source(session, find, 200))
+        self.assertEqual(
+            "session", self.router.screenshot_source(session, url, 200))
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+from datetime import datetime, timedelta
+from mock import Mock, MagicMock
+
+from helpers import BaseTestCase
+
+
+def loaded(model, **values):
+    """ Detached instance as if loaded, without model __init__. """
+    from sqlalchemy import inspect
+    obj = inspect(model).class_manager.new_instance()
+    for key, value in values.items():
+        setattr(obj, key, value)
+    state = inspect(obj)
+    state.key = state.mapper._identity_key_from_state(state)
+    state._commit_all(state.dict)
+    return obj
+
+
+class TestDatabaseUpdate(BaseTestCase):
+    def setUp(self):
+        from core.config import setup_config
+        setup_config('data/config.py')
+
+        from core.db import Database
+        from core.db.models import User, Session
+        self.database = object.__new__(Database)
+        self.database.users = Mock()
+        self.database.engine = MagicMock()
+        self.connection = \
+            self.database.engine.begin.return_value.__enter__.return_value
+        self.dbsession = Mock()
+
+        self.user = loaded(User, id=1, username="user", token="token-1",
+                           group=None)
+        self.created = datetime(2016, 1, 1)
+        self.sessions = [loaded(Session, id=i, modified=self.created)
+                         for i in (1, 2)]
+
+    def test_partial_update(self):
+        from core.db import changed_columns
+        self.user.token = "token-2"
+
+        self.database.update(self.user, dbsession=self.dbsession)
+
+        query = self.dbsession.query.return_value.filter_by
+        query.assert_called_once_with(id=1)
+        query.return_value.update.assert_called_once_with(
+            {"token": "token-2"}, synchronize_session=False)
+        self.assertEqual({}, changed_columns(self.user))
+
+    def test_noop_update(self):
+        self.database.update(self.user, dbsession=self.dbsession)
+
+        self.assertFalse(self.dbsession.query.called)
+        self.assertFalse(self.dbsession.merge.called)
+        self.assertFalse(self.dbsession.commit.called)
+
+    def test_relationship_change_is_merged(self):
+        from core.db import changed_columns
+        from core.db.models import UserGroup
+        self.user.group = UserGroup()
+        self.assertIsNone(changed_columns(self.user))
+
+        merged = self.database.update(self.user, dbsession=self.dbsession)
+
+        self.dbsession.merge.assert_called_once_with(self.user)
+        self.assertIs(self.dbsession.merge.return_value, merged)
+        self.assertEqual({}, changed_columns(self.user))
+
+        self.user.token = "token-2"
+        self.database.update(self.user, dbsession=self.dbsession)
+        self.assertEqual(1, self.dbsession.merge.call_count)
+
+    def test_user_invalidated_after_commit(self):
+        calls = Mock()
+        calls.attach_mock(self.dbsession.commit, "commit")
+        calls.attach_mock(self.database.users.invalidate, "invalidate")
+        self.user.token = "token-2"
+
+        self.database.update(self.user, dbsession=self.dbsession)
+
+        self.assertEqual(["commit", "invalidate"],
+                         [call[0] for call in calls.mock_calls])
+
+    def test_only_modified_sessions_activity_is_written(self):
+        from core.db import changed_columns
+        modified = self.created + timedelta(seconds=10)
+        self.sessions[1].modified = modified
+
+        self.database.update_sessions_activity(self.sessions)
+
+        statement, values = self.connection.execute.call_args[0]
+        self.assertEqual([{"_id": 2, "_modified": modified}], values)
+        self.assertEqual({}, changed_columns(self.sessions[1]))
+
+        self.database.update_sessions_activity(self.sessions)
+        self.assertEqual(1, self.connection.execute.call_count)
+
+
+class TestCachedUserUpdate(BaseTestCase):
+    def setUp(self):
+        from core.config import setup_config
+        setup_config('data/config.py')
+
+        from flask import Flask
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker, scoped_session
+        from core.db import Database
+        from core.db.cache import UserCache
+        from core.db.models import Base, User
+        self.database = object.__new__(Database)
+        self.database.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.database.engine)
+        self.database.DBSession = scoped_session(sessionmaker(
+            bind=self.database.engine, autoflush=False,
+            expire_on_commit=False))
+        self.database.users = UserCache(User, ttl=60)
+        self.database.add(User(username="user", token="token-1"))
+
+        self.app = Flask(__name__)
+        self.app.database = self.database
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        self.database.DBSession.remove()
+
+    def test_session_update_keeps_user_changed_meanwhile(self):
+        from core.db.models import Session
+        session = Session("session1", dc={"user": "user"})
+        cached = self.database.get_user(username="user")
+
+        user = self.database.get_user(username="user")
+        user.token = "token-2"
+        self.database.update(user)
+        # relationship changed, the session is merged
+        session.user = cached
+        self.database.update(session)
+
+        user = self.database.get_user(username="user")
+        self.assertEqual("token-2", user.token)
+        self.assertEqual(
+            user.id, self.database.get_session(session.id).user_id)
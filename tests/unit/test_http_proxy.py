@@ -2,10 +2,13 @@
 
 from mock import Mock, patch
 from core.config import setup_config
+from core.utils import wait_for
 
 from helpers import (vmmaster_server_mock, server_is_up, server_is_down,
                      BaseTestCase, get_free_port, ServerMock)
 
+import socket
+import threading
 import requests
 
 
@@ -48,6 +51,81 @@ class TestHttpProxy(BaseTestCase):
         server.stop()
         self.assertEqual("ok", response.content)
 
+    def test_proxy_streams_big_body(self):
+        server = ServerMock(self.host, self.free_port)
+        server.start()
+        body = "x" * 1024 * 1024
+        response = requests.post(
+            "http://%s:%s/proxy/session/%s/port/%s/" %
+            (self.host, self.port, self.session.id, self.free_port),
+            data=body, headers={"reply": "200"}
+        )
+        server.stop()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(body, response.content)
+
+    def test_proxy_keeps_pool_for_active_session(self):
+        resource = self.vmmaster.proxy
+        session_id = str(self.session.id)
+        resource.pools["closed"] = Mock()
+
+        pool = resource.get_pool(session_id)
+
+        self.assertIs(pool, resource.get_pool(session_id))
+        self.assertNotIn("closed", resource.pools)
+
+    def test_proxy_tunnels_upgrade(self):
+        upgraded = []
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.free_port))
+        listener.listen(1)
+
+        def echo():
+            connection = listener.accept()[0]
+            head = ""
+            while "\r\n\r\n" not in head:
+                head += connection.recv(1024)
+            head, data = head.split("\r\n\r\n", 1)
+            upgraded.append(head)
+            connection.sendall("HTTP/1.1 101 Switching Protocols\r\n"
+                               "Upgrade: websocket\r\n"
+                               "Connection: Upgrade\r\n\r\n" + data)
+            data = connection.recv(1024)
+            while data:
+                connection.sendall(data)
+                data = connection.recv(1024)
+            connection.close()
+
+        server = threading.Thread(target=echo)
+        server.start()
+        client = socket.create_connection(self.address)
+        client.settimeout(5)
+        client.sendall(
+            "GET /proxy/session/%s/port/%s/devtools/page/1 HTTP/1.1\r\n"
+            "Host: localhost\r\nUpgrade: websocket\r\n"
+            "Connection: Upgrade\r\n\r\nfirst" %
+            (self.session.id, self.free_port))
+
+        received = ""
+        while not received.endswith("first"):
+            received += client.recv(1024)
+        client.sendall("second")
+        echoed = client.recv(1024)
+        client.close()
+        server.join(5)
+        listener.close()
+
+        self.assertTrue(received.startswith("HTTP/1.1 101"))
+        self.assertEqual("second", echoed)
+        self.assertIn("GET /devtools/page/1 HTTP/1.1", upgraded[0])
+        self.assertIn("Host: localhost:%s" % self.free_port, upgraded[0])
+        self.assertTrue(wait_for(
+            lambda: not self.session.proxy_traffic.tunnels))
+        self.assertEqual(
+            len(upgraded[0]) + len("\r\n\r\nfirstsecond"),
+            self.session.proxy_traffic.sent)
+
     def test_proxy_responses_when_trying_to_connect_failed(self):
         with patch(
             'core.sessions.Sessions.get_session', Mock(
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import json
+
+from helpers import BaseTestCase
+
+
+def feed_by(scanner, document, size):
+    return "".join(scanner.feed(document[i:i + size])
+                   for i in range(0, len(document), size))
+
+
+class TestJsonStreamScanner(BaseTestCase):
+    def setUp(self):
+        self.document = json.dumps({
+            "sessionId": "selenium-1",
+            "status": 13,
+            "value": {
+                "message": 'element "a\\b" not found',
+                "screen": "iVBORw0KGgo" * 100,
+                "frames": [{"sessionId": None}, 1.5e3, True]
+            }
+        })
+
+    def scanner(self):
+        from core.utils.json_stream import JsonStreamScanner
+        return JsonStreamScanner(
+            replace={("sessionId",): '"1"'},
+            capture=[("value", "screen")]
+        )
+
+    def test_session_id_replaced_whatever_the_chunks(self):
+        expected = json.loads(self.document)
+        expected["sessionId"] = "1"
+
+        for size in (1, 2, 5, 64, len(self.document)):
+            result = feed_by(self.scanner(), self.document, size)
+            self.assertEqual(expected, json.loads(result))
+
+    def test_screen_captured_and_cut_from_log_copy(self):
+        scanner = self.scanner()
+        feed_by(scanner, self.document, 7)
+
+        self.assertEqual("iVBORw0KGgo" * 100,
+                         scanner.captured_value(("value", "screen")))
+        logged = json.loads(scanner.log_copy)
+        self.assertEqual("", logged["value"]["screen"])
+        self.assertEqual('element "a\\b" not found',
+                         logged["value"]["message"])
+
+    def test_non_string_value_replaced(self):
+        from core.utils.json_stream import rewrite_session_id
+        result = rewrite_session_id("1").feed(
+            '{"sessionId": null, "value": {"sessionId": [1, "]"]}}')
+        self.assertEqual(
+            '{"sessionId": "1", "value": {"sessionId": [1, "]"]}}', result)
+
+    def test_session_id_added_when_missing(self):
+        from core.utils.json_stream import set_session_id
+        self.assertEqual({"sessionId": 1, "status": 0},
+                         json.loads(set_session_id('{"status": 0}', 1)))
+        self.assertEqual({"sessionId": "1"},
+                         json.loads(set_session_id(' {} ', "1")))
+
+    def test_nested_session_id_kept(self):
+        from core.utils.json_stream import set_session_id
+        result = set_session_id(
+            '{"value": {"sessionId": "2"}, "sessionId": "3"}', "1")
+        self.assertEqual({"value": {"sessionId": "2"}, "sessionId": "1"},
+                         json.loads(result))
+
+    def test_set_session_id_of_not_an_object(self):
+        from core.utils.json_stream import set_session_id
+        self.assertRaises(ValueError, set_session_id, '[1, 2]', "1")
+
+    def test_big_document_rewritten_by_scanner(self):
+        from core.utils.json_stream import set_session_id, SMALL_DOCUMENT
+        for body in (self.document, json.dumps({"value": "a" * 10})):
+            body = body.replace('"value": ', '"value": %s' % (
+                " " * SMALL_DOCUMENT))
+            expected = json.loads(body)
+            expected["sessionId"] = 2
+            self.assertEqual(expected, json.loads(set_session_id(body, 2)))
+
+    def test_session_id_replaced_only_if_present(self):
+        from core.utils.json_stream import replace_session_id
+        self.assertEqual({"sessionId": 2, "status": 0}, json.loads(
+            replace_session_id('{"sessionId": "a", "status": 0}', 2)))
+        for body in ('{"status": 0}', '[1, 2]', '<html></html>'):
+            self.assertEqual(body, replace_session_id(body, 2))
@@ -10,6 +10,18 @@ def custom_wait(self, method):
     self.checking = False
 
 
+def servers_of(pool, **attrs):
+    """ servers.list replacement returning a server for every clone """
+    def list_servers(search_opts=None):
+        servers = []
+        for vm in list(pool.using) + list(pool.pool):
+            server = Mock(**attrs)
+            server.name = vm.name
+            servers.append(server)
+        return servers
+    return list_servers
+
+
 @patch(
     'vmpool.virtual_machines_pool.VirtualMachinesPool.can_produce',
     new=Mock(return_value=True)
@@ -93,6 +105,30 @@ class TestOpenstackClone(BaseTestCase):
         self.assertTrue(self.app.pool.using[0].ready)
         self.assertEqual(len(self.app.pool.using), 1)
 
+    @patch.multiple(
+        'vmpool.clone.OpenstackClone',
+        _wait_for_activated_service=custom_wait
+    )
+    def test_clients_and_metadata_shared_by_clones(self):
+        """
+        - create two clones
+        - reload platforms
+
+        Expected: one client, image looked up once, cache cleared on reload
+        """
+        from core.utils import openstack_utils
+        with patch('core.utils.openstack_utils.nova_client') as nova:
+            self.app.pool.add(self.platform)
+            self.app.pool.add(self.platform)
+
+            self.assertEqual(1, nova.call_count)
+            self.assertEqual(1, nova.return_value.images.find.call_count)
+            self.assertEqual(1, nova.return_value.flavors.find.call_count)
+            self.assertEqual(2, nova.return_value.servers.create.call_count)
+
+        self.app.platforms.cleanup()
+        self.assertEqual({}, openstack_utils.cache.values)
+
     def test_exception_during_creation_vm(self):
         """
         - call OpenstackClone.create()
@@ -439,11 +475,82 @@ class TestOpenstackClone(BaseTestCase):
         Expected: vm has been created
         """
         with patch('core.utils.openstack_utils.nova_client') as nova:
-            nova.return_value = Mock(servers=Mock(find=Mock(
-                return_value=Mock(status=Mock(lower=Mock(
-                    side_effect=['build', 'active']))))))
+            nova.return_value = Mock(servers=Mock(list=Mock(
+                side_effect=servers_of(self.app.pool, status=Mock(lower=Mock(
+                    side_effect=['build', 'active'])))))
+            )
             self.app.pool.add(self.platform)
+            wait_for(lambda: self.app.pool.using[0].ready is True)
             self.assertEqual(self.app.pool.count(), 1)
+            self.assertEqual(2, nova.return_value.servers.list.call_count)
+
+    @patch.multiple(
+        'vmpool.clone.OpenstackClone',
+        get_ip=Mock(__name__='get_ip'),
+        ping_vm=Mock(return_value=True)
+    )
+    def test_servers_status_listed_once_for_all_clones(self):
+        """
+        - create two clones at once
+        - servers become active
+
+        Expected: clones are ready, statuses came from servers.list only
+        """
+        from core.utils import openstack_utils
+        before = openstack_utils.counters.info.get("nova", {}).get(
+            "servers.list", 0)
+
+        with patch('core.utils.openstack_utils.nova_client') as nova:
+            servers_list = Mock(side_effect=servers_of(
+                self.app.pool, status='ACTIVE', addresses={}))
+            nova.return_value = Mock(servers=Mock(list=servers_list))
+            self.app.pool.add(self.platform)
+            self.app.pool.add(self.platform)
+            wait_for(lambda: all(vm.ready for vm in self.app.pool.using))
+
+            servers = nova.return_value.servers
+            self.assertTrue(all(vm.ready for vm in self.app.pool.using))
+            self.assertFalse(servers.find.called)
+            servers.list.assert_called_with(search_opts={"name": "^test_"})
+            self.assertEqual(
+                before + servers.list.call_count,
+                openstack_utils.counters.info["nova"]["servers.list"])
+
+    @patch.multiple(
+        'vmpool.clone.OpenstackClone',
+        get_ip=Mock(__name__='get_ip'),
+        ping_vm=Mock(return_value=True),
+        rebuild=Mock()
+    )
+    def test_failed_servers_listing_is_retried(self):
+        """
+        - create two clones at once
+        - first servers listing fails
+
+        Expected: clones are ready, none of them is rebuilt
+        """
+        from vmpool.clone import OpenstackClone
+        list_servers = servers_of(
+            self.app.pool, status='ACTIVE', addresses={})
+        responses = [Exception("Service unavailable"), None]
+
+        def servers_list(search_opts=None):
+            if responses:
+                error = responses.pop(0)
+                if error is not None:
+                    raise error
+            return list_servers(search_opts)
+
+        with patch('core.utils.openstack_utils.nova_client') as nova:
+            nova.return_value = Mock(servers=Mock(
+                list=Mock(side_effect=servers_list)))
+            self.app.pool.add(self.platform)
+            self.app.pool.add(self.platform)
+            wait_for(lambda: all(vm.ready for vm in self.app.pool.using))
+
+            self.assertTrue(all(vm.ready for vm in self.app.pool.using))
+            self.assertFalse(OpenstackClone.rebuild.called)
+            self.assertLessEqual(2, nova.return_value.servers.list.call_count)
 
     @patch.multiple(
         'vmpool.clone.OpenstackClone',
@@ -489,8 +596,8 @@ class TestOpenstackClone(BaseTestCase):
         Expected: vm has been created
         """
         with patch('core.utils.openstack_utils.nova_client') as nova:
-            nova.return_value = Mock(servers=Mock(find=Mock(
-                return_value=Mock(addresses=Mock(get=Mock(
+            nova.return_value = Mock(servers=Mock(list=Mock(
+                side_effect=servers_of(self.app.pool, addresses=Mock(get=Mock(
                     return_value=[{'addr': '127.0.0.1',
                                    'OS-EXT-IPS-MAC:mac_addr': 'test_mac'}])))))
             )
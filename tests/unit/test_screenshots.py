@@ -0,0 +1,132 @@
+# coding: utf-8
+
+import os
+import time
+import base64
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from PIL import Image
+from helpers import BaseTestCase
+
+
+def png(width, height):
+    image = StringIO()
+    Image.new("RGB", (width, height)).save(image, "PNG")
+    return base64.b64encode(image.getvalue())
+
+
+class TestScreenshotPipeline(BaseTestCase):
+    def setUp(self):
+        from core.config import setup_config
+        setup_config('data/config.py')
+
+        from core.config import config
+        from core.screenshots import ScreenshotPipeline
+        self.screenshots_dir = config.SCREENSHOTS_DIR
+        config.SCREENSHOTS_DIR = self.dir = tempfile.mkdtemp()
+        self.pipeline = ScreenshotPipeline(processes=1)
+        self.pipeline.start()
+
+    def tearDown(self):
+        from core.config import config
+        config.SCREENSHOTS_DIR = self.screenshots_dir
+        self.pipeline.stop()
+        shutil.rmtree(self.dir)
+
+    def test_screenshot_written_without_thumbnail(self):
+        path = self.pipeline.save(png(256, 100))
+        self.pipeline.wait()
+
+        self.assertTrue(path.startswith(os.path.join(self.dir, "store")))
+        self.assertEqual((256, 100), Image.open(path).size)
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(os.path.dirname(path)))
+        self.assertEqual(1, self.pipeline.info["written"])
+        self.assertEqual(0, self.pipeline.info["queue_depth"])
+
+    def test_identical_screenshots_stored_once(self):
+        first = self.pipeline.save(png(256, 100))
+        self.assertEqual(first, self.pipeline.save(png(256, 100)))
+        self.pipeline.wait()
+        os.utime(first, (0, 0))
+        self.assertEqual(first, self.pipeline.save(png(256, 100)))
+        # cleanup keeps a reused screenshot
+        self.assertNotEqual(0, os.path.getmtime(first))
+        self.assertNotEqual(first, self.pipeline.save(png(100, 256)))
+        self.pipeline.wait()
+
+        info = self.pipeline.info
+        self.assertEqual(2, info["written"])
+        self.assertEqual(2, info["deduplicated"])
+        self.assertEqual(2.0, info["dedup_ratio"])
+
+    def test_thumbnail_made_on_first_request(self):
+        path = self.pipeline.save(png(256, 100))
+        self.pipeline.wait()
+
+        thumbnail = self.pipeline.thumbnail(path)
+        self.assertEqual(path.replace(".png", "_thumb.png"), thumbnail)
+        self.assertEqual((128, 50), Image.open(thumbnail).size)
+
+        self.assertEqual(thumbnail, self.pipeline.thumbnail(path))
+        self.assertEqual(1, self.pipeline.info["thumbnails"])
+
+    def test_thumbnails_refused_before_screenshots(self):
+        self.pipeline.depth = self.pipeline.thumbnails_queue_size
+
+        self.assertIsNone(self.pipeline.thumbnail(
+            os.path.join(self.dir, "1.png")))
+        self.assertIsNotNone(self.pipeline.save(png(10, 10)))
+        self.assertEqual(1, self.pipeline.info["thumbnails_dropped"])
+        self.pipeline.depth -= self.pipeline.thumbnails_queue_size
+        self.pipeline.wait()
+
+        self.pipeline.depth = self.pipeline.queue_size
+        self.assertIsNone(self.pipeline.save(png(20, 20)))
+        self.assertEqual(1, self.pipeline.info["dropped"])
+
+    def test_lost_task_given_up(self):
+        self.pipeline.task_timeout = 0.1
+        self.pipeline.writing.add("lost.png")
+        self.pipeline._submit(self.pipeline.queue_size, "written",
+                              time.sleep, (0.5,), writing="lost.png")
+        time.sleep(0.2)
+
+        info = self.pipeline.info
+        self.assertEqual(0, info["queue_depth"])
+        self.assertEqual(1, info["lost"])
+        self.assertNotIn("lost.png", self.pipeline.writing)
+
+        self.pipeline.stop()
+        self.assertEqual(0, self.pipeline.info["queue_depth"])
+        self.assertEqual(0, self.pipeline.info["written"])
+
+    def test_screenshot_transcoded_to_webp(self):
+        from core.screenshots import get_encoding
+        encoding = get_encoding({"format": "webp", "quality": 50})
+        path = self.pipeline.save(png(256, 100), encoding)
+        self.pipeline.wait()
+
+        self.assertTrue(path.endswith(".webp"))
+        self.assertEqual("WEBP", Image.open(path).format)
+
+        thumbnail = self.pipeline.thumbnail(path)
+        self.assertTrue(thumbnail.endswith("_thumb.webp"))
+        self.assertEqual((128, 50), Image.open(thumbnail).size)
+
+    def test_same_image_stored_once_per_encoding(self):
+        from core.screenshots import get_encoding
+        screenshot = png(256, 100)
+        quantized = self.pipeline.save(
+            screenshot, get_encoding({"format": "quantized_png"}))
+        self.pipeline.wait()
+
+        self.assertNotEqual(quantized, self.pipeline.save(screenshot))
+        self.assertEqual("P", Image.open(quantized).mode)
+
+    def test_unknown_encoding(self):
+        from core.screenshots import get_encoding, DEFAULT_ENCODING
+        self.assertEqual(DEFAULT_ENCODING, get_encoding({}))
+        self.assertRaises(ValueError, get_encoding, {"format": "bmp"})
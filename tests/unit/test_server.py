@@ -7,7 +7,7 @@ from mock import Mock, patch, PropertyMock
 from uuid import uuid4
 from threading import Thread
 from multiprocessing.pool import ThreadPool
-from core.config import setup_config, config
+from core.config import setup_config
 from tests.unit.helpers import server_is_up, server_is_down, \
     new_session_request, get_session_request, delete_session_request, \
     vmmaster_label, run_script, request_with_drop, BaseTestCase, \
@@ -404,16 +404,110 @@ class TestSessionWorker(BaseTestCase):
         Expected: session timeouted
         """
 
-        session = Mock()
-        session.timeout = Mock()
-        session.is_active = False
-        session.inactivity = config.SESSION_TIMEOUT + 1
+        session = Mock(id=1, is_active=False, closed=False)
 
-        self.app.sessions.running = Mock(return_value=[session])
         self.worker.start()
-        time.sleep(1)
-        session.timeout.assert_any_call()
-        session.close()
+        self.worker.arm(session, timeout=0.2)
+        wait_for(lambda: session.timeout.called, timeout=2)
+        session.timeout.assert_called_once_with()
+
+    def test_disarmed_timer_does_not_fire(self):
+        """
+        - arm session timer
+        - disarm it before the deadline, arm another session
+        Expected: only the armed session timeouted
+        """
+        session = Mock(id=1, is_active=False, closed=False)
+        other = Mock(id=2, is_active=False, closed=False)
+
+        self.worker.start()
+        self.worker.arm(session, timeout=0.2)
+        self.worker.disarm(session)
+        self.worker.arm(other, timeout=0.4)
+        wait_for(lambda: other.timeout.called, timeout=2)
+
+        self.assertFalse(session.timeout.called)
+        self.assertEqual({}, self.worker.entries)
+
+    def test_stale_timers_are_compacted(self):
+        """
+        - rearm one session timer and disarm timers of many sessions
+        Expected: heap does not grow with the stale timers
+        """
+        session = Mock(id=0, is_active=False, closed=False)
+
+        self.worker.start()
+        for session_id in range(1, 1000):
+            closed = Mock(id=session_id, is_active=False, closed=True)
+            self.worker.arm(session, timeout=60)
+            self.worker.arm(closed, timeout=60)
+            self.worker.disarm(closed)
+
+        self.assertLessEqual(
+            len(self.worker.heap), self.worker.COMPACT_MIN_SIZE + 1)
+        self.assertEqual([0], self.worker.entries.keys())
+
+
+@patch('core.sessions.SessionWorker', Mock())
+class TestSessionsRegistry(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+
+        from core.sessions import Sessions
+        self.sessions = Sessions(Mock())
+
+    @staticmethod
+    def session(session_id, status="waiting", platform="origin_1"):
+        return Mock(id=session_id, status=status, user_id=1,
+                    endpoint_name=None, dc='{}', platform=platform)
+
+    def test_sessions_indexed_by_status_and_platform(self):
+        """
+        - put sessions of two platforms
+        - run one of them, remove another
+        Expected: indexes and counts follow the changes
+        """
+        first, second = self.session(1), self.session(2, platform="other")
+        self.sessions.put(first)
+        self.sessions.put(second)
+        self.assertEqual(2, len(self.sessions.waiting()))
+
+        first.status, first.endpoint_name = "running", "vm_1"
+        self.sessions.reindex(first)
+        self.sessions.remove(second)
+
+        self.assertEqual([first], self.sessions.running())
+        self.assertEqual([], self.sessions.waiting())
+        self.assertEqual([first], self.sessions.find("endpoint", "vm_1"))
+        self.assertEqual({
+            "status": {"running": 1},
+            "platform": {"origin_1": 1},
+            "user": {"1": 1},
+            "endpoint": {"vm_1": 1},
+        }, self.sessions.counts())
+
+    def test_duplicate_session_id(self):
+        """
+        - put a session
+        - put another session with the same id
+        Expected: SessionException, as before the indexes,
+                  the first session stays registered and indexed
+        """
+        from core.exceptions import SessionException
+        first = self.session(1)
+        self.sessions.put(first)
+        self.assertRaises(
+            SessionException, self.sessions.put,
+            self.session(1, status="running", platform="other"))
+
+        self.assertEqual([first], self.sessions.active())
+        self.assertEqual([first], self.sessions.waiting())
+        self.assertEqual({
+            "status": {"waiting": 1},
+            "platform": {"origin_1": 1},
+            "user": {"1": 1},
+            "endpoint": {"None": 1},
+        }, self.sessions.counts())
 
 
 class TestConnectionClose(BaseTestServer):
@@ -799,7 +893,7 @@ class TestSessionSteps(BaseTestServer):
         def raise_exception(*args, **kwargs):
             raise Exception('something ugly happened in make_request')
 
-        def new_vm_mock(arg):
+        def new_vm_mock(*args):
             yield Mock(ip=1)
 
         with patch(
@@ -882,7 +976,7 @@ class TestRunScriptTimeGreaterThenSessionTimeout(BaseTestCase):
         - exception while waiting endpoint
         Expected: session was created, session_step was created
         """
-        def get_vm_mock(arg):
+        def get_vm_mock(*args):
             yield Mock(name="test_vm_1", ip="127.0.0.1")
 
         with patch(
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+import os
+import gzip
+import shutil
+import tempfile
+
+from mock import Mock
+from helpers import BaseTestCase
+
+
+class TestStepBodyLog(BaseTestCase):
+    def setUp(self):
+        from core.config import setup_config, config
+        setup_config('data/config.py')
+
+        self.screenshots_dir = config.SCREENSHOTS_DIR
+        config.SCREENSHOTS_DIR = self.dir = tempfile.mkdtemp()
+        self.steps = []
+
+    def tearDown(self):
+        from core.config import config
+        config.SCREENSHOTS_DIR = self.screenshots_dir
+        shutil.rmtree(self.dir)
+
+    def add_step(self, body):
+        step = Mock(id=len(self.steps) + 1, body=body)
+        self.steps.append(step)
+        return step
+
+    def body_log(self, level=None):
+        from core.step_bodies import StepBodyLog
+        return StepBodyLog(1, level)
+
+    def test_small_bodies_logged_as_is(self):
+        body_log = self.body_log()
+        for _ in range(2):
+            self.assertEqual('{"value": 1}',
+                             body_log.add(self.add_step, '{"value": 1}').body)
+
+    def test_repeated_body_refers_to_first_step(self):
+        from core.config import config
+        body = "a" * config.STEPS_BODY_HASH_MIN_SIZE
+        body_log = self.body_log()
+
+        self.assertEqual(body, body_log.add(self.add_step, body).body)
+        self.assertEqual("[body of %s bytes, same as in step 1]" % len(body),
+                         body_log.add(self.add_step, body).body)
+
+    def test_big_body_spilled_to_file(self):
+        from core.config import config
+        from core.step_bodies import bodies_dir
+        body = "b" * (config.STEPS_BODY_MAX_SIZE + 1)
+
+        step = self.body_log().add(self.add_step, body)
+
+        files = os.listdir(bodies_dir(1))
+        self.assertEqual(1, len(files))
+        path = os.path.join(bodies_dir(1), files[0])
+        self.assertIn(path, step.body)
+        self.assertEqual(body, gzip.open(path).read())
+
+    def test_short_and_none_levels(self):
+        from core.config import config
+        body = "c" * (config.STEPS_BODY_SHORT_SIZE + 10)
+
+        short = self.body_log("short").add(self.add_step, body).body
+        self.assertTrue(short.startswith("c" * config.STEPS_BODY_SHORT_SIZE))
+        self.assertTrue(short.endswith("... [%s bytes]" % len(body)))
+
+        self.assertIsNone(self.body_log("none").add(self.add_step, body).body)
+        self.assertEqual("full", self.body_log("verbose").level)
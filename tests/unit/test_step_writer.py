@@ -0,0 +1,110 @@
+# coding: utf-8
+
+from mock import Mock, MagicMock, patch
+from flask import Flask
+from sqlalchemy.exc import OperationalError, IntegrityError
+
+from core.config import setup_config
+from helpers import BaseTestCase
+
+
+class TestStepWriter(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        from core.db.writer import StepWriter
+
+        self.connection = Mock()
+        engine = MagicMock()
+        engine.begin.return_value.__enter__.return_value = self.connection
+        self.writer = StepWriter(
+            Mock(engine=engine), batch_size=10, flush_interval=60)
+
+        sequence = iter(range(1, 1000))
+        self.fetch_block = patch(
+            'core.db.writer.IdAllocator._fetch_block',
+            Mock(side_effect=lambda: [next(sequence) for _ in range(10)])
+        )
+        self.fetch_block.start()
+
+        self.app = Flask(__name__)
+        self.app.database = Mock(add_step=self.writer.put)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.writer.stop()
+        self.ctx.pop()
+        self.fetch_block.stop()
+
+    def test_ids_are_assigned_before_write(self):
+        from core.db.models import SessionLogStep, SessionLogSubStep
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        sub_step = SessionLogSubStep("GET /url", parent_id=step.id)
+
+        self.assertIsNotNone(step.id)
+        self.assertEqual(step.id, sub_step.session_log_step_id)
+        self.assertTrue(self.writer.is_pending(step))
+        self.assertFalse(self.connection.execute.called)
+
+    def test_flush_writes_one_insert_per_table(self):
+        from core.db.models import SessionLogStep, SessionLogSubStep
+        parent = SessionLogStep("POST /wd/hub/session", session_id=1)
+        self.writer.flush()
+
+        SessionLogSubStep("GET /status", parent_id=parent.id)
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        SessionLogSubStep("GET /url", parent_id=step.id)
+        SessionLogSubStep("200", parent_id=step.id)
+        self.assertEqual(4, self.writer.flush())
+
+        tables = [args[0].table.name
+                  for args, _ in self.connection.execute.call_args_list]
+        self.assertEqual(
+            ["session_log_steps", "session_log_steps", "sub_steps"], tables)
+        self.assertFalse(self.writer.is_pending(step))
+
+    def test_failed_batch_is_kept(self):
+        from core.db.models import SessionLogStep
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        self.connection.execute.side_effect = OperationalError(
+            "INSERT", {}, Exception("connection lost"))
+
+        self.assertRaises(Exception, self.writer.flush)
+        self.assertTrue(self.writer.is_pending(step))
+
+        self.connection.execute.side_effect = None
+        SessionLogStep("GET /wd/hub/session/1/title", session_id=1)
+        self.assertEqual(2, self.writer.flush())
+        self.assertFalse(self.writer.is_pending(step))
+
+    def test_bad_row_is_dropped(self):
+        from core.db.models import SessionLogStep
+
+        def execute(statement):
+            rows = statement.parameters
+            if any(row["control_line"] == "bad" for row in (
+                    rows if isinstance(rows, list) else [rows])):
+                raise IntegrityError("INSERT", {}, Exception("bad row"))
+        self.connection.execute.side_effect = execute
+
+        good = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        bad = SessionLogStep("bad", session_id=1)
+        self.assertEqual(1, self.writer.flush())
+        self.assertFalse(self.writer.is_pending(good))
+        self.assertTrue(self.writer.is_pending(bad))
+
+        for _ in range(self.writer.ROW_ATTEMPTS - 1):
+            self.assertEqual(0, self.writer.flush())
+        self.assertFalse(self.writer.is_pending(bad))
+        self.assertEqual({}, self.writer.attempts)
+
+    def test_written_values_are_committed(self):
+        from core.db import changed_columns
+        from core.db.models import SessionLogStep
+        step = SessionLogStep("GET /wd/hub/session/1/url", session_id=1)
+        self.writer.flush()
+
+        self.assertEqual({}, changed_columns(step))
+        step.screenshot = "/screenshots/1.png"
+        self.assertEqual(
+            {"screenshot": "/screenshots/1.png"}, changed_columns(step))
@@ -0,0 +1,54 @@
+# coding: utf-8
+
+import time
+
+from helpers import BaseTestCase
+
+
+class TestUserCache(BaseTestCase):
+    def setUp(self):
+        from core.config import setup_config
+        setup_config('data/config.py')
+
+        from core.db.cache import UserCache
+        from core.db.models import User
+        self.cache = UserCache(User, ttl=60)
+        self.user = User(id=1, username="user", token="token-1")
+
+    def test_users_cached_by_name_and_id(self):
+        self.assertIsNone(self.cache.get(username="user"))
+        self.cache.put(self.user)
+
+        by_name = self.cache.get(username="user")
+        by_id = self.cache.get(user_id=1)
+        self.assertEqual("token-1", by_name.token)
+        self.assertEqual("user", by_id.username)
+        self.assertEqual({"users": 1, "hits": 2, "misses": 1},
+                         self.cache.info)
+
+    def test_every_get_returns_clean_copy(self):
+        from core.db import changed_columns
+        self.cache.put(self.user)
+
+        first = self.cache.get(username="user")
+        second = self.cache.get(username="user")
+        self.assertIsNot(first, second)
+        self.assertEqual({}, changed_columns(first))
+
+        first.token = "token-2"
+        self.assertEqual({"token": "token-2"}, changed_columns(first))
+        self.assertEqual("token-1", second.token)
+
+    def test_invalidated_user_is_loaded_again(self):
+        self.cache.put(self.user)
+        self.user.token = "token-2"
+        self.cache.invalidate(self.user)
+
+        self.assertIsNone(self.cache.get(username="user"))
+        self.assertIsNone(self.cache.get(user_id=1))
+
+    def test_expired_user_is_loaded_again(self):
+        self.cache.put(self.user)
+        self.cache.by_id[1] = (time.time() - 1, self.cache.by_id[1][1])
+
+        self.assertIsNone(self.cache.get(user_id=1))
@@ -28,6 +28,7 @@ class TestVirtualMachinePool(BaseTestCase):
             self.pool = VirtualMachinesPool()
 
     def tearDown(self):
+        self.pool.preloader.stop()
         with patch(
             'core.utils.delete_file', Mock()
         ):
@@ -55,6 +56,133 @@ class TestVirtualMachinePool(BaseTestCase):
 
         self.assertEqual(2, len(self.pool.using))
 
+    def test_newest_ready_vm_is_taken_first(self):
+        from vmpool import VirtualMachine
+        vms = [self.pool.preload(self.platform),
+               self.pool.preload(self.platform)]
+        newest = max(vms, key=lambda v: (v.created, v.name))
+
+        vm = self.pool.get_by_platform(self.platform)
+
+        self.assertIs(newest, vm)
+        self.assertEqual(VirtualMachine.USING, vm.state)
+        self.assertEqual(VirtualMachine.READY, self.pool.pool[0].state)
+        self.assertEqual(
+            {self.platform: 1}, self.pool.pooled_virtual_machines())
+        self.assertEqual(
+            {self.platform: 1}, self.pool.using_virtual_machines())
+
+    def test_not_ready_vm_is_not_taken(self):
+        from vmpool import VirtualMachine
+        vm = self.pool.preload(self.platform)
+        vm.ready = False
+
+        self.assertFalse(self.pool.has(self.platform))
+        self.assertIsNone(self.pool.get_by_platform(self.platform))
+        self.assertEqual(VirtualMachine.CREATING, vm.state)
+
+        vm.ready = True
+        self.assertIs(vm, self.pool.get_by_platform(self.platform))
+
+    def test_preloader_deficit_for_all_platforms(self):
+        preloaded = config.KVM_PRELOADED
+        config.KVM_PRELOADED = {"test_origin_1": 2, "test_origin_2": 1}
+        try:
+            self.pool.preload(self.platform)
+            need = self.pool.preloader.need_load()
+        finally:
+            config.KVM_PRELOADED = preloaded
+
+        self.assertEqual({"test_origin_1": 1, "test_origin_2": 1}, need)
+        self.assertEqual(
+            {"test_origin_1": 1}, self.pool.info["preloader"]["ready"])
+
+    def test_claimed_and_ondemand_vms_are_not_preloaded(self):
+        preloaded = config.KVM_PRELOADED
+        config.KVM_PRELOADED = {"test_origin_1": 2}
+        try:
+            self.pool.preload(self.platform, "preloaded")
+            self.pool.get_by_platform(self.platform)
+            self.pool.preload(self.platform, "ondemand")
+            need = self.pool.preloader.need_load()
+        finally:
+            config.KVM_PRELOADED = preloaded
+
+        self.assertEqual({"test_origin_1": 2}, need)
+
+    def test_ondemand_builds_go_before_queued_preloads(self):
+        preloader = self.pool.preloader
+        backend = self.pool.platforms.backend(self.platform)
+
+        with patch.object(preloader.workers[backend], "callInThread"), \
+                patch.object(self.pool, "preload", Mock()) as preload:
+            preloader.schedule(self.platform)
+            preloader.schedule(self.platform)
+            preloader.schedule(self.platform, "ondemand")
+            for _ in range(3):
+                preloader.load_next(backend)
+
+        self.assertEqual(["ondemand", "preloaded", "preloaded"],
+                         [call[0][1] for call in preload.call_args_list])
+        self.assertEqual(0, preloader.ondemand[self.platform])
+
+    def test_preloader_stop_does_not_wait_for_hung_build(self):
+        import time
+        from threading import Event
+        building, release = Event(), Event()
+
+        def hung_build(platform, prefix):
+            building.set()
+            release.wait(5)
+
+        with patch.object(self.pool, "preload",
+                          Mock(side_effect=hung_build)), \
+                patch("vmpool.virtual_machines_pool.log") as log:
+            self.pool.preloader.schedule(self.platform)
+            self.assertTrue(building.wait(5))
+            started = time.time()
+            self.pool.preloader.stop(timeout=0.1)
+            stopped_in = time.time() - started
+            release.set()
+
+        self.assertLess(stopped_in, 2)
+        self.assertIn("still running", log.warning.call_args[0][0])
+
+    def test_adaptive_preload_targets(self):
+        from vmpool.virtual_machines_pool import DemandEstimator
+        config.PRELOADER_ADAPTIVE = True
+        config.PRELOADER_ADAPTIVE_WINDOW = 600
+        config.PRELOADER_ADAPTIVE_HEADROOM = 1
+        config.PRELOADER_ADAPTIVE_MIN = 1
+        config.PRELOADER_ADAPTIVE_MAX = 3
+        # class state of the pool, restored by the patch
+        with patch.object(type(self.pool), "demand", DemandEstimator()):
+            for _ in range(20):
+                self.pool.demand.arrived("test_origin_1")
+            self.pool.demand.built("test_origin_1", 60)
+            self.pool.demand.arrived("test_origin_2")
+            self.pool.demand.arrived("unknown_platform")
+
+            self.assertEqual({"test_origin_1": 2, "test_origin_2": 1},
+                             self.pool.preload_targets())
+            targets = self.pool.info["preloader"]["targets"]
+        self.assertEqual(
+            "2.00 sessions/min, build time 60s",
+            targets["test_origin_1"]["reason"])
+        self.assertIn("minimum", targets["test_origin_2"]["reason"])
+
+    def test_old_arrivals_are_dropped(self):
+        import time
+        from vmpool.virtual_machines_pool import DemandEstimator
+        config.PRELOADER_ADAPTIVE_WINDOW = 600
+        demand = DemandEstimator()
+
+        for _ in range(5):
+            demand.arrived("test_origin_1", time.time() - 601)
+        demand.arrived("test_origin_1")
+
+        self.assertEqual(1, len(demand.arrivals["test_origin_1"]))
+
     def test_vm_preloading(self):
         self.assertEqual(0, len(self.pool.pool))
         self.pool.preload(self.platform)
@@ -107,7 +235,47 @@ class TestVirtualMachinePool(BaseTestCase):
 
         from vmpool.endpoint import get_vm
         for vm in get_vm(desired_caps):
+            if vm is None:
+                continue
             self.assertEqual(vm.platform, config.PLATFORM)
             break
 
         self.ctx.pop()
+
+
+class TestWaitQueue(BaseTestCase):
+    def setUp(self):
+        from vmpool.wait_queue import Waiter, WaitQueue
+        self.queue = WaitQueue()
+        self.first = self.queue.put(Waiter("test_origin_1", name="first"))
+        self.second = self.queue.put(Waiter("test_origin_1", name="second"))
+        self.urgent = self.queue.put(
+            Waiter("test_origin_1", priority=10, name="urgent"))
+        self.other = self.queue.put(Waiter("test_origin_2", name="other"))
+
+    def test_waiters_served_by_priority_then_arrival(self):
+        vms = iter(["vm_1", "vm_2", "vm_3"])
+
+        served = [self.queue.serve_first("test_origin_1", lambda p: next(vms))
+                  for _ in range(3)]
+
+        self.assertEqual([self.urgent, self.first, self.second], served)
+        self.assertEqual("vm_2", self.first.vm)
+        self.assertTrue(self.first.wait(0))
+        self.assertEqual({"test_origin_2": 1}, self.queue.counts())
+
+    def test_waiter_keeps_position_when_put_back(self):
+        self.queue.serve_first("test_origin_1", lambda p: "vm_1")
+        self.queue.serve_first("test_origin_1", lambda p: "vm_2")
+
+        self.queue.put(self.first)
+
+        self.assertEqual(1, self.queue.position(self.first))
+        self.assertEqual(2, self.queue.position(self.second))
+        self.assertIsNone(self.first.vm)
+
+    def test_no_vm_keeps_waiter_in_queue(self):
+        self.assertIsNone(
+            self.queue.serve_first("test_origin_2", lambda p: None))
+        self.assertEqual(1, self.queue.position(self.other))
+        self.assertFalse(self.other.served)
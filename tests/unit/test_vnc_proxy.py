@@ -0,0 +1,241 @@
+# coding: utf-8
+
+import os
+import time
+import socket
+import threading
+from mock import Mock, patch
+from core.config import setup_config, config
+from core.utils import wait_for
+
+from helpers import (vmmaster_server_mock, server_is_up, server_is_down,
+                     BaseTestCase, get_free_port)
+
+
+def client_frame(payload, opcode=0x2, fin=True):
+    """ Masked frame, as clients send them. """
+    from vmmaster.vnc_proxy import frame_header, unmask
+    header = frame_header(opcode, len(payload))
+    mask = os.urandom(4)
+    first = ord(header[0]) if fin else ord(header[0]) & 0x7f
+    header = chr(first) + chr(ord(header[1]) | 0x80) + header[2:]
+    return header + mask + unmask(payload, mask)
+
+
+class TestFrames(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        from vmmaster import vnc_proxy
+        self.vnc_proxy = vnc_proxy
+
+    def test_unmask_is_reversible(self):
+        payload = "vnc" * 1000 + "\x00\xff"
+        masked = self.vnc_proxy.unmask(payload, "\x01\x02\x03\x04")
+
+        self.assertNotEqual(payload, masked)
+        self.assertEqual(
+            payload, self.vnc_proxy.unmask(masked, "\x01\x02\x03\x04"))
+
+    def test_decoder_waits_for_complete_frames(self):
+        decoder = self.vnc_proxy.FrameDecoder()
+        payload = "x" * 300
+        data = client_frame(payload) + client_frame("", opcode=0x9)
+
+        self.assertEqual([], decoder.feed(data[:100]))
+        self.assertEqual([(0x2, payload), (0x9, "")],
+                         decoder.feed(data[100:]))
+        self.assertEqual(0, decoder.size)
+
+    def test_decoder_joins_fragments(self):
+        decoder = self.vnc_proxy.FrameDecoder()
+        # split inside a base64 quad, a ping between the fragments
+        data = client_frame("UkZC", opcode=0x1, fin=False) + \
+            client_frame("ID", opcode=0x0, fin=False) + \
+            client_frame("", opcode=0x9) + \
+            client_frame("Aw==", opcode=0x0)
+
+        frames = []
+        for byte in data:
+            frames.extend(decoder.feed(byte))
+
+        self.assertEqual([(0x9, ""), (0x1, "UkZCIDAw==")], frames)
+
+    def test_decoder_refuses_big_frames(self):
+        decoder = self.vnc_proxy.FrameDecoder(max_size=100)
+
+        self.assertRaises(self.vnc_proxy.FrameTooBig, decoder.feed,
+                          client_frame("x" * 101)[:10])
+        decoder = self.vnc_proxy.FrameDecoder(max_size=100)
+        decoder.feed(client_frame("x" * 60, fin=False))
+        self.assertRaises(self.vnc_proxy.FrameTooBig, decoder.feed,
+                          client_frame("x" * 60, opcode=0x0))
+
+
+class TestVNCProxyReaper(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        from vmmaster.vnc_proxy import VNCProxyResource
+        self.app = Mock()
+        self.resource = VNCProxyResource(self.app)
+
+    def bridge(self, session_id, idle=0):
+        bridge = Mock(last_activity=time.time() - idle)
+        bridge.factory.session_id = session_id
+        self.resource.connecting[session_id] += 1
+        self.resource.opened(bridge)
+        return bridge
+
+    def test_idle_and_orphaned_connections_closed(self):
+        active, idle = self.bridge("1"), self.bridge("1", idle=601)
+        orphaned = self.bridge("2")
+        self.app.sessions.get_active = Mock(
+            side_effect=lambda session_id: Mock() if session_id == "1"
+            else None)
+
+        self.resource.reap()
+        self.resource.reaper.stop()
+
+        self.assertFalse(active.close.called)
+        idle.close.assert_called_once_with(1000)
+        orphaned.close.assert_called_once_with(1000)
+
+
+class TestVNCProxy(BaseTestCase):
+    def setUp(self):
+        setup_config('data/config.py')
+        self.host = "localhost"
+        self.port = config.PORT
+        self.address = (self.host, self.port)
+        self.vmmaster = vmmaster_server_mock(self.port)
+        server_is_up(self.address)
+
+        self.ctx = self.vmmaster.app.app_context()
+        self.ctx.push()
+
+        from core.sessions import Session
+        self.session = Session()
+        self.session.endpoint_ip = self.host
+        self.session.vnc_helper = Mock(port=get_free_port())
+
+    def tearDown(self):
+        self.session.close()
+        self.ctx.pop()
+        self.vmmaster.app.sessions.kill_all()
+        self.vmmaster.app.cleanup()
+        del self.vmmaster
+        server_is_down(self.address)
+
+    def vnc_server(self):
+        """ Echoes everything it gets. """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.session.vnc_helper.port))
+        listener.listen(1)
+
+        def echo():
+            connection = listener.accept()[0]
+            data = connection.recv(1024)
+            while data:
+                connection.sendall(data)
+                data = connection.recv(1024)
+            connection.close()
+            listener.close()
+
+        server = threading.Thread(target=echo)
+        server.start()
+        return server
+
+    def connect(self, session_id, protocols="binary"):
+        client = socket.create_connection(self.address)
+        client.settimeout(5)
+        client.sendall(
+            "GET /vnc/session/%s HTTP/1.1\r\n"
+            "Host: localhost\r\nUpgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+            "Sec-WebSocket-Protocol: %s\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n" % (session_id, protocols))
+        head = ""
+        while "\r\n\r\n" not in head:
+            data = client.recv(1024)
+            if not data:
+                break
+            head += data
+        return client, head
+
+    def test_vnc_bridge(self):
+        server = self.vnc_server()
+        client, head = self.connect(self.session.id)
+
+        client.sendall(client_frame("RFB 003.008\n"))
+        echoed = ""
+        while len(echoed) < 14:
+            echoed += client.recv(1024)
+        client.close()
+        server.join(5)
+
+        self.assertTrue(head.startswith("HTTP/1.1 101"))
+        self.assertIn("s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", head)
+        self.assertIn("Sec-WebSocket-Protocol: binary", head)
+        self.assertEqual("\x82\x0cRFB 003.008\n", echoed[:14])
+        self.assertEqual(12, self.session.proxy_traffic.sent)
+        self.assertTrue(wait_for(
+            lambda: not self.vmmaster.vnc_proxy.info["connections"]))
+
+    def test_vnc_orphaned_connection_closed(self):
+        from nose.twistedtools import reactor
+        server = self.vnc_server()
+        client, head = self.connect(self.session.id)
+        self.assertTrue(wait_for(
+            lambda: self.vmmaster.vnc_proxy.info["connections"]))
+
+        with patch.object(self.vmmaster.app.sessions, "get_active",
+                          Mock(return_value=None)):
+            reactor.callFromThread(self.vmmaster.vnc_proxy.reap)
+            closed = ""
+            data = client.recv(1024)
+            while data:
+                closed += data
+                data = client.recv(1024)
+        client.close()
+        server.join(5)
+
+        self.assertEqual("\x88\x02\x03\xe8", closed)
+        self.assertTrue(wait_for(
+            lambda: not self.vmmaster.vnc_proxy.info["connections"]))
+
+    def test_vnc_frame_too_big(self):
+        config.VNC_PROXY_MAX_FRAME_SIZE = 10
+        server = self.vnc_server()
+        client, head = self.connect(self.session.id)
+
+        client.sendall(client_frame("RFB 003.008\n"))
+        closed = ""
+        data = client.recv(1024)
+        while data:
+            closed += data
+            data = client.recv(1024)
+        client.close()
+        server.join(5)
+
+        self.assertEqual("\x88\x02\x03\xf1", closed)
+        self.assertEqual(0, self.session.proxy_traffic.sent)
+
+    def test_vnc_connections_limit(self):
+        config.VNC_PROXY_SESSION_MAX_CONNECTIONS = 0
+        client, head = self.connect(self.session.id)
+        client.close()
+
+        self.assertTrue(head.startswith("HTTP/1.1 503"))
+
+    def test_vnc_unknown_session(self):
+        client, head = self.connect(self.session.id + 1000)
+        client.close()
+
+        self.assertTrue(head.startswith("HTTP/1.1 404"))
+
+    def test_vnc_unsupported_protocol(self):
+        client, head = self.connect(self.session.id, protocols="chat")
+        client.close()
+
+        self.assertTrue(head.startswith("HTTP/1.1 400"))
@@ -33,9 +33,11 @@ def status():
     return render_json({
         'node': helpers.get_node_info(),
         'sessions': helpers.get_sessions(),
+        'sessions_counts': current_app.sessions.counts(),
         'queue': helpers.get_queue(),
         'platforms': vmpool_helpers.get_platforms(),
-        'pool': vmpool_helpers.get_pool()
+        'pool': vmpool_helpers.get_pool(),
+        'screenshots': current_app.screenshots.info
     })
 
 
@@ -125,6 +127,15 @@ def get_screenshot_for_log_step(session_id, log_step_id):
     })
 
 
+@api.route(
+    '/session/<string:session_id>/step/<string:log_step_id>/thumbnail',
+    methods=['GET']
+)
+def get_thumbnail_for_log_step(session_id, log_step_id):
+    thumbnail, code = helpers.get_thumbnail(session_id, log_step_id)
+    return render_json({'thumbnail': thumbnail}, code)
+
+
 @api.route('/session/<int:session_id>/label/<int:label_id>/screenshots',
            methods=['GET'])
 def get_screenshots_for_label(session_id, label_id):
@@ -139,15 +150,11 @@ def get_vnc_info(session_id):
 
     _session = helpers.get_session(session_id)
     if _session and _session.endpoint_ip:
-        if _session.vnc_helper.proxy:
-            result, code = (
-                {'vnc_proxy_port': _session.vnc_helper.get_proxy_port()}, 200
-            )
-        else:
-            _session.vnc_helper.start_proxy()
-            result, code = (
-                {'vnc_proxy_port': _session.vnc_helper.get_proxy_port()}, 200
-            )
+        # websocket of the vnc proxy of the vmmaster server
+        result, code = {
+            'vnc_proxy_port': config.PORT,
+            'vnc_proxy_path': '/vnc/session/%s' % session_id
+        }, 200
 
     return render_json(result=result, code=code)
 
@@ -24,9 +24,20 @@ def get_sessions():
 
 
 def get_queue():
+    waiters = dict((waiter["session_id"], waiter)
+                   for waiter in current_app.pool.queue_info())
     queue = list()
     for session in current_app.sessions.waiting():
-        queue.append(session.info)
+        info = session.info
+        waiter = waiters.get(session.id)
+        if waiter:
+            info["queue"] = {
+                "position": waiter["position"],
+                "priority": waiter["priority"],
+                "waiting": waiter["waiting"],
+                "estimated_wait": waiter["estimated_wait"],
+            }
+        queue.append(info)
     return queue
 
 
@@ -56,6 +67,19 @@ def get_screenshots(session_id, log_step_id=None):
     return sorted(screenshots)
 
 
+def get_thumbnail(session_id, log_step_id):
+    """ Thumbnail is made on the first request of it. """
+    log_step = current_app.database.get_step_by_id(log_step_id)
+    if not log_step or str(log_step.session_id) != str(session_id) or \
+            not log_step.screenshot:
+        return None, 404
+
+    thumbnail = current_app.screenshots.thumbnail(log_step.screenshot)
+    if thumbnail is None:
+        return None, 503
+    return thumbnail, 200
+
+
 def get_screenshots_for_label(session_id, label_id):
     steps_groups = {}
     current_label = 0
@@ -2,6 +2,7 @@
 
 import logging
 from uuid import uuid1
+from datetime import datetime, timedelta
 from flask import json, Flask
 from core.config import config
 
@@ -19,9 +20,12 @@ class Vmmaster(Flask):
     def __init__(self, *args, **kwargs):
         from core.db import Database
         from core.sessions import Sessions
+        from core.screenshots import ScreenshotPipeline
         from vmpool.virtual_machines_pool import VirtualMachinesPool
 
         super(Vmmaster, self).__init__(*args, **kwargs)
+        self.screenshots = ScreenshotPipeline()
+        self.screenshots.start()
         self.running = True
         self.uuid = str(uuid1())
         self.database = Database()
@@ -29,6 +33,16 @@ class Vmmaster(Flask):
         self.sessions = Sessions(self)
         self.json_encoder = JSONEncoder
         self.register()
+        if config.PRELOADER_ADAPTIVE:
+            self.seed_demand()
+
+    def seed_demand(self):
+        since = datetime.now() - timedelta(
+            seconds=config.PRELOADER_ADAPTIVE_WINDOW)
+        try:
+            self.pool.demand.seed(self.database.get_session_arrivals(since))
+        except Exception as e:
+            log.exception("Can't load recent sessions demand: %s" % e)
 
     def register(self):
         self.database.register_platforms(self.uuid, self.pool.platforms.info())
@@ -37,10 +51,15 @@ class Vmmaster(Flask):
         self.database.unregister_platforms(self.uuid)
 
     def cleanup(self):
+        from core.sessions import stop_upstream_pool
+
         log.info("Shutting down...")
         self.pool.preloader.stop()
         self.sessions.worker.stop()
         self.pool.free()
+        self.screenshots.stop()
+        self.database.step_writer.stop()
+        stop_upstream_pool()
         self.unregister()
         self.pool.platforms.cleanup()
         log.info("Server gracefully shut down.")
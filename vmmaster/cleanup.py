@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import os
+import time
 import logging
 from datetime import datetime, timedelta
 
@@ -9,9 +10,10 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import ArgumentError
 
 from core.config import config, setup_config
-from core.db.models import Session, User
+from core.db.models import Session, SessionLogStep, User
 from core.utils import change_user_vmmaster
 from core.utils.init import home_dir
+from core.screenshots import thumbnail_path
 
 from shutil import rmtree
 from errno import ENOENT
@@ -48,6 +50,44 @@ def delete_files(session=None):
                          (str(session_dir), os_error.strerror))
 
 
+@transaction
+def get_screenshots(session, dbsession=None):
+    return [path for (path,) in dbsession.query(SessionLogStep.screenshot).
+            filter(SessionLogStep.session_id == session.id,
+                   SessionLogStep.screenshot.isnot(None)).distinct()]
+
+
+@transaction
+def is_screenshot_referenced(path, dbsession=None):
+    return dbsession.query(SessionLogStep.id).\
+        filter_by(screenshot=path).first() is not None
+
+
+def is_screenshot_used_lately(path):
+    """ Log steps of a screenshot written or reused by the server
+        may be not in the database yet. """
+    try:
+        return time.time() - os.path.getmtime(path) < \
+            config.SCREENSHOTS_CLEANUP_GRACE_PERIOD
+    except OSError:
+        return False
+
+
+def delete_screenshots(paths):
+    """ Stored screenshots are shared by sessions, a file is deleted
+        when no log step refers to it anymore. """
+    for path in paths:
+        if is_screenshot_referenced(path) or is_screenshot_used_lately(path):
+            continue
+        for file_path in (path, thumbnail_path(path)):
+            try:
+                os.remove(file_path)
+            except OSError as os_error:
+                if os_error.errno != ENOENT:
+                    log.info('Unable to delete %s (%s)' %
+                             (file_path, os_error.strerror))
+
+
 @transaction
 def delete(session, dbsession=None):
     dbsession.delete(session)
@@ -71,8 +111,10 @@ def delete_session_data(sessions=None, ):
                 log.info("Done: %s%% (%d / %d)" %
                          (percentage.rjust(5), num + 1, sessions_count))
                 checkpoint = datetime.now()
+            screenshots = get_screenshots(session)
             delete_files(session)
             delete(session)
+            delete_screenshots(screenshots)
         log.info(
             "%s sessions have been deleted.\n" % (str(sessions_count)))
     else:
@@ -1,20 +1,75 @@
+import logging
+
 from twisted.internet import reactor, protocol
+from twisted.internet.defer import CancelledError
 from twisted.web.resource import Resource
-from twisted.web.http import HTTPChannel, HTTPClient, Request
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer
+from twisted.web.client import ResponseDone
+from twisted.web.http import HTTPChannel, Request, PotentialDataLoss
+from twisted.web.http_headers import Headers
 from twisted.web.server import NOT_DONE_YET
 
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+# not forwarded, they are about a single connection
+HOP_BY_HOP_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade"
+))
+BODY_METHODS = ("POST", "PUT", "PATCH")
+
+
+def forwarded_headers(headers, skip=()):
+    result = Headers()
+    for name, values in headers.getAllRawHeaders():
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in skip:
+            result.setRawHeaders(name, values)
+    return result
+
+
+class Traffic(object):
+    """ Bytes proxied for a session, counted in the reactor thread. """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.tunnels = 0
+
+    @property
+    def info(self):
+        return {"sent": self.sent, "received": self.received,
+                "tunnels": self.tunnels}
+
 
 class HTTPChannelWithClient(HTTPChannel):
+    """ HTTP channel which becomes a raw tunnel after an upgrade. """
     requestFactory = Request
 
     def __init__(self):
         HTTPChannel.__init__(self)
         self.client = None
+        self.pending = None
+
+    def upgrade(self):
+        """ Stops parsing HTTP, bytes received until the tunnel
+            is connected are kept for it. """
+        self.pending = [self.clearLineBuffer()]
+
+    def tunnel(self, client):
+        """ Bytes of the client go to the tunnel from now on,
+            returns the ones received before. """
+        pending, self.pending = self.pending or [], None
+        self.client = client
+        return [data for data in pending if data]
 
     # Client => Proxy
     def dataReceived(self, data):
         if self.client:
             self.client.write(data)
+        elif self.pending is not None:
+            self.pending.append(data)
         else:
             HTTPChannel.dataReceived(self, data)
 
@@ -22,68 +77,113 @@ class HTTPChannelWithClient(HTTPChannel):
     def write(self, data):
         self.transport.write(data)
 
+    def connectionLost(self, reason):
+        if self.client:
+            self.client.transport.unregisterProducer()
+            self.client.transport.loseConnection()
+        HTTPChannel.connectionLost(self, reason)
+
+
+class Tunnel(protocol.Protocol):
+    """ Upgraded connection of a client channel to an endpoint port.
+        Bytes are forwarded as they are received, every transport
+        produces for the other one, so the slower side pauses
+        the faster one instead of buffering in the proxy. """
 
-class ClientProtocol(HTTPClient):
-    def __init__(self, factory, command, rest, version, headers, data):
+    def __init__(self, factory):
         self.factory = factory
-        self.command = command
-        self.rest = rest
-        self.headers = headers
-        self.data = data
-        self.version = version
+        self.channel = factory.request.channel
+        self.traffic = factory.traffic
 
     def connectionMade(self):
-        self.factory.server.client = self
-        self.sendCommand(self.command, self.rest, self.version)
-        for header, value in self.headers.items():
-            self.sendHeader(header, value)
-        self.endHeaders()
-        self.write(self.data)
-
-    def sendCommand(self, command, path, version):
-        self.transport.writeSequence(
-            [command, b' ', path, b' ', version, '\r\n'])
-
-    # Server => Proxy
-    def dataReceived(self, data):
-        self.factory.server.write(data)
+        self.traffic.tunnels += 1
+        head = [self.factory.head] + self.channel.tunnel(self)
+        self.traffic.sent += sum(len(data) for data in head)
+        self.transport.writeSequence(head)
+
+        self.transport.registerProducer(self.channel.transport, True)
+        self.channel.transport.registerProducer(self.transport, True)
 
-    # Proxy => Server
+    # Client => Proxy => Server
     def write(self, data):
-        if data:
-            self.transport.write(data)
+        self.traffic.sent += len(data)
+        self.transport.write(data)
 
+    # Server => Proxy => Client
+    def dataReceived(self, data):
+        self.traffic.received += len(data)
+        self.channel.write(data)
 
-class ClientFactory(protocol.ClientFactory):
-    protocol = ClientProtocol
+    def connectionLost(self, reason):
+        self.traffic.tunnels -= 1
+        self.channel.transport.unregisterProducer()
+        self.channel.transport.loseConnection()
 
-    def __init__(self, request, rest):
-        headers = request.getAllHeaders().copy()
-        request.content.seek(0, 0)
-        s = request.content.read()
+
+class TunnelFactory(protocol.ClientFactory):
+    protocol = Tunnel
+
+    def __init__(self, request, head, traffic):
         self.request = request
-        self.method = request.method
-        self.rest = rest
-        self.headers = headers
-        self.data = s
-        self.version = request.clientproto
+        self.head = head
+        self.traffic = traffic
 
     def buildProtocol(self, addr):
-        return self.protocol(
-            self,
-            self.method, self.rest, self.version,
-            self.headers,
-            self.data)
+        return self.protocol(self)
 
     def clientConnectionFailed(self, connector, reason):
+        self.request.setResponseCode(502)
         self.request.write(
             "Request forwarding failed:\n" + reason.getErrorMessage())
         self.request.finish()
+        self.request.channel.transport.loseConnection()
+
+
+class ResponseStreamer(protocol.Protocol):
+    """ Writes the upstream response body to the client as it arrives.
+        The upstream connection produces for the client connection,
+        it is paused while the client doesn't keep up. """
+
+    def __init__(self, request, traffic):
+        self.request = request
+        self.traffic = traffic
+        self.client_lost = False
+
+    def connectionMade(self):
+        self.request.notifyFinish().addErrback(self._client_lost)
+        self.request.registerProducer(self.transport, True)
+
+    def _client_lost(self, failure):
+        self.client_lost = True
+        self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.traffic.received += len(data)
+        if not self.client_lost:
+            self.request.write(data)
+
+    def connectionLost(self, reason):
+        if self.client_lost:
+            return
+        self.request.unregisterProducer()
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.request.finish()
+        else:
+            log.warning("Proxied response of %s is broken: %s" %
+                        (self.request.uri, reason.getErrorMessage()))
+            self.request.loseConnection()
 
 
 class ProxyResource(Resource):
+    """ Proxies requests to ports of session endpoints. Bodies are
+        streamed, upstream connections are kept alive in a pool
+        for every session. Upgrade requests (websockets of devtools
+        or noVNC, for example) become raw tunnels. Proxied bytes
+        are counted in proxy_traffic of the session. """
+
     def __init__(self, app):
         self.app = app
+        self.pools = {}
 
     isLeaf = True
 
@@ -97,6 +197,92 @@ class ProxyResource(Resource):
             dest += "/"
         return session_id, port, dest
 
+    def get_session(self, session_id):
+        session = self.app.sessions.get_active(session_id)
+        if session is None:
+            # raises with the reason the session is not active
+            with self.app.app_context():
+                session = self.app.sessions.get_session(session_id)
+        return session
+
+    @staticmethod
+    def get_traffic(session):
+        if session.proxy_traffic is None:
+            session.proxy_traffic = Traffic()
+        return session.proxy_traffic
+
+    def get_pool(self, session_id):
+        pool = self.pools.get(session_id)
+        if pool is None:
+            self.close_pools()
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = config.PROXY_PERSISTENT_CONNECTIONS
+            pool.cachedConnectionTimeout = \
+                config.PROXY_IDLE_CONNECTION_TIMEOUT
+            self.pools[session_id] = pool
+        return pool
+
+    def close_pools(self):
+        """ Closes connections of sessions which are not active. """
+        for session_id in list(self.pools):
+            if self.app.sessions.get_active(session_id) is None:
+                self.pools.pop(session_id).closeCachedConnections()
+
+    def tunnel(self, request, session, port, path):
+        """ Sends the upgrade request as it is, with the endpoint
+            as host, the connection is a tunnel from then on. """
+        host = session.endpoint_ip
+        headers = request.requestHeaders.copy()
+        headers.setRawHeaders("host", ["%s:%s" % (host, port)])
+        request.content.seek(0, 0)
+        head = "%s /%s %s\r\n%s\r\n%s" % (
+            request.method, path, request.clientproto,
+            "".join("%s: %s\r\n" % (name, value)
+                    for name, values in headers.getAllRawHeaders()
+                    for value in values),
+            request.content.read())
+
+        request.channel.upgrade()
+        reactor.connectTCP(
+            host, port,
+            TunnelFactory(request, head, self.get_traffic(session)),
+            timeout=config.PROXY_CONNECT_TIMEOUT)
+
+    def forward(self, request, session, port, dest):
+        traffic = self.get_traffic(session)
+        body = None
+        if request.method in BODY_METHODS:
+            # twisted spools big request bodies to a temporary file
+            request.content.seek(0, 2)
+            traffic.sent += request.content.tell()
+            request.content.seek(0, 0)
+            body = FileBodyProducer(request.content)
+
+        agent = Agent(reactor, pool=self.get_pool(str(session.id)),
+                      connectTimeout=config.PROXY_CONNECT_TIMEOUT)
+        d = agent.request(
+            request.method,
+            "http://%s:%s/%s" % (session.endpoint_ip, port, dest),
+            forwarded_headers(request.requestHeaders, skip=("host",)), body)
+        request.notifyFinish().addErrback(lambda failure: d.cancel())
+        d.addCallback(self.respond, request, traffic)
+        d.addErrback(self.failed, request)
+
+    def respond(self, response, request, traffic):
+        request.setResponseCode(response.code, response.phrase)
+        for name, values in \
+                forwarded_headers(response.headers).getAllRawHeaders():
+            request.responseHeaders.setRawHeaders(name, values)
+        response.deliverBody(ResponseStreamer(request, traffic))
+
+    def failed(self, failure, request):
+        if failure.check(CancelledError):
+            return
+        request.setResponseCode(502)
+        request.write(
+            "Request forwarding failed:\n" + failure.getErrorMessage())
+        request.finish()
+
     def process(self, request):
         try:
             session_id, port, dest = self._parse_uri(request.uri)
@@ -106,13 +292,13 @@ class ProxyResource(Resource):
                 "make sure you request uri has "
                 "/proxy/session/<session_id>/port/<port_number>/<destination>")
 
-        with self.app.app_context():
-            session = self.app.sessions.get_session(session_id)
-
-        host = session.endpoint_ip
-        client_factory = ClientFactory(request, dest)
-        client_factory.server = request.channel
-        reactor.connectTCP(host, port, client_factory)
+        session = self.get_session(session_id)
+        if request.getHeader("upgrade"):
+            # the path as requested, without a slash added
+            path = request.uri.partition("/port/%s" % port)[2].lstrip("/")
+            self.tunnel(request, session, port, path)
+        else:
+            self.forward(request, session, port, dest)
 
         return NOT_DONE_YET
 
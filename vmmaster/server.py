@@ -14,6 +14,7 @@ from twisted.internet.threads import deferToThread
 
 from app import create_app
 from http_proxy import ProxyResource, HTTPChannelWithClient
+from vnc_proxy import VNCProxyResource
 from core.config import config
 
 log = logging.getLogger(__name__)
@@ -56,7 +57,10 @@ class VMMasterServer(object):
         wsgi_resource = WSGIResource(self.reactor, self.thread_pool, self.app)
 
         root_resource = RootResource(wsgi_resource)
-        root_resource.putChild("proxy", ProxyResource(self.app))
+        self.proxy = ProxyResource(self.app)
+        root_resource.putChild("proxy", self.proxy)
+        self.vnc_proxy = VNCProxyResource(self.app)
+        root_resource.putChild("vnc", self.vnc_proxy)
         site = Site(root_resource)
         site.protocol = HTTPChannelWithClient
         self.bind = self.reactor.listenTCP(port, site)
@@ -70,6 +74,9 @@ class VMMasterServer(object):
 
     def __del__(self):
         d = self.bind.stopListening()
+        # port is closed by a delayed call, reactor may be idle
+        # if we are not in its thread
+        self.reactor.wakeUp()
         _block_on(d, 20)
         self.app.cleanup()
         self.thread_pool.stop()
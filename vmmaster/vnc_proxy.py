@@ -0,0 +1,353 @@
+# coding: utf-8
+
+import time
+import base64
+import struct
+import hashlib
+import binascii
+import logging
+from collections import defaultdict
+
+from twisted.internet import reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from core.config import config
+from vmmaster.http_proxy import Tunnel, TunnelFactory, ProxyResource
+
+log = logging.getLogger(__name__)
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# frame opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xa
+
+# subprotocols of noVNC, the first one offered by the viewer is used
+PROTOCOLS = ("binary", "base64")
+REAP_INTERVAL = 5
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def unmask(payload, mask):
+    """ XOR with the repeated mask, done on the payload as one number. """
+    if not payload:
+        return payload
+    size = len(payload)
+    key = (mask * (size / 4 + 1))[:size]
+    value = int(binascii.hexlify(payload), 16) ^ \
+        int(binascii.hexlify(key), 16)
+    return binascii.unhexlify("%0*x" % (size * 2, value))
+
+
+def frame_header(opcode, size):
+    if size < 126:
+        return struct.pack("!BB", 0x80 | opcode, size)
+    elif size < 0x10000:
+        return struct.pack("!BBH", 0x80 | opcode, 126, size)
+    return struct.pack("!BBQ", 0x80 | opcode, 127, size)
+
+
+class FrameTooBig(Exception):
+    pass
+
+
+class FrameDecoder(object):
+    """ Frames sent by a websocket client, they are masked. Fragments
+        of a message are joined, control frames may come between them.
+        Received data is joined once a frame is complete, not on every
+        read, and frames are parsed at an offset of it. """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or config.VNC_PROXY_MAX_FRAME_SIZE
+        self.chunks = []
+        self.size = 0
+        # bytes to receive before the next frame can be parsed
+        self.needed = 2
+        self.fragments = []
+        self.fragments_opcode = None
+        self.fragments_size = 0
+
+    def feed(self, data):
+        """ Returns (opcode, payload) of every complete message
+            and control frame. Raises FrameTooBig. """
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size < self.needed:
+            return []
+
+        buf, offset = "".join(self.chunks), 0
+        frames = []
+        frame, offset = self._next(buf, offset)
+        while frame is not None:
+            if frame[0] & 0x8:
+                frames.append(frame[:2])
+            else:
+                message = self._join(*frame)
+                if message is not None:
+                    frames.append(message)
+            frame, offset = self._next(buf, offset)
+
+        buf = buf[offset:]
+        self.chunks = [buf] if buf else []
+        self.size = len(buf)
+        return frames
+
+    def _next(self, buf, offset):
+        """ Frame at offset and offset of the next one. """
+        start = offset
+        if len(buf) - start < 2:
+            self.needed = 2
+            return None, start
+        first, second = struct.unpack("!BB", buf[start:start + 2])
+        fin, opcode, size = first & 0x80, first & 0x0f, second & 0x7f
+        offset = start + 2
+        if size == 126:
+            offset += 2
+            if len(buf) < offset:
+                self.needed = offset - start
+                return None, start
+            size = struct.unpack("!H", buf[offset - 2:offset])[0]
+        elif size == 127:
+            offset += 8
+            if len(buf) < offset:
+                self.needed = offset - start
+                return None, start
+            size = struct.unpack("!Q", buf[offset - 8:offset])[0]
+        if size > self.max_size:
+            raise FrameTooBig("Frame of %s bytes" % size)
+
+        mask = None
+        if second & 0x80:
+            mask = buf[offset:offset + 4]
+            offset += 4
+        if len(buf) < offset + size:
+            self.needed = offset + size - start
+            return None, start
+
+        self.needed = 2
+        payload = buf[offset:offset + size]
+        if mask is not None:
+            payload = unmask(payload, mask)
+        return (opcode, payload, fin), offset + size
+
+    def _join(self, opcode, payload, fin):
+        """ Message of data frames, None until its last frame. """
+        if opcode != CONTINUATION:
+            self.fragments, self.fragments_size = [], 0
+            self.fragments_opcode = opcode
+        self.fragments_size += len(payload)
+        if self.fragments_size > self.max_size:
+            raise FrameTooBig("Message of %s bytes" % self.fragments_size)
+        self.fragments.append(payload)
+        if not fin:
+            return None
+
+        message = self.fragments_opcode, "".join(self.fragments)
+        self.fragments, self.fragments_size = [], 0
+        return message
+
+
+class VNCBridge(Tunnel):
+    """ Websocket of a VNC viewer bridged to the VNC server
+        of a session endpoint. """
+
+    def __init__(self, factory):
+        Tunnel.__init__(self, factory)
+        self.subprotocol = factory.subprotocol
+        self.decoder = FrameDecoder()
+        self.last_activity = time.time()
+        self.closing = False
+
+    def connectionMade(self):
+        self.factory.resource.opened(self)
+        self.traffic.tunnels += 1
+        self.channel.write(self.factory.head)
+        pending = self.channel.tunnel(self)
+
+        self.transport.registerProducer(self.channel.transport, True)
+        self.channel.transport.registerProducer(self.transport, True)
+        for data in pending:
+            self.write(data)
+
+    def send(self, opcode, payload):
+        self.channel.transport.writeSequence(
+            [frame_header(opcode, len(payload)), payload])
+
+    def close(self, status):
+        """ Sends a close frame once and closes the connections. """
+        if not self.closing:
+            self.closing = True
+            self.send(CLOSE, struct.pack("!H", status))
+        self.transport.loseConnection()
+
+    # Viewer => Proxy => VNC server
+    def write(self, data):
+        if self.closing:
+            return
+        self.last_activity = time.time()
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooBig as e:
+            log.warning("Closing vnc connection of session %s: %s" %
+                        (self.factory.session_id, e))
+            self.close(1009)
+            return
+
+        for opcode, payload in frames:
+            if opcode in (TEXT, BINARY):
+                if self.subprotocol == "base64":
+                    payload = base64.b64decode(payload)
+                self.traffic.sent += len(payload)
+                self.transport.write(payload)
+            elif opcode == PING:
+                self.send(PONG, payload)
+            elif opcode == CLOSE:
+                self.close(1000)
+
+    # VNC server => Proxy => Viewer
+    def dataReceived(self, data):
+        self.last_activity = time.time()
+        self.traffic.received += len(data)
+        if self.subprotocol == "base64":
+            self.send(TEXT, base64.b64encode(data))
+        else:
+            self.send(BINARY, data)
+
+    def connectionLost(self, reason):
+        self.factory.resource.closed(self)
+        if not self.closing:
+            self.closing = True
+            self.send(CLOSE, struct.pack("!H", 1000))
+        Tunnel.connectionLost(self, reason)
+
+
+class VNCBridgeFactory(TunnelFactory):
+    protocol = VNCBridge
+
+    def __init__(self, request, head, traffic, resource, session_id,
+                 subprotocol):
+        TunnelFactory.__init__(self, request, head, traffic)
+        self.resource = resource
+        self.session_id = session_id
+        self.subprotocol = subprotocol
+
+    def clientConnectionFailed(self, connector, reason):
+        self.resource.connected(self.session_id)
+        TunnelFactory.clientConnectionFailed(self, connector, reason)
+
+
+class VNCProxyResource(Resource):
+    """ Websockets of VNC viewers at /vnc/session/<session_id>, bridged
+        to VNC servers of session endpoints in the reactor. Connections
+        are limited in total and for every session, idle ones and ones
+        of sessions which are not active are closed. """
+
+    isLeaf = True
+
+    def __init__(self, app):
+        Resource.__init__(self)
+        self.app = app
+        self.bridges = defaultdict(set)
+        self.connecting = defaultdict(int)
+        self.reaper = task.LoopingCall(self.reap)
+
+    def count(self, session_id=None):
+        if session_id is not None:
+            return len(self.bridges.get(session_id, ())) + \
+                self.connecting.get(session_id, 0)
+        return sum(len(bridges) for bridges in self.bridges.values()) + \
+            sum(self.connecting.values())
+
+    def connected(self, session_id):
+        self.connecting[session_id] -= 1
+        if not self.connecting[session_id]:
+            del self.connecting[session_id]
+
+    def opened(self, bridge):
+        session_id = bridge.factory.session_id
+        self.connected(session_id)
+        self.bridges[session_id].add(bridge)
+        if not self.reaper.running:
+            self.reaper.start(REAP_INTERVAL, now=False)
+
+    def closed(self, bridge):
+        session_id = bridge.factory.session_id
+        bridges = self.bridges.get(session_id, set())
+        bridges.discard(bridge)
+        if not bridges:
+            self.bridges.pop(session_id, None)
+        if not self.bridges and self.reaper.running:
+            self.reaper.stop()
+
+    def reap(self):
+        idle_since = time.time() - config.VNC_PROXY_IDLE_TIMEOUT
+        for session_id, bridges in self.bridges.items():
+            active = self.app.sessions.get_active(session_id) is not None
+            for bridge in list(bridges):
+                if not active or bridge.last_activity < idle_since:
+                    log.info("Closing %s vnc connection of session %s" %
+                             ("idle" if active else "orphaned", session_id))
+                    bridge.close(1000)
+
+    @property
+    def info(self):
+        return {"connections": self.count(), "sessions": len(self.bridges)}
+
+    @staticmethod
+    def error(request, code, message):
+        request.setResponseCode(code)
+        return message
+
+    def render_GET(self, request):
+        path = [part for part in request.postpath if part]
+        if len(path) != 2 or path[0] != "session":
+            return self.error(request, 404, "Use /vnc/session/<session_id>")
+
+        session_id = path[1]
+        session = self.app.sessions.get_active(session_id)
+        if session is None or not session.vnc_helper:
+            return self.error(
+                request, 404, "There is no active session %s" % session_id)
+
+        key = request.getHeader("sec-websocket-key")
+        if not key or \
+                (request.getHeader("upgrade") or "").lower() != "websocket":
+            return self.error(request, 400, "Websocket upgrade expected")
+
+        if self.count() >= config.VNC_PROXY_MAX_CONNECTIONS or \
+                self.count(session_id) >= \
+                config.VNC_PROXY_SESSION_MAX_CONNECTIONS:
+            return self.error(request, 503, "Too many vnc connections")
+
+        offered = [name.strip() for name in (
+            request.getHeader("sec-websocket-protocol") or "").split(",")]
+        offered = [name for name in offered if name]
+        supported = [name for name in offered if name in PROTOCOLS]
+        if offered and not supported:
+            return self.error(
+                request, 400, "Supported protocols: %s" % ", ".join(PROTOCOLS))
+
+        head = "HTTP/1.1 101 Switching Protocols\r\n" \
+               "Upgrade: websocket\r\nConnection: Upgrade\r\n" \
+               "Sec-WebSocket-Accept: %s\r\n" % accept_key(key)
+        if supported:
+            head += "Sec-WebSocket-Protocol: %s\r\n" % supported[0]
+        head += "\r\n"
+
+        self.connecting[session_id] += 1
+        request.channel.upgrade()
+        reactor.connectTCP(
+            session.endpoint_ip, session.vnc_helper.port,
+            VNCBridgeFactory(request, head, ProxyResource.get_traffic(session),
+                             self, session_id,
+                             supported[0] if supported else None),
+            timeout=config.PROXY_CONNECT_TIMEOUT)
+        return NOT_DONE_YET
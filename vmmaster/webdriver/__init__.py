@@ -4,10 +4,11 @@ from datetime import datetime
 from traceback import format_exc
 from flask import Blueprint, current_app, request, jsonify, g
 
-from vmmaster.webdriver import commands, helpers
+from vmmaster.webdriver import commands, helpers, router
 import helpers
 
 from core.exceptions import SessionException
+from core.sessions import update_log_step
 from core.auth.custom_auth import auth, anonymous
 from core import utils
 
@@ -35,11 +36,18 @@ def handle_errors(error):
     return selenium_error_response("%s %s" % (error, tb))
 
 
+def get_command():
+    """ WebDriver command of the current request. """
+    if not hasattr(request, 'command'):
+        request.command = router.parse(request.method, request.path)
+    return request.command
+
+
 def get_vmmaster_session(request):
     if hasattr(request, 'session'):
         session = request.session
     else:
-        session_id = commands.get_session_id(request.path)
+        session_id = get_command().session_id
 
         try:
             session = current_app.sessions.get_session(session_id)
@@ -64,7 +72,7 @@ def log_request(session, request, created=None):
 @webdriver.before_request
 def before_request():
     g.started = datetime.now()
-    log.debug('%s' % request)
+    log.debug('%s %s' % (request, get_command().type))
     session = get_vmmaster_session(request)
 
     if session:
@@ -72,6 +80,14 @@ def before_request():
 
 
 def log_response(session, response, created=None):
+    streamed_body = getattr(response, "streamed_body", None)
+    if streamed_body is not None:
+        step = session.add_session_step(control_line=response.status_code,
+                                        created=created)
+        streamed_body.on_complete(lambda body: update_log_step(
+            step, message=body.scanner.log_copy, body_log=session.body_log))
+        return
+
     response_data = utils.remove_base64_screenshot(response.data)
     session.add_session_step(control_line=response.status_code,
                              body=response_data, created=created)
@@ -79,16 +95,17 @@ def log_response(session, response, created=None):
 
 @webdriver.after_request
 def after_request(response):
-    log.debug('Response %s %s' % (response.data, response.status_code))
+    if not response.is_streamed:
+        log.debug('Response %s %s' % (response.data, response.status_code))
     session = get_vmmaster_session(request)
-    parts = request.path.split("/")
+    command = get_command()
 
     if session:
         log_request(session, request, created=g.started)
         if not session.closed:
             log_response(session, response, created=datetime.now())
-            if request.method == 'DELETE' and parts[-2] == "session" \
-                    and parts[-1] == str(session.id):
+            if command.type == router.DELETE_SESSION \
+                    and command.session_id == str(session.id):
                 session.succeed()
             else:
                 session.start_timer()
@@ -141,15 +158,11 @@ def get_session(session_id):
 
 
 def take_screenshot(status, body):
-    words = ["url", "click", "execute", "keys", "value"]
-    only_screenshots = ["element", "execute_async"]
-    parts = request.path.split("/")
-    if set(words) & set(parts) or parts[-1] == "session":
-        utils.to_thread(
-            helpers.take_screenshot_from_session(request.session))
-    elif set(only_screenshots) & set(parts) and status == 500:
-        utils.to_thread(
-            helpers.take_screenshot_from_response(request.session, body))
+    source = router.screenshot_source(request.session, get_command(), status)
+    if source == "session":
+        helpers.take_screenshot_from_session(request.session)
+    elif source == "response":
+        helpers.take_screenshot_from_response(request.session, body)
 
 
 @webdriver.route(
@@ -8,10 +8,11 @@ import logging
 
 from traceback import format_exc
 from core import utils
-from core.utils import network_utils
+from core.utils import network_utils, json_stream
 from core.utils import generator_wait_for
 
 from vmmaster.webdriver.helpers import check_to_exist_ip, connection_watcher
+from vmmaster.webdriver.router import parse as parse_command
 
 from core.config import config
 from core.exceptions import CreationException
@@ -182,8 +183,9 @@ def selenium_status(request, session, port):
 
 
 def replace_platform_with_any(request):
-    body = json.loads(request.data)
-    desired_capabilities = body["desiredCapabilities"]
+    """ Copies, the parsed capabilities stay with the session. """
+    body = dict(utils.request_json(request))
+    desired_capabilities = dict(body["desiredCapabilities"])
 
     desired_capabilities["platform"] = u"ANY"
     body["desiredCapabilities"] = desired_capabilities
@@ -192,39 +194,29 @@ def replace_platform_with_any(request):
 
 
 def get_desired_capabilities(request):
-    body = json.loads(request.data)
-    dc = body['desiredCapabilities']
-    return dc
+    return utils.request_json(request)['desiredCapabilities']
 
 
 def get_session_id(path):
-    parts = path.split("/")
-    try:
-        pos = parts.index("session")
-    except ValueError:
-        return None
-    try:
-        session_id = parts[pos + 1]
-    except IndexError:
-        return None
-
-    return session_id
+    return parse_command("GET", path).session_id
 
 
 def set_body_session_id(body, session_id):
     if not body:
         return body
 
-    body = json.loads(body)
-    body["sessionId"] = session_id
-    return json.dumps(body)
+    return json_stream.set_session_id(body, session_id)
 
 
 def set_path_session_id(path, session_id):
-    parts = path.split("/")
-    pos = parts.index("session")
-    parts[pos + 1] = str(session_id)
-    return "/".join(parts)
+    start = path.find("/session/")
+    if start < 0:
+        raise ValueError("No session in path %s" % path)
+    start += len("/session/")
+    end = path.find("/", start)
+    if end < 0:
+        end = len(path)
+    return "%s%s%s" % (path[:start], session_id, path[end:])
 
 
 def take_screenshot(session, port):
@@ -257,16 +249,20 @@ def run_script_through_websocket(script, session, host):
         _t.daemon = True
         _t.start()
 
+    def log_output(_ws):
+        msg = json.dumps({"status": _ws.status, "output": _ws.output})
+        update_log_step(sub_step, message=msg, body_log=session.body_log)
+
     def on_message(_ws, message):
         _ws.output += message
-        if sub_step:
-            msg = json.dumps({"status": _ws.status, "output": _ws.output})
-            update_log_step(sub_step, message=msg)
+        # bigger output would be written to a file on every message,
+        # it is logged once on close
+        if sub_step and len(_ws.output) <= config.STEPS_BODY_MAX_SIZE:
+            log_output(_ws)
 
     def on_close(_ws):
-        if sub_step and ws.output:
-            msg = json.dumps({"status": _ws.status, "output": _ws.output})
-            update_log_step(sub_step, message=msg)
+        if sub_step and _ws.output:
+            log_output(_ws)
         log.info("RunScript: Close websocket on vm %s" % host)
 
     def on_error(_ws, message):
@@ -290,6 +286,7 @@ def run_script_through_websocket(script, session, host):
     t.start()
 
     while t.isAlive():
+        t.join(0.01)
         yield None, None, None
 
     full_msg = json.dumps({"status": ws.status, "output": ws.output})
@@ -1,22 +1,21 @@
 # coding: utf-8
 
-import base64
 import commands
 import json
 import time
 import logging
 
 from functools import wraps
-from flask import Response, request
+from flask import Response, request, current_app, stream_with_context
 
 from core.exceptions import CreationException, ConnectionError, \
     TimeoutException, SessionException
 from core.config import config
 
-from core import utils
-from core.sessions import Session, RequestHelper
+from core import screenshots
+from core.sessions import Session, RequestHelper, StreamedBody
+from core.utils.json_stream import JsonStreamScanner, replace_session_id
 from vmpool import endpoint
-from PIL import Image
 
 log = logging.getLogger(__name__)
 
@@ -52,24 +51,38 @@ def connection_watcher(func):
                 raise TimeoutException(session_timeouted)
             elif session_closed:
                 raise SessionException(session_closed)
-
-            time.sleep(0.01)
         return value
     return wrapper
 
 
+def screenshot_encoding(session):
+    """ Encoding for the user of the session, else for its platform. """
+    user = getattr(session, "user", None)
+    if user is not None and \
+            user.username in config.SCREENSHOTS_USER_ENCODING:
+        settings = config.SCREENSHOTS_USER_ENCODING[user.username]
+    else:
+        settings = config.SCREENSHOTS_PLATFORM_ENCODING.get(
+            session.platform, config.SCREENSHOTS_ENCODING)
+    return screenshots.get_encoding(settings)
+
+
 def save_screenshot(session, screenshot):
     if screenshot:
         log_step = session.current_log_step
-        path = config.SCREENSHOTS_DIR + "/" + str(session.id) + \
-            "/" + str(log_step.id) + ".png"
-        utils.write_file(path, base64.b64decode(screenshot))
-        log_step.screenshot = path
-        log_step.save()
-        make_thumbnail_for_screenshot(path)
+        path = current_app.screenshots.save(
+            screenshot, screenshot_encoding(session))
+        if path:
+            log_step.screenshot = path
+            log_step.save()
 
 
 def take_screenshot_from_response(session, body):
+    if isinstance(body, StreamedBody):
+        body.on_complete(lambda streamed: save_screenshot(
+            session, streamed.scanner.captured_value(("value", "screen"))))
+        return
+
     data = json.loads(body)
     try:
         screenshot = data.get('value', {}).get('screen', None)
@@ -92,32 +105,6 @@ def take_screenshot_from_session(session):
     save_screenshot(session, screenshot)
 
 
-def make_thumbnail_for_screenshot(screenshot_path):
-    screenshot_resize(screenshot_path, 128, postfix="_thumb")
-
-
-def screenshot_resize(screenshot_path, width, height=None, postfix=None):
-    try:
-        img = Image.open(screenshot_path)
-
-        if height:
-            size = width, height
-        else:
-            wpercent = (width / float(img.size[0]))
-            size = width, int((float(img.size[1]) * float(wpercent)))
-
-        if postfix:
-            postfix = "%s.png" % postfix
-        else:
-            postfix = "%sx%s.png" % size
-
-        new_file_path = screenshot_path.split('.png')[0] + postfix
-        img = img.resize(size, Image.ANTIALIAS)
-        img.save(new_file_path, "PNG")
-    except IOError:
-        log.debug("Can\'t resize image '%s'" % screenshot_path)
-
-
 def form_response(code, headers, body):
     """ Send reply to client. """
     if not code:
@@ -126,35 +113,58 @@ def form_response(code, headers, body):
         headers = {
             'Content-Length': len(body)
         }
+    if isinstance(body, StreamedBody):
+        response = Response(response=stream_with_context(body),
+                            status=code, headers=headers.iteritems())
+        response.streamed_body = body
+        return response
     return Response(response=body, status=code, headers=headers.iteritems())
 
 
 def swap_session(req, desired_session):
+    """ Returns original data and path, restoring them is cheaper
+        than swapping back. """
+    original = req.data, req.path
     req.data = commands.set_body_session_id(req.data, desired_session)
     req.path = commands.set_path_session_id(req.path, desired_session)
+    return original
+
+
+def response_scanner(session):
+    """ Streamed responses get the vmmaster session id, screenshots are
+        kept out of the logged copy of the body. """
+    return JsonStreamScanner(
+        replace={("sessionId",): json.dumps(session.id)},
+        capture=[("value", "screen"), ("screenshot",)]
+    )
 
 
 @connection_watcher
 def transparent():
     status, headers, body = None, None, None
-    swap_session(request, request.session.selenium_session)
+    original = swap_session(request, request.session.selenium_session)
     for status, headers, body in request.session.make_request(
         config.SELENIUM_PORT,
         RequestHelper(
             request.method, request.path, request.headers, request.data
-        )
+        ),
+        scanner=response_scanner(request.session)
     ):
         yield status, headers, body
 
-    swap_session(request, str(request.session.id))
+    request.data, request.path = original
+    if body and not isinstance(body, StreamedBody):
+        # buffered responses get the session id streamed ones get
+        body = replace_session_id(body, request.session.id)
+        headers["Content-Length"] = str(len(body))
     yield status, headers, body
 
 
 def vmmaster_agent(command):
     session = request.session
-    swap_session(request, session.selenium_session)
+    original = swap_session(request, session.selenium_session)
     code, headers, body = command(request, session)
-    swap_session(request, session.selenium_session)
+    request.data, request.path = original
     return code, headers, body
 
 
@@ -188,7 +198,7 @@ def get_session():
              (str(session.id), session.name, str(dc)))
     yield session
 
-    for vm in endpoint.get_vm(dc):
+    for vm in endpoint.get_vm(dc, session):
         session.endpoint = vm
         yield session
 
@@ -0,0 +1,121 @@
+# coding: utf-8
+
+import re
+from collections import namedtuple
+
+# command types
+NEW_SESSION = "new_session"
+GET_SESSION = "get_session"
+DELETE_SESSION = "delete_session"
+URL = "url"
+CLICK = "click"
+TOUCH = "touch"
+KEYS = "keys"
+VALUE = "value"
+ATTRIBUTE_VALUE = "attribute_value"
+EXECUTE = "execute"
+EXECUTE_ASYNC = "execute_async"
+ELEMENT = "element"
+ELEMENTS = "elements"
+RUN_SCRIPT = "run_script"
+LABEL = "label"
+OTHER = "other"
+UNKNOWN = "unknown"
+
+SESSION_PATH = re.compile(
+    r"/session(?:/(?P<session_id>[^/]+)(?:/(?P<command>.*?))?)?/?$")
+ELEMENT_ID = r"(?P<element_id>[^/]+)"
+
+# command name routes by the first part of the name, checked in order
+ROUTES = {
+    "url": [(r"url$", URL)],
+    "click": [(r"click$", CLICK)],
+    "touch": [(r"touch/click$", CLICK),
+              (r"touch/.+$", TOUCH)],
+    "keys": [(r"keys$", KEYS)],
+    # w3c execute/async was always screenshotted like execute
+    "execute": [(r"execute(/sync|/async)?$", EXECUTE)],
+    "execute_async": [(r"execute_async$", EXECUTE_ASYNC)],
+    "element": [(r"element/%s/click$" % ELEMENT_ID, CLICK),
+                (r"element/%s/value$" % ELEMENT_ID, VALUE),
+                (r"element/%s/(?:attribute|property)/value$" % ELEMENT_ID,
+                 ATTRIBUTE_VALUE),
+                (r"element/%s(/.*)?$" % ELEMENT_ID, ELEMENT),
+                (r"element$", ELEMENT)],
+    "elements": [(r"elements$", ELEMENTS)],
+    "vmmaster": [(r"vmmaster/runScript$", RUN_SCRIPT),
+                 (r"vmmaster/vmmasterLabel$", LABEL)],
+}
+ROUTES = dict(
+    (first, [(re.compile(pattern), command) for pattern, command in routes])
+    for first, routes in ROUTES.items()
+)
+
+Command = namedtuple("Command", "type session_id element_id name")
+
+
+def parse(method, path):
+    """ WebDriver command of a request, path is parsed once. """
+    match = SESSION_PATH.search(path)
+    if match is None:
+        return Command(UNKNOWN, None, None, None)
+
+    session_id, name = match.group("session_id", "command")
+    if session_id is None:
+        command = NEW_SESSION if method == "POST" else UNKNOWN
+        return Command(command, None, None, None)
+    if not name:
+        command = {"GET": GET_SESSION, "DELETE": DELETE_SESSION}.get(
+            method, OTHER)
+        return Command(command, session_id, None, None)
+
+    for pattern, command in ROUTES.get(name.split("/", 1)[0], ()):
+        route = pattern.match(name)
+        if route:
+            return Command(command, session_id,
+                           route.groupdict().get("element_id"), name)
+    return Command(OTHER, session_id, None, name)
+
+
+# screenshot policies
+ALWAYS = "always"
+ON_ERROR = "on_error"
+NEVER = "never"
+
+# other commands, touch and elements among them, are never screenshotted
+DEFAULT_SCREENSHOT_POLICY = {
+    URL: ALWAYS,
+    CLICK: ALWAYS,
+    KEYS: ALWAYS,
+    VALUE: ALWAYS,
+    ATTRIBUTE_VALUE: ALWAYS,
+    EXECUTE: ALWAYS,
+    EXECUTE_ASYNC: ON_ERROR,
+    ELEMENT: ON_ERROR,
+}
+
+
+def screenshot_policy(session):
+    """ Policy by command type, desired capability screenshotPolicy
+        overrides the defaults, {"element": "never"} for example. """
+    policy = getattr(session, "screenshot_policy", None)
+    if policy is None:
+        policy = dict(DEFAULT_SCREENSHOT_POLICY)
+        overrides = session.capabilities.get("screenshotPolicy")
+        if isinstance(overrides, dict):
+            policy.update(
+                (command, value) for command, value in overrides.items()
+                if value in (ALWAYS, ON_ERROR, NEVER))
+        session.screenshot_policy = policy
+    return policy
+
+
+def screenshot_source(session, command, status):
+    """ Where the screenshot for the command comes from: "session" for
+        a new one, "response" for the one of an error response. """
+    policy = screenshot_policy(session).get(command.type, NEVER)
+    if policy == ALWAYS:
+        return "session"
+    elif policy == ON_ERROR and status == 500:
+        return "response"
+    return None
@@ -5,16 +5,32 @@ from core.dispatcher import dispatcher, Signals
 
 
 class VirtualMachine(object):
+    CREATING = "creating"
+    READY = "ready"
+    USING = "using"
+    DELETING = "deleting"
+
     def __init__(self, name, platform):
         self.name = name
         self.ip = None
         self.mac = None
         self.platform = platform
         self.created = datetime.now()
-        self.ready = False
+        self.built = None
+        self.state = VirtualMachine.CREATING
+        self._ready = False
         self.checking = False
         self.done = False
 
+    @property
+    def ready(self):
+        return self._ready
+
+    @ready.setter
+    def ready(self, value):
+        self._ready = value
+        dispatcher.send(signal=Signals.VIRTUAL_MACHINE_READY, sender=self)
+
     @property
     def info(self):
         return {
@@ -32,3 +48,6 @@ class VirtualMachine(object):
 
     def is_preloaded(self):
         return 'preloaded' in self.name
+
+    def is_ondemand(self):
+        return 'ondemand' in self.name
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import os
 import time
 import netifaces
 import SubnetTree
@@ -12,8 +13,8 @@ from uuid import uuid4
 from threading import Thread
 
 from vmpool import VirtualMachine
+from vmpool.clone_factory import StepTimer
 
-from core import dumpxml
 from core import utils
 from core.exceptions import libvirtError, CreationException
 from core.config import config
@@ -125,14 +126,20 @@ class KVMClone(Clone):
         log.info("Creating kvm clone of {platform}".format(
             platform=self.platform)
         )
-        self.dumpxml_file = self.clone_origin(self.platform)
-        self.define_clone(self.dumpxml_file)
-        self.start_virtual_machine(self.name)
-        self.ip = self.network.get_ip(self.mac)
+        timer = StepTimer()
+        with timer("clone"):
+            self.dumpxml_file = self.clone_origin(self.platform)
+        with timer("define"):
+            self.define_clone(self.dumpxml_file)
+        with timer("start"):
+            self.start_virtual_machine(self.name)
+        with timer("ip"):
+            self.ip = self.network.get_ip(self.mac)
+        self.origin.factory.record(timer)
         self.ready = True
-        log.info("Created kvm {clone} on ip: {ip} with mac: {mac}".format(
-            clone=self.name, ip=self.ip, mac=self.mac)
-        )
+        log.info("Created kvm {clone} on ip: {ip} with mac: {mac} "
+                 "({timings})".format(clone=self.name, ip=self.ip,
+                                      mac=self.mac, timings=timer))
         return self
 
     def rebuild(self):
@@ -150,22 +157,23 @@ class KVMClone(Clone):
             pass
 
     def clone_origin(self, origin_name):
-        self.drive_path = utils.clone_qcow2_drive(origin_name, self.name)
-        origin_dumpxml = minidom.parseString(self.origin.settings)
-        _dumpxml = self.create_dumpxml(origin_dumpxml)
-        clone_dumpxml_file = utils.write_clone_dumpxml(self.name, _dumpxml)
+        factory = self.origin.factory
+        self.drive_path = factory.overlays.take(self.name)
+        self.mac = self.network.get_free_mac()
+        _dumpxml = factory.template.render(
+            name=self.name,
+            uuid=uuid4(),
+            mac=self.mac,
+            disk_file=self.drive_path,
+            interface_source=self.network.bridge_name
+        )
+        clone_dumpxml_file = os.path.join(
+            config.CLONES_DIR, "%s.xml" % self.name)
+        with open(clone_dumpxml_file, "w") as f:
+            f.write(_dumpxml)
 
         return clone_dumpxml_file
 
-    def create_dumpxml(self, clone_xml):
-        dumpxml.set_name(clone_xml, self.name)
-        dumpxml.set_uuid(clone_xml, uuid4())
-        self.mac = self.network.get_free_mac()
-        dumpxml.set_mac(clone_xml, self.mac)
-        dumpxml.set_disk_file(clone_xml, self.drive_path)
-        dumpxml.set_interface_source(clone_xml, self.network.bridge_name)
-        return clone_xml
-
     def define_clone(self, clone_dumpxml_file):
         log.info("Defining from {}".format(clone_dumpxml_file))
         file_handler = open(clone_dumpxml_file, "r")
@@ -217,11 +225,14 @@ class OpenstackClone(Clone):
         self.platform = origin.short_name
 
         from core.utils import openstack_utils
-        self.nova_client = openstack_utils.nova_client()
-        self.network_client = openstack_utils.neutron_client()
+        self.cache = openstack_utils.cache
+        self.poller = openstack_utils.poller
+        self.listing_error = openstack_utils.ServerListingError
+        self.nova_client = self.cache.nova()
+        self.network_client = self.cache.neutron()
 
-        self.network_id = self.get_network_id()
-        self.network_name = self.get_network_name(self.network_id)
+        self.network_id, self.network_name = \
+            self.cache.get("network", self.resolve_network)
 
     def create(self):
         log.info(
@@ -246,8 +257,8 @@ class OpenstackClone(Clone):
     def get_ip(self):
         if self.ip is None:
             try:
-                addresses = self.nova_client.servers.find(
-                    name=self.name).addresses.get(self.network_name, None)
+                addresses = self.poller.server(
+                    self.name).addresses.get(self.network_name, None)
                 if addresses is not None:
                     ip = addresses[0].get('addr', None)
                     self.mac = addresses[0].get('OS-EXT-IPS-MAC:mac_addr',
@@ -274,16 +285,22 @@ class OpenstackClone(Clone):
 
         create_check_retry = 1
         ping_retry = 1
+        listing_retry = 1
 
         while True:
             try:
-                server = self.nova_client.servers.find(name=self.name)
-            except Exception as e:
-                log.exception(
-                    "Can't find vm %s in openstack. Error: %s" %
-                    (self.name, e.message)
-                )
+                server = self.poller.wait(self.name)
+            except self.listing_error as e:
+                # the vm is not rebuilt for a failed listing of all vms,
+                # unless the listings fail for too long
+                if listing_retry <= config_create_check_retry_count:
+                    log.warning("Status of vm %s is unknown: %s" %
+                                (self.name, e))
+                    listing_retry += 1
+                    continue
                 server = None
+            if server is None:
+                log.info("Can't find vm %s in openstack" % self.name)
 
             if server is not None and server.status.lower() in \
                     ('build', 'rebuild'):
@@ -296,22 +313,20 @@ class OpenstackClone(Clone):
                                   "check this VM" % (self.name, p))
 
                 create_check_retry += 1
-                time.sleep(config_create_check_pause)
 
             elif self.vm_has_created():
                 if method is not None:
                     method()
-                if self.ping_vm():
-                    self.ready = True
-                    break
-                if ping_retry > config_ping_retry_count:
-                    p = config_ping_retry_count * config_ping_timeout
-                    log.info("VM %s pings more than %s seconds, "
-                                  "rebuilding VM..." % (self.name, p))
-                    self.rebuild()
-                    break
-
-                ping_retry += 1
+                while not self.ping_vm():
+                    if ping_retry > config_ping_retry_count:
+                        p = config_ping_retry_count * config_ping_timeout
+                        log.info("VM %s pings more than %s seconds, "
+                                      "rebuilding VM..." % (self.name, p))
+                        self.rebuild()
+                        return
+                    ping_retry += 1
+                self.ready = True
+                break
             else:
                 log.info("VM %s has not been created." % self.name)
                 self.rebuild()
@@ -319,11 +334,15 @@ class OpenstackClone(Clone):
 
     @property
     def image(self):
-        return self.nova_client.images.find(name=self.origin.name)
+        return self.cache.image(self.origin)
 
     @property
     def flavor(self):
-        return self.nova_client.flavors.find(name=self.origin.flavor_name)
+        return self.cache.flavor(self.origin)
+
+    def resolve_network(self):
+        network_id = self.get_network_id()
+        return network_id, self.get_network_name(network_id)
 
     def get_network_name(self, network_id):
         if network_id:
@@ -366,14 +385,7 @@ class OpenstackClone(Clone):
             # create new network
 
     def vm_has_created(self):
-        try:
-            server = self.nova_client.servers.find(name=self.name)
-        except Exception as e:
-            log.exception(
-                "An error occurred during addition ip for vm %s: %s" %
-                (self.name, e.message))
-            server = None
-
+        server = self.poller.server(self.name)
         if server is not None:
             if server.status.lower() == 'active':
                 if getattr(server, 'addresses', None) is not None:
@@ -0,0 +1,185 @@
+# coding: utf-8
+
+import os
+import time
+import logging
+
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Lock
+from uuid import uuid4
+from xml.dom import minidom
+from xml.sax.saxutils import escape
+
+from core import dumpxml
+from core import utils
+from core.config import config
+
+log = logging.getLogger(__name__)
+
+
+class CloneTemplate(object):
+    """ Origin settings parsed once. Settings of a clone are made by
+        substituting its values into the serialized template. """
+    fields = ("name", "uuid", "mac", "disk_file", "interface_source")
+
+    def __init__(self, settings):
+        xml = minidom.parseString(settings)
+        dumpxml.set_name(xml, self._marker("name"))
+        dumpxml.set_uuid(xml, self._marker("uuid"))
+        dumpxml.set_mac(xml, self._marker("mac"))
+        dumpxml.set_disk_file(xml, self._marker("disk_file"))
+        dumpxml.set_interface_source(xml, self._marker("interface_source"))
+        self.template = xml.toxml()
+
+    @staticmethod
+    def _marker(field):
+        return "@@%s@@" % field
+
+    def render(self, **values):
+        result = self.template
+        for field in self.fields:
+            result = result.replace(
+                self._marker(field),
+                escape(str(values[field]), {'"': "&quot;"})
+            )
+        return result
+
+
+class OverlayPool(object):
+    """ Spare copy-on-write overlays of an origin drive created in
+        advance, a clone takes one by renaming it. """
+
+    def __init__(self, origin, size):
+        self.origin = origin
+        self.size = size
+        self.spares = deque()
+        self.lock = Lock()
+        self.filling = False
+
+    @staticmethod
+    def path(name):
+        return os.path.join(config.CLONES_DIR, "%s.qcow2" % name)
+
+    def create(self, path):
+        utils.create_qcow2_overlay(self.origin.drive, path)
+
+    def take(self, clone_name):
+        path = self.path(clone_name)
+        with self.lock:
+            spare = self.spares.popleft() if self.spares else None
+
+        if spare:
+            os.rename(spare, path)
+        else:
+            self.create(path)
+
+        self.fill()
+        return path
+
+    def fill(self):
+        with self.lock:
+            if self.filling or len(self.spares) >= self.size:
+                return
+            self.filling = True
+
+        worker = Thread(target=self._fill)
+        worker.daemon = True
+        worker.start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.spares) >= self.size:
+                        break
+                path = self.path("%s-spare-%s" % (
+                    self.origin.name, str(uuid4())[:8]))
+                self.create(path)
+                with self.lock:
+                    keep = len(self.spares) < self.size
+                    if keep:
+                        self.spares.append(path)
+                if not keep:
+                    utils.delete_file(path)
+                    break
+        except Exception as e:
+            log.exception("Can't create spare overlay for %s: %s" %
+                          (self.origin.name, e))
+        finally:
+            with self.lock:
+                self.filling = False
+
+    def clear(self):
+        with self.lock:
+            spares, self.spares = list(self.spares), deque()
+            self.size = 0
+        for spare in spares:
+            utils.delete_file(spare)
+
+    def __len__(self):
+        return len(self.spares)
+
+
+class StepTimer(object):
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def __call__(self, step):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings.append((step, time.time() - start))
+
+    def __str__(self):
+        return ", ".join("%s %.3fs" % timing for timing in self.timings)
+
+
+class KVMCloneFactory(object):
+    """ Prepares everything a KVM clone of an origin needs in advance:
+        parsed settings template and spare drive overlays. """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self._template = None
+        self.overlays = OverlayPool(origin, config.KVM_SPARE_OVERLAYS)
+        self.lock = Lock()
+        self.created = 0
+        self.timings = {}
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = CloneTemplate(self.origin.settings)
+        return self._template
+
+    def prepare(self):
+        self.overlays.fill()
+
+    def record(self, timer):
+        """ Keeps moving averages of the clone creation steps. """
+        with self.lock:
+            self.created += 1
+            for step, seconds in timer.timings:
+                previous = self.timings.get(step)
+                if previous is None:
+                    self.timings[step] = seconds
+                else:
+                    self.timings[step] = 0.8 * previous + 0.2 * seconds
+
+    @property
+    def info(self):
+        with self.lock:
+            timings = dict(
+                (step, round(seconds, 3))
+                for step, seconds in self.timings.items())
+            return {
+                "created": self.created,
+                "spare_overlays": len(self.overlays),
+                "timings": timings,
+            }
+
+    def stop(self):
+        self.overlays.clear()
@@ -1,6 +1,6 @@
 # coding: utf-8
+import time
 import logging
-from core.utils import generator_wait_for
 from core.config import config
 
 from core.exceptions import PlatformException, CreationException
@@ -35,34 +35,41 @@ def get_platform(desired_caps):
     return platform
 
 
-def get_vm(desired_caps):
-    platform = get_platform(desired_caps)
+def get_priority(session):
+    user = getattr(session, "user", None)
+    if user is None:
+        return 0
+    return max(config.QUEUE_USER_PRIORITIES.get(user.username, 0),
+               config.QUEUE_GROUP_PRIORITIES.get(user.group_id, 0))
 
-    vm = None
-    for _ in generator_wait_for(
-        lambda: vm, timeout=config.GET_VM_TIMEOUT
-    ):
-        vm = current_app.pool.get_vm(platform)
-        if vm:
-            break
-
-    if not vm:
-        raise CreationException(
-            "Timeout while waiting for vm with platform %s" % platform
-        )
 
-    yield vm
+def get_vm(desired_caps, session=None):
+    platform = get_platform(desired_caps)
+    current_app.pool.demand.arrived(platform)
 
-    for _ in generator_wait_for(
-        lambda: vm.ready, timeout=config.GET_VM_TIMEOUT
-    ):
-        yield vm
+    waiter = current_app.pool.enqueue(
+        platform,
+        priority=get_priority(session),
+        session_id=getattr(session, "id", None),
+        name=getattr(session, "name", None)
+    )
 
-    if not vm.ready:
-        raise CreationException(
-            'Timeout while building vm %s (platform: %s)' %
-            (vm.name, platform)
-        )
+    vm = None
+    start = time.time()
+    try:
+        while not vm:
+            if waiter.wait(0.1):
+                vm = current_app.pool.claim(waiter)
+            elif time.time() - start > config.GET_VM_TIMEOUT:
+                raise CreationException(
+                    "Timeout while waiting for vm with platform %s" %
+                    platform
+                )
+            else:
+                yield None
+    finally:
+        if not vm:
+            current_app.pool.cancel_waiting(waiter)
 
     log.info('Got vm for request with params: %s' % vm.info)
     yield vm
@@ -5,6 +5,7 @@ import logging
 
 from core.config import config
 from core.utils import openstack_utils
+from vmpool.clone_factory import KVMCloneFactory
 
 UnlimitedCount = type("UnlimitedCount", (), {})()
 log = logging.getLogger(__name__)
@@ -29,6 +30,7 @@ class KVMOrigin(Platform):
         self.name = name
         self.drive = os.path.join(path, 'drive.qcow2')
         self.settings = open(os.path.join(path, 'settings.xml'), 'r').read()
+        self.factory = KVMCloneFactory(self)
 
     @staticmethod
     def make_clone(origin, prefix, pool):
@@ -104,17 +106,17 @@ class KVMPlatforms(PlatformsInterface):
 class OpenstackPlatforms(PlatformsInterface):
     @classmethod
     def limits(cls, if_none):
-        return openstack_utils.nova_client().limits.get().to_dict().get(
+        return openstack_utils.cache.nova().limits.get().to_dict().get(
             'absolute', if_none)
 
     @classmethod
     def flavor_params(cls, flavor_name):
-        return openstack_utils.nova_client().flavors.find(
+        return openstack_utils.cache.nova().flavors.find(
             name=flavor_name).to_dict()
 
     @staticmethod
     def images():
-        return openstack_utils.glance_client().images.list()
+        return openstack_utils.cache.glance().images.list()
 
     @property
     def platforms(self):
@@ -146,10 +148,13 @@ class Platforms(object):
         if config.USE_KVM:
             cls.kvm_platforms = {vm.name: vm for vm in
                                  KVMPlatforms().platforms}
+            for origin in cls.kvm_platforms.values():
+                origin.factory.prepare()
             log.info("KVM platforms: {}".format(
                 cls.kvm_platforms.keys())
             )
         if config.USE_OPENSTACK:
+            openstack_utils.cache.clear()
             cls.openstack_platforms = {vm.short_name: vm for vm in
                                        OpenstackPlatforms().platforms}
             log.info("Openstack platforms: {}".format(
@@ -187,6 +192,13 @@ class Platforms(object):
         if config.USE_OPENSTACK and platform in cls.openstack_platforms.keys():
             return OpenstackPlatforms.get_limit(platform)
 
+    @classmethod
+    def backend(cls, platform):
+        if config.USE_KVM and platform in cls.kvm_platforms.keys():
+            return "kvm"
+        if config.USE_OPENSTACK and platform in cls.openstack_platforms.keys():
+            return "openstack"
+
     @classmethod
     def check_platform(cls, platform):
         if platform in cls.platforms.keys():
@@ -205,13 +217,27 @@ class Platforms(object):
             return [config.PLATFORM]
         return list(cls.platforms.keys())
 
+    @classmethod
+    def clone_factories_info(cls):
+        if not cls.kvm_platforms:
+            return {}
+        return dict((name, origin.factory.info)
+                    for name, origin in cls.kvm_platforms.items())
+
+    @staticmethod
+    def api_calls_info():
+        return openstack_utils.counters.info
+
     @classmethod
     def cleanup(cls):
         if bool(cls.kvm_platforms):
-            for platform in cls.kvm_platforms:
+            for platform, origin in cls.kvm_platforms.items():
+                origin.factory.stop()
                 del cls.platforms[platform]
             cls.kvm_platforms = None
         if bool(cls.openstack_platforms):
             for platform in cls.openstack_platforms:
                 del cls.platforms[platform]
             cls.openstack_platforms = None
+            openstack_utils.poller.stop()
+            openstack_utils.cache.clear()
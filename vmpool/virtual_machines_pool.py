@@ -1,21 +1,234 @@
 # coding: utf-8
 
+import math
 import time
 import logging
-from threading import Thread, Lock
-from collections import defaultdict
+from bisect import bisect_left
+from datetime import datetime
+from threading import Thread, Lock, RLock
+from collections import defaultdict, OrderedDict, deque
+from twisted.python.threadpool import ThreadPool
 
 from core.config import config
 from core.network import Network
+from core.dispatcher import dispatcher, Signals
 
+from vmpool import VirtualMachine
 from vmpool.platforms import Platforms, UnlimitedCount
+from vmpool.wait_queue import Waiter, WaitQueue
 
 log = logging.getLogger(__name__)
 
 
+class VirtualMachinesList(object):
+    """ List of virtual machines with counters by platform, which are
+        maintained on every change, and an optional index of ready
+        machines by platform ordered by creation time. """
+
+    def __init__(self, ready_state, index_ready=False):
+        self.ready_state = ready_state
+        self.index_ready = index_ready
+        self.lock = RLock()
+        self.vms = OrderedDict()
+        self.counts = defaultdict(int)
+        self.ready = defaultdict(list)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.vms.values()))
+
+    def __len__(self):
+        return len(self.vms)
+
+    def __getitem__(self, item):
+        with self.lock:
+            return list(self.vms.values())[item]
+
+    def __contains__(self, vm):
+        return self.vms.get(getattr(vm, "name", None)) is vm
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __str__(self):
+        return str(list(self))
+
+    @staticmethod
+    def _key(vm):
+        return vm.created, vm.name
+
+    def _index(self, vm):
+        if not self.index_ready:
+            return
+        keys = self.ready[vm.platform]
+        key = self._key(vm)
+        position = bisect_left(keys, key)
+        if position == len(keys) or keys[position] != key:
+            keys.insert(position, key)
+
+    def _unindex(self, vm):
+        keys = self.ready.get(vm.platform)
+        if not keys:
+            return
+        key = self._key(vm)
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            del keys[position]
+
+    def _forget(self, vm):
+        del self.vms[vm.name]
+        self.counts[vm.platform] -= 1
+        if not self.counts[vm.platform]:
+            del self.counts[vm.platform]
+
+    def append(self, vm):
+        with self.lock:
+            self.vms[vm.name] = vm
+            self.counts[vm.platform] += 1
+            self.update_state(vm)
+
+    def remove(self, vm):
+        with self.lock:
+            if vm not in self:
+                raise ValueError("%s not in list" % vm.name)
+            self._forget(vm)
+            self._unindex(vm)
+
+    def discard(self, vm):
+        try:
+            self.remove(vm)
+            return True
+        except ValueError:
+            return False
+
+    def update_state(self, vm):
+        with self.lock:
+            if vm not in self:
+                return
+            if vm.ready and not vm.checking:
+                vm.state = self.ready_state
+                self._index(vm)
+            else:
+                vm.state = VirtualMachine.CREATING
+                self._unindex(vm)
+
+    def has_ready(self, platform):
+        return bool(self.ready.get(platform))
+
+    def pop_ready(self, platform):
+        """ Takes the newest ready machine of platform out of the list. """
+        with self.lock:
+            keys = self.ready.get(platform)
+            if not keys:
+                return None
+            created, name = keys.pop()
+            vm = self.vms[name]
+            self._forget(vm)
+            return vm
+
+    def count_by_platform(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def ready_count(self):
+        with self.lock:
+            return dict((platform, len(keys))
+                        for platform, keys in self.ready.items() if keys)
+
+
+class DemandEstimator(object):
+    """ Preload targets from recent session arrival rates and build
+        times of virtual machines: to serve sessions arriving while
+        replacements are being built, a platform needs about
+        rate * build time ready machines in the pool. """
+    default_build_time = 60
+
+    def __init__(self):
+        self.lock = Lock()
+        self.arrivals = defaultdict(deque)
+        self.build_times = {}
+        self.targets = {}
+
+    @staticmethod
+    def _trim(arrivals, now):
+        since = now - config.PRELOADER_ADAPTIVE_WINDOW
+        while arrivals and arrivals[0] < since:
+            arrivals.popleft()
+
+    def arrived(self, platform, timestamp=None):
+        """ Arrivals older than the window are dropped right away,
+            the estimator is fed with adaptive preloading off too. """
+        now = time.time()
+        if timestamp is None:
+            timestamp = now
+        with self.lock:
+            arrivals = self.arrivals[platform]
+            arrivals.append(timestamp)
+            self._trim(arrivals, now)
+
+    def built(self, platform, seconds):
+        with self.lock:
+            previous = self.build_times.get(platform)
+            if previous is None:
+                self.build_times[platform] = seconds
+            else:
+                self.build_times[platform] = 0.8 * previous + 0.2 * seconds
+
+    def seed(self, arrivals):
+        """ Loads arrivals (platform, created) of stored sessions. """
+        for platform, created in sorted(arrivals, key=lambda a: a[1]):
+            self.arrived(platform, time.mktime(created.timetuple()))
+
+    def estimated_build_time(self, platform):
+        with self.lock:
+            return self._build_time(platform)
+
+    def _build_time(self, platform):
+        if platform in self.build_times:
+            return self.build_times[platform]
+        if self.build_times:
+            return sum(self.build_times.values()) / len(self.build_times)
+        return self.default_build_time
+
+    def compute(self, platforms):
+        window = config.PRELOADER_ADAPTIVE_WINDOW
+        lower, upper = \
+            config.PRELOADER_ADAPTIVE_MIN, config.PRELOADER_ADAPTIVE_MAX
+        now = time.time()
+        targets = {}
+
+        with self.lock:
+            for platform in platforms:
+                arrivals = self.arrivals[platform]
+                self._trim(arrivals, now)
+
+                rate = len(arrivals) / float(window)
+                build_time = self._build_time(platform)
+                demand = rate * build_time * config.PRELOADER_ADAPTIVE_HEADROOM
+                target = min(max(int(math.ceil(demand)), lower), upper)
+
+                reason = "%.2f sessions/min, build time %ds" % (
+                    rate * 60, build_time)
+                if target == lower and demand < lower:
+                    reason += ", raised to minimum"
+                elif target == upper and demand > upper:
+                    reason += ", limited to maximum"
+
+                self.targets[platform] = {"target": target, "reason": reason}
+                targets[platform] = target
+        return targets
+
+    @property
+    def info(self):
+        with self.lock:
+            return dict(self.targets)
+
+
 class VirtualMachinesPool(object):
-    pool = list()
-    using = list()
+    demand = DemandEstimator()
+    queue = WaitQueue()
+    pool = VirtualMachinesList(VirtualMachine.READY, index_ready=True)
+    using = VirtualMachinesList(VirtualMachine.USING)
     network = Network()
     lock = Lock()
     platforms = Platforms
@@ -25,21 +238,52 @@ class VirtualMachinesPool(object):
 
     def __init__(self):
         self.platforms()
+        dispatcher.connect(self.update_vm_state,
+                           signal=Signals.VIRTUAL_MACHINE_READY)
         self.preloader = VirtualMachinesPoolPreloader(self)
         self.preloader.start()
 
+    @classmethod
+    def update_vm_state(cls, sender):
+        cls.pool.update_state(sender)
+        cls.using.update_state(sender)
+
+        if sender.ready and sender.built is None:
+            sender.built = datetime.now()
+            cls.demand.built(
+                sender.platform,
+                (sender.built - sender.created).total_seconds())
+
+        if sender.state == VirtualMachine.READY:
+            cls.dispatch(sender.platform)
+
+    @classmethod
+    def preload_targets(cls):
+        platforms = {}
+        if config.USE_KVM:
+            platforms.update(config.KVM_PRELOADED)
+        if config.USE_OPENSTACK:
+            platforms.update(config.OPENSTACK_PRELOADED)
+
+        if not config.PRELOADER_ADAPTIVE:
+            return platforms
+
+        known = set(cls.platforms.platforms.keys())
+        wanted = (set(platforms.keys()) | set(cls.demand.arrivals.keys()))
+        return cls.demand.compute(known & wanted)
+
+    @classmethod
+    def preload_targets_info(cls):
+        if config.PRELOADER_ADAPTIVE:
+            return cls.demand.info
+        return dict((platform, {"target": target, "reason": "configured"})
+                    for platform, target in cls.preload_targets().items())
+
     @classmethod
     def remove_vm(cls, vm):
-        if vm in list(cls.using):
-            try:
-                cls.using.remove(vm)
-            except ValueError:
-                log.warning("VM %s not found in using" % vm.name)
-        if vm in list(cls.pool):
-            try:
-                cls.pool.remove(vm)
-            except ValueError:
-                log.warning("VM %s not found in pool" % vm.name)
+        cls.using.discard(vm)
+        cls.pool.discard(vm)
+        vm.state = VirtualMachine.DELETING
 
     @classmethod
     def add_vm(cls, vm, to=None):
@@ -81,37 +325,25 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def has(cls, platform):
-        for vm in cls.pool:
-            if vm.platform == platform and vm.ready and not vm.checking:
-                return True
-        return False
+        return cls.pool.has_ready(platform)
 
     @classmethod
     def get_by_platform(cls, platform):
-        res = None
-
         with cls.lock:
-            if not cls.has(platform):
+            res = cls.pool.pop_ready(platform)
+            if not res:
                 return None
+            cls.using.append(res)
 
-            for vm in sorted(cls.pool, key=lambda v: v.created, reverse=True):
-                if vm.platform == platform and vm.ready and not vm.checking:
-                    log.info(
-                        "Got VM %s (ip=%s, ready=%s, checking=%s)" %
-                        (vm.name, vm.ip, vm.ready, vm.checking)
-                    )
-                    cls.pool.remove(vm)
-                    cls.using.append(vm)
-                    res = vm
-                    break
-
-        if not res:
-            return None
+        log.info(
+            "Got VM %s (ip=%s, ready=%s, checking=%s)" %
+            (res.name, res.ip, res.ready, res.checking)
+        )
 
         if res.ping_vm():
             return res
         else:
-            cls.using.remove(res)
+            cls.using.discard(res)
             res.delete()
             return None
 
@@ -120,9 +352,7 @@ class VirtualMachinesPool(object):
         # TODO: remove get_by_name
         if _name:
             log.debug('Getting VM: %s' % _name)
-            for vm in cls.pool + cls.using:
-                if vm.name == _name:
-                    return vm
+            return cls.pool.vms.get(_name) or cls.using.vms.get(_name)
 
     @classmethod
     def count_virtual_machines(cls, it):
@@ -134,11 +364,11 @@ class VirtualMachinesPool(object):
 
     @classmethod
     def pooled_virtual_machines(cls):
-        return cls.count_virtual_machines(cls.pool)
+        return cls.pool.count_by_platform()
 
     @classmethod
     def using_virtual_machines(cls):
-        return cls.count_virtual_machines(cls.using)
+        return cls.using.count_by_platform()
 
     @classmethod
     def add(cls, platform, prefix="ondemand", to=None):
@@ -176,18 +406,6 @@ class VirtualMachinesPool(object):
 
         return clone
 
-    @classmethod
-    def get_vm(cls, platform):
-        vm = cls.get_by_platform(platform)
-
-        if vm:
-            return vm
-
-        vm = cls.add(platform)
-
-        if vm:
-            return vm
-
     @classmethod
     def preload(cls, origin_name, prefix=None):
         return cls.add(origin_name, prefix, to=cls.pool)
@@ -196,12 +414,86 @@ class VirtualMachinesPool(object):
     def return_vm(cls, vm):
         cls.using.remove(vm)
         cls.pool.append(vm)
+        cls.dispatch(vm.platform)
+
+    @classmethod
+    def _take_ready(cls, platform):
+        with cls.lock:
+            vm = cls.pool.pop_ready(platform)
+            if vm:
+                cls.using.append(vm)
+            return vm
+
+    @classmethod
+    def dispatch(cls, platform):
+        """ Hands ready machines to waiting sessions in queue order. """
+        while cls.queue.serve_first(platform, cls._take_ready):
+            pass
+
+    def enqueue(self, platform, priority=0, session_id=None, name=None):
+        waiter = self.queue.put(
+            Waiter(platform, priority, session_id, name))
+        self.dispatch(platform)
+        if not waiter.served:
+            self.preloader.build_for_waiters(platform)
+        return waiter
+
+    def claim(self, waiter):
+        """ Returns machine served to waiter. A preloaded machine could
+            stay in the pool for long, so it is checked first, if it is
+            dead waiter is put back to its place in the queue. """
+        vm = waiter.vm
+        if not vm.is_preloaded() or vm.ping_vm():
+            log.info("Got VM %s (ip=%s) for session %s" %
+                     (vm.name, vm.ip, waiter.name))
+            return vm
+
+        self.using.discard(vm)
+        vm.delete()
+        self.queue.put(waiter)
+        self.dispatch(waiter.platform)
+        if not waiter.served:
+            self.preloader.build_for_waiters(waiter.platform)
+        return None
+
+    @classmethod
+    def cancel_waiting(cls, waiter):
+        with cls.queue.lock:
+            if cls.queue.remove(waiter) or waiter.vm is None:
+                return
+            vm, waiter.vm = waiter.vm, None
+
+        if vm.is_preloaded():
+            cls.return_vm(vm)
+        else:
+            cls.using.discard(vm)
+            vm.delete()
+
+    def estimated_wait(self, platform, position):
+        if self.has(platform):
+            return 0
+        concurrency = self.preloader.concurrency(platform)
+        return self.demand.estimated_build_time(platform) * \
+            math.ceil(position / float(concurrency))
+
+    def queue_info(self):
+        now = time.time()
+        return [{
+            "session_id": waiter.session_id,
+            "name": waiter.name,
+            "platform": waiter.platform,
+            "priority": waiter.priority,
+            "position": position,
+            "waiting": now - waiter.enqueued,
+            "estimated_wait": self.estimated_wait(waiter.platform, position),
+        } for position, waiter in self.queue.items()]
 
     @property
     def info(self):
         def print_view(lst):
             return [{"name": l.name, "ip": l.ip,
                      "ready": l.ready, "checking": l.checking,
+                     "state": l.state,
                      "created": l.created} for l in lst]
 
         return {
@@ -214,47 +506,182 @@ class VirtualMachinesPool(object):
                 'list': print_view(self.using),
             },
             "already_use": self.count(),
+            "queue": self.queue.counts(),
+            "preloader": self.preloader.info,
+            "clone_factories": self.platforms.clone_factories_info(),
+            "openstack_api_calls": self.platforms.api_calls_info(),
         }
 
 
+class PreloaderThreadPool(ThreadPool):
+    """ Workers don't keep the process alive if a build hangs
+        on shutdown. """
+
+    def threadFactory(self, *args, **kwargs):
+        thread = Thread(*args, **kwargs)
+        thread.daemon = True
+        return thread
+
+    def signal_stop(self):
+        """ ThreadPool.stop without joining, returns the threads. """
+        self.joined = True
+        self.started = False
+        while self.workers:
+            self.stopAWorker()
+        return list(self.threads)
+
+
 class VirtualMachinesPoolPreloader(Thread):
+    """ Keeps the pool filled up to KVM_PRELOADED / OPENSTACK_PRELOADED.
+        Missing machines of all platforms are created concurrently,
+        with a separate bounded worker pool for every backend.
+        Machines for waiting sessions are built before queued preloads. """
+
     def __init__(self, pool):
         Thread.__init__(self)
         self.running = True
         self.daemon = True
         self.pool = pool
+        self.lock = RLock()
+        self.queued = defaultdict(int)
+        self.creating = defaultdict(int)
+        self.ondemand = defaultdict(int)
+        self.pending = {"ondemand": defaultdict(deque),
+                        "preloaded": defaultdict(deque)}
+        self.workers = {
+            "kvm": PreloaderThreadPool(
+                minthreads=0,
+                maxthreads=config.KVM_PRELOADER_CONCURRENCY,
+                name="preloader-kvm"),
+            "openstack": PreloaderThreadPool(
+                minthreads=0,
+                maxthreads=config.OPENSTACK_PRELOADER_CONCURRENCY,
+                name="preloader-openstack"),
+        }
+        for workers in self.workers.values():
+            workers.start()
 
     def run(self):
         while self.running:
             try:
-                platform = self.need_load()
-                if platform is not None:
-                    self.pool.preload(platform, "preloaded")
+                for platform in self.pool.queue.counts():
+                    self.build_for_waiters(platform)
+                for platform, count in self.need_load().items():
+                    for _ in range(count):
+                        self.schedule(platform)
             except Exception as e:
                 log.exception('Exception in preloader: %s', e.message)
 
             time.sleep(config.PRELOADER_FREQUENCY)
 
-    def need_load(self):
-        if self.pool.using is not []:
-            using = [vm for vm in self.pool.using
-                     if vm.is_preloaded()]
-        else:
-            using = []
-        already_have = self.pool.count_virtual_machines(self.pool.pool + using)
-        platforms = {}
+    def concurrency(self, platform):
+        backend = self.pool.platforms.backend(platform)
+        if backend is None:
+            return 1
+        return self.workers[backend].max
+
+    def schedule(self, platform, prefix="preloaded"):
+        backend = self.pool.platforms.backend(platform)
+        if backend is None:
+            log.warning("Can't preload unknown platform %s" % platform)
+            return
+
+        with self.lock:
+            self.queued[platform] += 1
+            if prefix == "ondemand":
+                self.ondemand[platform] += 1
+            self.pending[prefix][backend].append(platform)
+        self.workers[backend].callInThread(self.load_next, backend)
+
+    def load_next(self, backend):
+        """ Every worker call builds one scheduled machine,
+            on-demand ones first. """
+        with self.lock:
+            if self.pending["ondemand"][backend]:
+                prefix = "ondemand"
+            else:
+                prefix = "preloaded"
+            platform = self.pending[prefix][backend].popleft()
+        self.load(platform, prefix)
+
+    def build_for_waiters(self, platform):
+        """ Schedules machines for waiters which are not covered
+            by machines already being created. """
+        with self.lock:
+            pending = self.queued[platform] + self.creating[platform]
+            for _ in range(self.pool.queue.count(platform) - pending):
+                self.schedule(platform, "ondemand")
+
+    def load(self, platform, prefix="preloaded"):
+        with self.lock:
+            self.queued[platform] -= 1
+            self.creating[platform] += 1
+        try:
+            if not self.running:
+                return
+            vm = self.pool.preload(platform, prefix)
+            if vm and prefix == "ondemand":
+                self.pool.dispatch(platform)
+                if vm.ready and vm in self.pool.pool:
+                    log.info("Nobody waits for %s, deleting" % vm.name)
+                    self.pool.remove_vm(vm)
+                    vm.delete()
+        except Exception as e:
+            log.exception('Exception while preloading %s: %s' %
+                          (platform, e.message))
+        finally:
+            with self.lock:
+                self.creating[platform] -= 1
+                if prefix == "ondemand":
+                    self.ondemand[platform] -= 1
 
-        if config.USE_KVM:
-            platforms.update(config.KVM_PRELOADED)
-        if config.USE_OPENSTACK:
-            platforms.update(config.OPENSTACK_PRELOADED)
+    def need_load(self):
+        """ Returns count of machines to create for every platform.
+            Claimed machines and the ones built for waiting sessions
+            don't count as preloaded. """
+        already_have = self.pool.count_virtual_machines(
+            vm for vm in self.pool.pool if not vm.is_ondemand())
+        platforms = self.pool.preload_targets()
+
+        deficit = {}
+        with self.lock:
+            for platform, need in platforms.iteritems():
+                have = already_have.get(platform, 0) + \
+                    self.queued[platform] + self.creating[platform] - \
+                    self.ondemand[platform]
+                if need > have:
+                    deficit[platform] = need - have
+        return deficit
 
-        for platform, need in platforms.iteritems():
-            have = already_have.get(platform, 0)
-            if need > have:
-                return platform
+    @property
+    def info(self):
+        with self.lock:
+            queued = dict((p, c) for p, c in self.queued.items() if c)
+            creating = dict((p, c) for p, c in self.creating.items() if c)
+        return {
+            "queued": queued,
+            "creating": creating,
+            "ready": self.pool.pool.ready_count(),
+            "targets": self.pool.preload_targets_info(),
+        }
 
-    def stop(self):
+    def stop(self, timeout=None):
+        """ Queued builds are dropped, running ones get the timeout
+            to finish. """
+        if timeout is None:
+            timeout = config.PRELOADER_STOP_TIMEOUT
         self.running = False
         self.join(1)
+
+        threads = []
+        for workers in self.workers.values():
+            threads.extend(workers.signal_stop())
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        stragglers = [thread.name for thread in threads if thread.is_alive()]
+        if stragglers:
+            log.warning("Preloader workers still running after %ss: %s" %
+                        (timeout, ", ".join(stragglers)))
         log.info("Preloader stopped")
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import time
+import itertools
+from bisect import bisect_left, insort
+from threading import Event, RLock
+from collections import defaultdict
+
+
+class Waiter(object):
+    """ Session waiting for a virtual machine of a platform. """
+
+    def __init__(self, platform, priority=0, session_id=None, name=None):
+        self.platform = platform
+        self.priority = priority
+        self.session_id = session_id
+        self.name = name
+        self.enqueued = time.time()
+        self.seq = None
+        self.vm = None
+        self.event = Event()
+
+    @property
+    def key(self):
+        return -self.priority, self.seq
+
+    @property
+    def served(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def serve(self, vm):
+        self.vm = vm
+        self.event.set()
+
+
+class WaitQueue(object):
+    """ Per platform queue of waiters ordered by priority, then by
+        arrival. A waiter put back keeps its place in the queue. """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.waiters = defaultdict(list)
+        self.counter = itertools.count()
+
+    def put(self, waiter):
+        with self.lock:
+            if waiter.seq is None:
+                waiter.seq = next(self.counter)
+            waiter.vm = None
+            waiter.event.clear()
+            insort(self.waiters[waiter.platform], (waiter.key, waiter))
+        return waiter
+
+    def remove(self, waiter):
+        """ Returns False if waiter is not in the queue. """
+        with self.lock:
+            waiters = self.waiters[waiter.platform]
+            i = bisect_left(waiters, (waiter.key,))
+            if i < len(waiters) and waiters[i][1] is waiter:
+                del waiters[i]
+                return True
+            return False
+
+    def first(self, platform):
+        with self.lock:
+            waiters = self.waiters.get(platform)
+            if waiters:
+                return waiters[0][1]
+            return None
+
+    def serve_first(self, platform, get_vm):
+        """ Hands a machine from get_vm to the first waiter of platform.
+            Returns the waiter, None if no waiter or no machine. """
+        with self.lock:
+            waiter = self.first(platform)
+            if waiter is None:
+                return None
+            vm = get_vm(platform)
+            if vm is None:
+                return None
+            self.remove(waiter)
+            waiter.serve(vm)
+            return waiter
+
+    def position(self, waiter):
+        with self.lock:
+            waiters = self.waiters[waiter.platform]
+            i = bisect_left(waiters, (waiter.key,))
+            if i < len(waiters) and waiters[i][1] is waiter:
+                return i + 1
+            return None
+
+    def count(self, platform=None):
+        with self.lock:
+            if platform is not None:
+                return len(self.waiters.get(platform, ()))
+            return sum(len(waiters) for waiters in self.waiters.values())
+
+    def counts(self):
+        with self.lock:
+            return dict((platform, len(waiters))
+                        for platform, waiters in self.waiters.items()
+                        if waiters)
+
+    def items(self):
+        """ Returns (position, waiter) pairs of all platforms. """
+        with self.lock:
+            return [(position, waiter)
+                    for waiters in self.waiters.values()
+                    for position, (_, waiter) in enumerate(waiters, 1)]